@@ -3,22 +3,22 @@
 Скрипт для авторизации Google Calendar в headless режиме
 """
 import os
-import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+import token_store
 
-SCOPES = ['https://www.googleapis.com/auth/calendar']
-TOKEN_PATH = 'data/token.pickle'
+SCOPES = token_store.SCOPES
+TOKEN_PATH = token_store.TOKEN_PATH
 CREDENTIALS_PATH = 'credentials.json'
 
 def authenticate():
     """Авторизация в Google Calendar"""
     creds = None
     
-    # Проверяем существующий токен
-    if os.path.exists(TOKEN_PATH):
-        with open(TOKEN_PATH, 'rb') as token:
-            creds = pickle.load(token)
+    # Проверяем существующий токен (token.pickle переносится в JSON)
+    if os.path.exists(token_store.LEGACY_PICKLE_PATH) and not os.path.exists(TOKEN_PATH):
+        print(f"🔁 Перенос токена из {token_store.LEGACY_PICKLE_PATH} в {TOKEN_PATH}")
+    creds = token_store.load_or_migrate()
     
     # Если токена нет или он невалиден
     if not creds or not creds.valid:
@@ -58,9 +58,7 @@ def authenticate():
             creds = flow.credentials
         
         # Сохраняем токен
-        os.makedirs('data', exist_ok=True)
-        with open(TOKEN_PATH, 'wb') as token:
-            pickle.dump(creds, token)
+        token_store.save_credentials(creds)
         
         print("✅ Авторизация успешна!")
         print(f"📁 Токен сохранен: {TOKEN_PATH}")
@@ -0,0 +1,186 @@
+"""
+Сетка доступности: свободное время на горизонте в виде битовой маски
+
+Горизонт делится на ячейки по AVAILABILITY_GRID_MINUTES минут, ячейка i
+соответствует биту i целого числа. Рабочие часы, записи и занятые интервалы
+из календаря растеризуются в маски целиком, а запросы (слоты, первый
+свободный слот, свободные минуты по дням) решаются побитовыми операциями над
+всей маской сразу, без перебора слотов по дням.
+"""
+from datetime import datetime, date, time, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import pytz
+import config
+
+
+def _span(start: int, end: int) -> int:
+    """Маска с единицами в битах [start, end)"""
+    if end <= start:
+        return 0
+    return ((1 << (end - start)) - 1) << start
+
+
+def _set_bits(mask: int) -> List[int]:
+    """Номера установленных битов по возрастанию"""
+    bits = format(mask, 'b')[::-1]
+    result = []
+    i = bits.find('1')
+    while i != -1:
+        result.append(i)
+        i = bits.find('1', i + 1)
+    return result
+
+
+def _runs(mask: int, length: int) -> int:
+    """Биты i, для которых свободны все ячейки i..i+length-1"""
+    result = mask
+    have = 1
+    while have < length:
+        step = min(have, length - have)
+        result &= result >> step
+        have += step
+    return result
+
+
+def _periodic(count: int, step: int) -> int:
+    """Маска с count битами через каждые step ячеек, начиная с 0"""
+    if count <= 0:
+        return 0
+    pattern, have = 1, 1
+    while have < count:
+        pattern |= pattern << (have * step)
+        have *= 2
+    return pattern & ((1 << ((count - 1) * step + 1)) - 1)
+
+
+class AvailabilityGrid:
+    def __init__(self, start_date: date, days: int, tz: pytz.BaseTzInfo,
+                 cell_minutes: int = config.AVAILABILITY_GRID_MINUTES):
+        self.tz = tz
+        self.cell = timedelta(minutes=cell_minutes)
+        
+        # Локальные полуночи горизонта (days + 1 граница)
+        midnights = [
+            tz.localize(datetime.combine(start_date + timedelta(days=i), time(0, 0)))
+            for i in range(days + 1)
+        ]
+        self.start_utc = midnights[0].astimezone(pytz.utc)
+        self.end_utc = midnights[-1].astimezone(pytz.utc)
+        self.size = int((self.end_utc - self.start_utc) / self.cell)
+        
+        # Границы локальных дней в ячейках: (дата, первая ячейка, конец)
+        self.day_bounds: List[Tuple[date, int, int]] = [
+            (start_date + timedelta(days=i),
+             self._cell_floor(midnights[i]),
+             self._cell_floor(midnights[i + 1]))
+            for i in range(days)
+        ]
+        
+        self.working = 0
+        self.busy = 0
+        self.not_before = 0
+        # Рабочие окна по дням: (дата, первая ячейка, конец) - от них отсчитываются слоты
+        self.windows: List[Tuple[date, int, int]] = []
+        # Возраст данных календаря о занятости в секундах (None - свежие)
+        self.busy_age: Optional[float] = None
+    
+    # === Растеризация ===
+    
+    def _cell_floor(self, dt: datetime) -> int:
+        cell = int((dt - self.start_utc) // self.cell)
+        return min(max(cell, 0), self.size)
+    
+    def _cell_ceil(self, dt: datetime) -> int:
+        offset = dt - self.start_utc
+        cell = int(offset // self.cell) + (1 if offset % self.cell else 0)
+        return min(max(cell, 0), self.size)
+    
+    def cell_time(self, cell: int) -> datetime:
+        return self.start_utc + cell * self.cell
+    
+    def add_working_window(self, day: date, start_utc: datetime, end_utc: datetime):
+        """Добавить рабочее окно (только целые ячейки внутри окна)"""
+        start, end = self._cell_ceil(start_utc), self._cell_floor(end_utc)
+        if start < end:
+            self.working |= _span(start, end)
+            self.windows.append((day, start, end))
+    
+    def add_busy(self, intervals: Iterable[Tuple[datetime, datetime]]):
+        """Отметить занятые интервалы (ячейки, хоть частично пересекающиеся с интервалом)"""
+        busy = self.busy
+        for start_utc, end_utc in intervals:
+            busy |= _span(self._cell_floor(start_utc), self._cell_ceil(end_utc))
+        self.busy = busy
+    
+    def block_before(self, dt: datetime):
+        """Запретить запись раньше dt"""
+        self.not_before = max(self.not_before, self._cell_ceil(dt))
+    
+    @property
+    def free(self) -> int:
+        """Маска свободных ячеек"""
+        return self.working & ~self.busy & ~_span(0, self.not_before)
+    
+    # === Запросы ===
+    
+    def _cells(self, minutes: int) -> int:
+        return -(-timedelta(minutes=minutes) // self.cell)
+    
+    def _candidates(self, duration_cells: int, step_cells: int) -> int:
+        """
+        Возможные начала слотов с шагом step_cells: от начала рабочего окна
+        или от not_before, если окно уже началось (как в исходном расписании)
+        """
+        mask = 0
+        for _, start, end in self.windows:
+            first = max(start, self.not_before)
+            count = (end - duration_cells - first) // step_cells + 1
+            if count > 0:
+                mask |= _periodic(count, step_cells) << first
+        return mask
+    
+    def slot_mask(self, duration_minutes: int, step_minutes: Optional[int] = None,
+                  within: Optional[int] = None, buffer_minutes: int = 0) -> int:
+        """
+        Маска начал свободных слотов длительностью duration_minutes
+        Слот занимает duration_minutes + buffer_minutes; по умолчанию слоты
+        идут с таким же шагом.
+        within - ограничить маской ячеек (слот должен целиком попасть в нее)
+        """
+        occupied_cells = self._cells(duration_minutes + buffer_minutes)
+        step_cells = self._cells(step_minutes or duration_minutes + buffer_minutes)
+        free = self.free if within is None else self.free & within
+        return self._candidates(occupied_cells, step_cells) & _runs(free, occupied_cells)
+    
+    def slots(self, duration_minutes: int, step_minutes: Optional[int] = None,
+              within: Optional[int] = None,
+              buffer_minutes: int = 0) -> List[Tuple[datetime, datetime]]:
+        """Свободные слоты на всем горизонте: список (start_utc, end_utc)"""
+        duration = timedelta(minutes=duration_minutes)
+        mask = self.slot_mask(duration_minutes, step_minutes, within, buffer_minutes)
+        return [
+            (self.cell_time(cell), self.cell_time(cell) + duration)
+            for cell in _set_bits(mask)
+        ]
+    
+    def first_free(self, after: datetime, duration_minutes: int,
+                   step_minutes: Optional[int] = None,
+                   buffer_minutes: int = 0) -> Optional[datetime]:
+        """Первый свободный слот, начинающийся не раньше after"""
+        mask = self.slot_mask(duration_minutes, step_minutes, buffer_minutes=buffer_minutes)
+        mask &= ~_span(0, self._cell_ceil(after))
+        if not mask:
+            return None
+        return self.cell_time((mask & -mask).bit_length() - 1)
+    
+    def count_by_day(self, mask: int) -> Dict[date, int]:
+        """Число установленных битов маски по локальным дням"""
+        return {
+            day: (mask & _span(start, end)).bit_count()
+            for day, start, end in self.day_bounds
+        }
+    
+    def free_minutes_by_day(self) -> Dict[date, int]:
+        """Свободные минуты по дням (для тепловой карты)"""
+        cell_minutes = int(self.cell.total_seconds() // 60)
+        return {day: cells * cell_minutes for day, cells in self.count_by_day(self.free).items()}
@@ -0,0 +1,171 @@
+"""
+Резервные копии базы данных
+
+Копия снимается онлайн через backup API SQLite порциями по
+BACKUP_PAGES_PER_STEP страниц с паузой между ними: блокировка чтения на
+исходной БД держится только на время одной порции, поэтому запись бота
+(создание записей) не ждет всю копию. Если БД изменилась во время
+копирования, SQLite сам начинает копию заново - снимок всегда целостный.
+
+Снимок сжимается gzip, рядом пишется файл .sha256 (формат sha256sum).
+Хранятся последние BACKUP_KEEP снимков. Восстановление проверяет
+контрольную сумму и PRAGMA integrity_check до замены файла БД.
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import config
+
+
+PREFIX = 'psybooking-'
+SUFFIX = '.db.gz'
+CHUNK_SIZE = 1024 * 1024
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_checksum(path: str, checksum: str):
+    with open(path + '.sha256', 'w', encoding='utf-8') as f:
+        f.write(f"{checksum}  {os.path.basename(path)}\n")
+
+
+def _read_checksum(path: str) -> Optional[str]:
+    checksum_path = path + '.sha256'
+    if not os.path.exists(checksum_path):
+        return None
+    with open(checksum_path, encoding='utf-8') as f:
+        return f.read().split()[0]
+
+
+def _integrity_check(db_path: str) -> str:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def create_backup(db_path: str = config.DATABASE_PATH,
+                  backup_dir: str = config.BACKUP_DIR,
+                  keep: int = config.BACKUP_KEEP,
+                  pages_per_step: int = config.BACKUP_PAGES_PER_STEP,
+                  step_sleep: float = config.BACKUP_STEP_SLEEP_SECONDS) -> Dict:
+    """
+    Снять сжатый снимок БД и удалить старые снимки сверх keep
+    Возвращает path, size, sha256, pages, seconds, removed.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.monotonic()
+    name = f"{PREFIX}{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}{SUFFIX}"
+    path = os.path.join(backup_dir, name)
+    
+    fd, raw_path = tempfile.mkstemp(dir=backup_dir, prefix='.backup-', suffix='.db')
+    os.close(fd)
+    gz_tmp_path = path + '.tmp'
+    try:
+        # Онлайн-копия порциями
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(raw_path)
+        try:
+            source.backup(target, pages=pages_per_step, sleep=step_sleep)
+            pages = target.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        
+        # Сжатие и контрольная сумма уже без обращения к исходной БД
+        with open(raw_path, 'rb') as src, gzip.open(gz_tmp_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        checksum = _file_sha256(gz_tmp_path)
+        os.replace(gz_tmp_path, path)
+        _write_checksum(path, checksum)
+    finally:
+        for tmp in (raw_path, gz_tmp_path):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    
+    removed = rotate_backups(backup_dir, keep)
+    return {
+        'path': path,
+        'size': os.path.getsize(path),
+        'sha256': checksum,
+        'pages': pages,
+        'seconds': round(time.monotonic() - started, 2),
+        'removed': removed,
+    }
+
+
+def list_backups(backup_dir: str = config.BACKUP_DIR) -> List[str]:
+    """Снимки от старых к новым (имя содержит время создания)"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return [
+        os.path.join(backup_dir, name)
+        for name in sorted(os.listdir(backup_dir))
+        if name.startswith(PREFIX) and name.endswith(SUFFIX)
+    ]
+
+
+def rotate_backups(backup_dir: str = config.BACKUP_DIR, keep: int = config.BACKUP_KEEP) -> int:
+    """Удалить старые снимки, оставив keep последних; возвращает число удаленных"""
+    backups = list_backups(backup_dir)
+    old = backups[:-keep] if keep > 0 else []
+    for path in old:
+        os.remove(path)
+        if os.path.exists(path + '.sha256'):
+            os.remove(path + '.sha256')
+    return len(old)
+
+
+def verify_backup(path: str) -> bool:
+    """Совпадает ли контрольная сумма снимка с файлом .sha256"""
+    expected = _read_checksum(path)
+    return expected is not None and expected == _file_sha256(path)
+
+
+def restore_backup(path: str, db_path: str = config.DATABASE_PATH) -> Dict:
+    """
+    Восстановить БД из снимка
+    Снимок распаковывается рядом с БД и проверяется (контрольная сумма,
+    integrity_check), только потом заменяет текущий файл. Текущая БД
+    сохраняется как <БД>.before-restore-<время>. Бот на время
+    восстановления нужно остановить.
+    """
+    if not verify_backup(path):
+        raise ValueError(f"Контрольная сумма снимка не совпадает или файл .sha256 не найден: {path}")
+    
+    db_dir = os.path.dirname(db_path) or '.'
+    os.makedirs(db_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=db_dir, prefix='.restore-', suffix='.db')
+    try:
+        with os.fdopen(fd, 'wb') as dst, gzip.open(path, 'rb') as src:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        
+        result = _integrity_check(tmp_path)
+        if result != 'ok':
+            raise ValueError(f"Снимок поврежден (integrity_check: {result})")
+        
+        previous = None
+        if os.path.exists(db_path):
+            previous = f"{db_path}.before-restore-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            os.replace(db_path, previous)
+        os.replace(tmp_path, db_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    return {'path': db_path, 'previous': previous}
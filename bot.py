@@ -1,6 +1,7 @@
 """
 PsyBooking Telegram Bot - главный файл
 """
+import asyncio
 import logging
 from datetime import datetime, date, timedelta
 from typing import Optional
@@ -18,25 +19,32 @@ from telegram.ext import (
 import config
 from database import Database
 from scheduler import Scheduler
+from stats import collect_stats, format_stats
+import backup
+import callbacks
+import timefmt
+import waitlist
+from logging_setup import setup_logging, traced
+from health import HealthMonitor
+from update_processor import (OrderedUpdateProcessor, PRIORITY_BROWSE,
+                              PRIORITY_COMMIT, PRIORITY_DEFAULT)
+
+# Настройка логирования (до импорта Google Calendar - его ошибка тоже логируется)
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # Google Calendar - опционально
 try:
     from google_calendar import get_calendar_client
+    import reconcile
     GOOGLE_CALENDAR_ENABLED = True
 except Exception as e:
     logger.warning(f"Google Calendar недоступен: {e}")
     GOOGLE_CALENDAR_ENABLED = False
     get_calendar_client = None
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
 # Состояния диалога
-SELECTING_DATE, SELECTING_SLOT = range(2)
+SELECTING_SERVICE, SELECTING_DATE, SELECTING_SLOT = range(3)
 
 # Инициализация
 db = Database()
@@ -71,29 +79,185 @@ def check_max_bookings(user_id: int) -> bool:
     return len(active_bookings) < config.MAX_ACTIVE_BOOKINGS_PER_USER
 
 
-def format_booking_confirmation(booking: dict, event_link: str) -> str:
+def format_service(service: dict) -> str:
+    """Название услуги с длительностью и ценой для кнопок и сообщений"""
+    text = f"{service['name']} · {service['duration']} мин"
+    if service['price']:
+        text += f" · {service['price']}"
+    return text
+
+
+def get_user_tz(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str:
+    """Часовой пояс клиента для отображения (кэшируется в user_data)"""
+    if 'timezone' not in context.user_data:
+        context.user_data['timezone'] = db.get_user_timezone(user_id) or config.PRIMARY_TZ
+    return context.user_data['timezone']
+
+
+def timezone_name(tz_name: str) -> str:
+    """Название часового пояса для сообщений"""
+    return config.CLIENT_TIMEZONES.get(tz_name, {}).get('name', tz_name)
+
+
+def no_slots_message(default: str) -> str:
+    """Сообщение об отсутствии слотов (с причиной, если недоступен календарь)"""
+    if scheduler.is_calendar_degraded():
+        return ("⚠️ Календарь психолога временно недоступен, поэтому свободное время "
+                "сейчас не показывается. Попробуйте, пожалуйста, немного позже.")
+    return default
+
+
+def stale_data_notice() -> str:
+    """Предупреждение к слотам, показанным по сохраненной занятости календаря"""
+    age = scheduler.calendar_data_age()
+    if age is None:
+        return ''
+    minutes = max(1, round(age.total_seconds() / 60))
+    return (f"\n\n⚠️ Календарь психолога временно недоступен: свободное время показано "
+            f"по данным {minutes} мин назад.")
+
+
+def format_booking_confirmation(booking: dict, event_link: str,
+                                tz_name: str = config.PRIMARY_TZ) -> str:
     """Форматировать сообщение подтверждения записи"""
-    tz = pytz.timezone(config.PRIMARY_TZ)
     start_utc = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
-    start_local = start_utc.astimezone(tz)
+    service = scheduler.get_service(booking['service_type'])
     
     message = f"""
 ✅ <b>Запись подтверждена!</b>
 
-📅 Дата: {start_local.strftime('%d.%m.%Y')}
-🕐 Время: {start_local.strftime('%H:%M')} (по времени Минска)
-⏱ Длительность: {config.SESSION_DURATION_MINUTES} минут
+🗂 Услуга: {service['name']}
+📅 Дата: {timefmt.format_date(start_utc, tz_name)}
+🕐 Время: {timefmt.format_time(start_utc, tz_name)} ({timefmt.tz_label(tz_name)})
+⏱ Длительность: {service['duration']} минут
 
 Событие добавлено в календарь.
 Вы получите напоминание за час до консультации.
 
 <a href="{event_link}">📎 Добавить в свой календарь</a>
 
-Если вам нужно отменить или перенести запись, пожалуйста, свяжитесь с психологом заранее.
+Отменить или перенести запись можно в разделе «Мои записи».
 """
     return message
 
 
+def format_bookings_list(bookings: list, tz_name: str) -> str:
+    """Форматировать список записей клиента"""
+    message = "📋 <b>Ваши записи:</b>\n\n"
+    
+    for booking in bookings:
+        start_utc = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
+        
+        status_emoji = "✅" if booking['status'] == 'confirmed' else "⏳"
+        
+        message += (f"{status_emoji} {timefmt.format_date(start_utc, tz_name)} "
+                    f"в {timefmt.format_time(start_utc, tz_name)}\n")
+        
+        if booking['event_link']:
+            message += f"   <a href=\"{booking['event_link']}\">Ссылка на событие</a>\n"
+        
+        message += "\n"
+    
+    if tz_name != config.PRIMARY_TZ:
+        message += f"🌍 Часовой пояс: {timezone_name(tz_name)}\n"
+    
+    message += (f"Отменить или перенести запись можно кнопками ниже не позднее чем за "
+                f"{config.CLIENT_CHANGE_MIN_HOURS} ч. до начала, позже - свяжитесь с психологом.")
+    return message
+
+
+def format_waitlist(entries: list) -> str:
+    """Форматировать подписки клиента на освободившееся время"""
+    message = "🔔 <b>Лист ожидания:</b>\n"
+    for entry in entries:
+        day = date.fromisoformat(entry['date'])
+        message += (f"   • {scheduler.format_date_local(day)}, "
+                    f"{waitlist.format_range(entry['from_time'], entry['to_time'])}\n")
+    message += f"<i>Время - {timefmt.tz_label(config.PRIMARY_TZ)}</i>\n"
+    return message
+
+
+def get_waitlist_entries(user_id: int) -> list:
+    """Подписки клиента на сегодня и позже"""
+    today = datetime.now(pytz.timezone(config.PRIMARY_TZ)).date()
+    return db.get_waitlist(today.isoformat(), user_id)
+
+
+def format_my_bookings(bookings: list, entries: list, tz_name: str) -> str:
+    """Записи и подписки клиента (раздел 'Мои записи')"""
+    if bookings:
+        message = format_bookings_list(bookings, tz_name)
+    else:
+        message = "У вас пока нет активных записей.\n"
+    if entries:
+        message += "\n\n" + format_waitlist(entries)
+    return message
+
+
+def booking_start(booking: dict) -> datetime:
+    return datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
+
+
+def change_deadline() -> datetime:
+    """Записи, начинающиеся раньше, клиент сам не отменяет и не переносит"""
+    return (datetime.now(pytz.utc) + timedelta(hours=config.CLIENT_CHANGE_MIN_HOURS)).replace(microsecond=0)
+
+
+def my_bookings_keyboard(bookings: list, entries: list, user_id: int, tz_name: str) -> InlineKeyboardMarkup:
+    """Кнопки раздела 'Мои записи': отмена и перенос записей, отписка"""
+    keyboard = []
+    deadline = change_deadline()
+    for booking in bookings:
+        start_utc = booking_start(booking)
+        if start_utc < deadline:
+            continue
+        booking_code = callbacks.to_base36(booking['id'])
+        keyboard.append([
+            InlineKeyboardButton(
+                f"✖️ Отменить {timefmt.to_local(start_utc, tz_name).strftime('%d.%m %H:%M')}",
+                callback_data=callbacks.encode('booking_cancel', booking_code, user_id=user_id)
+            ),
+            InlineKeyboardButton(
+                "🔁 Перенести",
+                callback_data=callbacks.encode('booking_move', booking_code, user_id=user_id)
+            )
+        ])
+    
+    keyboard += [
+        [InlineKeyboardButton(
+            f"✖️ Не ждать {scheduler.format_date_local(date.fromisoformat(entry['date']))}",
+            callback_data=callbacks.encode('waitlist_leave', callbacks.to_base36(entry['id']), user_id=user_id)
+        )]
+        for entry in entries
+    ]
+    keyboard += [
+        [InlineKeyboardButton("📅 Записаться ещё раз", callback_data=callbacks.encode('book_start'))],
+        [InlineKeyboardButton("🆘 SOS", url="tg://user?id=783321437"),
+         InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def format_slots_list(slots: list, tz_name: str) -> str:
+    """Форматировать список ближайших слотов, сгруппированный по дням клиента"""
+    message = "🕐 <b>Ближайшие доступные слоты:</b>\n\n"
+    
+    if tz_name != config.PRIMARY_TZ:
+        message += f"<i>🌍 Часовой пояс: {timezone_name(tz_name)}</i>\n"
+    
+    current_date = None
+    for slot in slots:
+        slot_date = timefmt.to_local(slot['start_utc'], tz_name).date()
+        if slot_date != current_date:
+            current_date = slot_date
+            message += f"\n📅 <b>{scheduler.format_date_local(slot_date)}</b>\n"
+        
+        message += (f"   • {timefmt.format_time(slot['start_utc'], tz_name)} - "
+                    f"{timefmt.format_time(slot['end_utc'], tz_name)}\n")
+    
+    return message
+
+
 # === Команды бота ===
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -112,13 +276,14 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Нажмите кнопку ниже, чтобы начать запись.
 """
-    
+
     keyboard = [
-        [InlineKeyboardButton("📅 Записаться на консультацию", callback_data="book_start")],
-        [InlineKeyboardButton("📋 Мои записи", callback_data="my_bookings"),
-         InlineKeyboardButton("🕐 Доступные слоты", callback_data="slots")],
+        [InlineKeyboardButton("📅 Записаться на консультацию", callback_data=callbacks.encode('book_start'))],
+        [InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings')),
+         InlineKeyboardButton("🕐 Доступные слоты", callback_data=callbacks.encode('slots'))],
         [InlineKeyboardButton("🆘 SOS - Связаться с психологом", url="tg://user?id=783321437")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
+        [InlineKeyboardButton("🌍 Часовой пояс", callback_data=callbacks.encode('timezone')),
+         InlineKeyboardButton("ℹ️ Помощь", callback_data=callbacks.encode('help'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -127,7 +292,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
-    help_text = """
+    services = '\n'.join(f"• {format_service(service)}" for service in config.SERVICE_TYPES.values())
+    help_text = f"""
 ℹ️ <b>Справка по использованию бота</b>
 
 <b>Доступные команды:</b>
@@ -135,26 +301,30 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /book - Записаться на консультацию
 /slots - Посмотреть ближайшие свободные слоты
 /mybookings - Мои записи
+/timezone - Часовой пояс для отображения времени
 /help - Показать эту справку
 
 <b>Как записаться:</b>
 1. Нажмите "Записаться" или используйте команду /book
-2. Выберите удобную дату
-3. Выберите подходящее время
-4. Получите подтверждение с ссылкой на событие
+2. Выберите услугу
+3. Выберите удобную дату
+4. Выберите подходящее время
+5. Получите подтверждение с ссылкой на событие
+
+<b>Услуги:</b>
+{services}
 
 <b>Важно:</b>
 • Запись возможна минимум за {config.MIN_HOURS_BEFORE_BOOKING} часа
-• Длительность консультации: {config.SESSION_DURATION_MINUTES} минут
 • Максимум активных записей: {config.MAX_ACTIVE_BOOKINGS_PER_USER}
 
 Если у вас возникли вопросы, свяжитесь с психологом напрямую.
 """
-    
+
     keyboard = [
-        [InlineKeyboardButton("📅 Записаться", callback_data="book_start")],
+        [InlineKeyboardButton("📅 Записаться", callback_data=callbacks.encode('book_start'))],
         [InlineKeyboardButton("🆘 SOS - Связаться с психологом", url="tg://user?id=783321437")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -183,39 +353,95 @@ async def book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    # Показать выбор даты
+    # Показать выбор услуги
+    return await show_service_selection(update, context)
+
+
+async def show_service_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать выбор типа услуги (если услуга одна - сразу выбор даты)"""
+    if len(config.SERVICE_TYPES) == 1:
+        context.user_data['service_type'] = next(iter(config.SERVICE_TYPES))
+        return await show_date_selection(update, context)
+    
+    user_id = update.effective_user.id
+    keyboard = [
+        [InlineKeyboardButton(format_service(service),
+                              callback_data=callbacks.encode('service', key, user_id=user_id))]
+        for key, service in config.SERVICE_TYPES.items()
+    ]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=callbacks.encode('cancel'))])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    message = "🗂 Выберите тип консультации:"
+    
+    if update.message:
+        await update.message.reply_text(message, reply_markup=reply_markup)
+    elif update.callback_query:
+        await update.callback_query.message.edit_text(message, reply_markup=reply_markup)
+    
+    return SELECTING_SERVICE
+
+
+async def service_selected(update: Update, context: ContextTypes.DEFAULT_TYPE, service_type: str):
+    """Обработчик выбора типа услуги"""
+    query = update.callback_query
+    await query.answer()
+    
+    if service_type not in config.SERVICE_TYPES:
+        return await show_service_selection(update, context)
+    
+    context.user_data['service_type'] = service_type
+    
+    return await show_date_selection(update, context)
+
+
+async def choose_date_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопки 'Выбрать другую дату'"""
+    query = update.callback_query
+    await query.answer()
+    
     return await show_date_selection(update, context)
 
 
 async def show_date_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать выбор даты"""
-    available_dates = scheduler.get_available_dates()
+    """Показать выбор даты (только даты со свободными слотами)"""
+    slot_counts = await scheduler.free_slot_counts(context.user_data.get('service_type'))
+    available_dates = list(slot_counts)
     
     if not available_dates:
-        message = "😔 К сожалению, в ближайшее время нет доступных дат для записи."
+        message = no_slots_message("😔 К сожалению, в ближайшее время нет свободных слотов для записи.")
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔔 Сообщить, когда освободится", callback_data=callbacks.encode('waitlist'))
+        ]])
         
         if update.message:
-            await update.message.reply_text(message)
+            await update.message.reply_text(message, reply_markup=reply_markup)
         else:
-            await update.callback_query.message.edit_text(message)
+            await update.callback_query.message.edit_text(message, reply_markup=reply_markup)
         
-        return ConversationHandler.END
+        return SELECTING_DATE
     
     # Создать кнопки для дат
+    user_id = update.effective_user.id
     keyboard = []
     
+    def date_button(label: str, day: date) -> InlineKeyboardButton:
+        return InlineKeyboardButton(
+            label, callback_data=callbacks.encode('date', callbacks.encode_date(day), user_id=user_id)
+        )
+    
     # Сегодня и завтра (если доступны)
     today = datetime.now(pytz.timezone(config.PRIMARY_TZ)).date()
     tomorrow = today + timedelta(days=1)
     
     quick_buttons = []
-    if today in available_dates:
+    if today in slot_counts:
         quick_buttons.append(
-            InlineKeyboardButton("Сегодня", callback_data=f"date_{today.isoformat()}")
+            date_button(f"Сегодня ({slot_counts[today]})", today)
         )
-    if tomorrow in available_dates:
+    if tomorrow in slot_counts:
         quick_buttons.append(
-            InlineKeyboardButton("Завтра", callback_data=f"date_{tomorrow.isoformat()}")
+            date_button(f"Завтра ({slot_counts[tomorrow]})", tomorrow)
         )
     
     if quick_buttons:
@@ -224,15 +450,16 @@ async def show_date_selection(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Остальные даты (первые 7)
     other_dates = [d for d in available_dates if d not in [today, tomorrow]][:7]
     for date_obj in other_dates:
-        date_str = scheduler.format_date_local(date_obj)
-        keyboard.append([
-            InlineKeyboardButton(date_str, callback_data=f"date_{date_obj.isoformat()}")
-        ])
+        date_str = f"{scheduler.format_date_local(date_obj)} ({slot_counts[date_obj]})"
+        keyboard.append([date_button(date_str, date_obj)])
     
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
+    keyboard.append([InlineKeyboardButton("🔔 Нет удобной даты - лист ожидания",
+                                          callback_data=callbacks.encode('waitlist'))])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=callbacks.encode('cancel'))])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    message = "📅 Выберите удобную дату для консультации:"
+    message = "📅 Выберите удобную дату для консультации\n(в скобках - число свободных слотов):"
+    message += stale_data_notice()
     
     if update.message:
         await update.message.reply_text(message, reply_markup=reply_markup)
@@ -242,7 +469,7 @@ async def show_date_selection(update: Update, context: ContextTypes.DEFAULT_TYPE
     return SELECTING_DATE
 
 
-async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE, date_code: str):
     """Обработчик выбора даты"""
     query = update.callback_query
     await query.answer()
@@ -256,49 +483,61 @@ async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    # Извлечь дату из callback_data
-    date_str = query.data.replace("date_", "")
-    selected_date = date.fromisoformat(date_str)
+    selected_date = callbacks.decode_date(date_code)
     
     # Сохранить выбранную дату в контексте
     context.user_data['selected_date'] = selected_date
     
-    # Получить доступные слоты
-    available_slots = scheduler.get_available_slots(selected_date)
+    # Получить доступные слоты для выбранной услуги
+    service = scheduler.get_service(context.user_data.get('service_type'))
+    available_slots = await scheduler.available_slots(selected_date, service['key'])
     
     if not available_slots:
         await query.message.edit_text(
             f"😔 К сожалению, на {scheduler.format_date_local(selected_date)} нет свободных слотов.\n"
             "Пожалуйста, выберите другую дату.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Выбрать другую дату", callback_data="book_start")
-            ]])
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔔 Сообщить, если освободится", callback_data=callbacks.encode(
+                    'waitlist_date', service['key'], date_code, user_id=user_id
+                ))],
+                [InlineKeyboardButton("🔙 Выбрать другую дату", callback_data=callbacks.encode('choose_date'))]
+            ])
         )
         return SELECTING_DATE
     
+    tz_name = get_user_tz(context, user_id)
+    
     # Создать кнопки для слотов
     keyboard = []
     for slot in available_slots[:12]:  # Показать максимум 12 слотов
-        time_range = f"{slot['start_local']} - {slot['end_local']}"
+        time_range = (f"{timefmt.format_time(slot['start_utc'], tz_name)} - "
+                      f"{timefmt.format_time(slot['end_utc'], tz_name)}")
         keyboard.append([
             InlineKeyboardButton(
-                time_range, 
-                callback_data=f"slot_{slot['start_utc'].isoformat()}"
+                time_range,
+                callback_data=callbacks.encode(
+                    'slot', service['key'], callbacks.encode_datetime(slot['start_utc']),
+                    user_id=user_id
+                )
             )
         ])
     
-    keyboard.append([InlineKeyboardButton("🔙 Выбрать другую дату", callback_data="book_start")])
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
+    keyboard.append([InlineKeyboardButton("🔙 Выбрать другую дату", callback_data=callbacks.encode('choose_date'))])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=callbacks.encode('cancel'))])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     message = f"🕐 Выберите удобное время на {scheduler.format_date_local(selected_date)}:"
+    if tz_name != config.PRIMARY_TZ:
+        message += f"\n({timefmt.tz_label(tz_name)})"
+    message += stale_data_notice()
     
     await query.message.edit_text(message, reply_markup=reply_markup)
     
     return SELECTING_SLOT
 
 
-async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                        service_type: str, start_code: str):
     """Обработчик выбора слота - создание записи"""
     query = update.callback_query
     await query.answer()
@@ -306,10 +545,28 @@ async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     
-    # Извлечь время начала из callback_data
-    start_time_str = query.data.replace("slot_", "")
-    start_time_utc = datetime.fromisoformat(start_time_str).replace(tzinfo=pytz.utc)
-    end_time_utc = start_time_utc + timedelta(minutes=config.SESSION_DURATION_MINUTES)
+    # Услуга и время подписаны в callback_data - берем их из кнопки, а не из контекста
+    service = scheduler.get_service(service_type)
+    start_time_utc = callbacks.decode_datetime(start_code)
+    end_time_utc = start_time_utc + timedelta(minutes=service['duration'])
+    
+    # Кнопка могла остаться в старом сообщении - время уже слишком близко или прошло,
+    # день закрыт или время занято в календаре
+    min_start = datetime.now(pytz.utc) + timedelta(hours=config.MIN_HOURS_BEFORE_BOOKING)
+    day = start_time_utc.astimezone(scheduler.primary_tz).date()
+    available = start_time_utc >= min_start and any(
+        slot['start_utc'] == start_time_utc
+        for slot in await scheduler.available_slots(day, service['key'])
+    )
+    if not available:
+        await query.message.edit_text(
+            "😔 Это время уже недоступно для записи.\n"
+            "Пожалуйста, выберите другое время.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Выбрать другое время", callback_data=callbacks.encode('book_start'))
+            ]])
+        )
+        return ConversationHandler.END
     
     # Показать индикатор загрузки
     await query.message.edit_text("⏳ Создаю запись...")
@@ -321,16 +578,20 @@ async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         client_first_name=user.first_name,
         client_last_name=user.last_name,
         start_time_utc=start_time_utc.isoformat(),
-        end_time_utc=end_time_utc.isoformat()
+        end_time_utc=end_time_utc.isoformat(),
+        service_type=service['key']
     )
     
+    if booking_id is not None:
+        scheduler.invalidate_availability()
+    
     if booking_id is None:
         # Слот уже занят
         await query.message.edit_text(
             "😔 К сожалению, этот слот уже занят другим клиентом.\n"
             "Пожалуйста, выберите другое время.",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Выбрать другое время", callback_data="book_start")
+                InlineKeyboardButton("🔙 Выбрать другое время", callback_data=callbacks.encode('book_start'))
             ]])
         )
         return ConversationHandler.END
@@ -340,14 +601,14 @@ async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Календарь не подключен - просто подтвердить запись
         db.update_booking_with_google_event(booking_id, '', '')
         
-        tz = pytz.timezone(config.PRIMARY_TZ)
-        start_local = start_time_utc.astimezone(tz)
+        tz_name = get_user_tz(context, user_id)
         
         await query.message.edit_text(
             f"✅ Запись создана!\n\n"
-            f"📅 Дата: {start_local.strftime('%d.%m.%Y')}\n"
-            f"🕐 Время: {start_local.strftime('%H:%M')} (по времени Минска)\n"
-            f"⏱ Длительность: {config.SESSION_DURATION_MINUTES} минут\n\n"
+            f"📅 Дата: {timefmt.format_date(start_time_utc, tz_name)}\n"
+            f"🗂 Услуга: {service['name']}\n"
+            f"🕐 Время: {timefmt.format_time(start_time_utc, tz_name)} ({timefmt.tz_label(tz_name)})\n"
+            f"⏱ Длительность: {service['duration']} минут\n\n"
             f"⚠️ Календарь не подключен, событие не создано автоматически."
         )
         return ConversationHandler.END
@@ -361,12 +622,15 @@ async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.username:
         client_name += f" (@{user.username})"
     
-    event_result = calendar_client.create_event(
+    # Клиент календаря потокобезопасен - запрос к API не блокирует обработку других обновлений
+    event_result = await asyncio.to_thread(
+        calendar_client.create_event,
         calendar_id=calendar_id,
-        summary=f"Консультация: {client_name}",
-        description=f"Клиент: {client_name}\nTelegram ID: {user_id}",
+        summary=f"{service['name']}: {client_name}",
+        description=f"Клиент: {client_name}\nTelegram ID: {user_id}\nУслуга: {format_service(service)}",
         start_time=start_time_utc,
-        end_time=end_time_utc
+        end_time=end_time_utc,
+        booking_id=booking_id
     )
     
     if event_result is None:
@@ -388,14 +652,18 @@ async def slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     booking = db.get_booking(booking_id)
     
     # Отправить подтверждение
-    confirmation_message = format_booking_confirmation(booking, event_result['event_link'])
+    confirmation_message = format_booking_confirmation(
+        booking,
+        event_result['event_link'],
+        get_user_tz(context, user_id)
+    )
     
     # Добавить кнопки для дальнейших действий
     keyboard = [
-        [InlineKeyboardButton("📅 Записаться ещё раз", callback_data="book_start"),
-         InlineKeyboardButton("📋 Мои записи", callback_data="my_bookings")],
+        [InlineKeyboardButton("📅 Записаться ещё раз", callback_data=callbacks.encode('book_start')),
+         InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings'))],
         [InlineKeyboardButton("🆘 SOS", url="tg://user?id=783321437"),
-         InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+         InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -419,24 +687,15 @@ async def slots_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    next_slots = scheduler.get_next_available_slots(limit=10)
+    next_slots = await scheduler.next_available_slots(limit=10)
     
     if not next_slots:
         await update.message.reply_text(
-            "😔 К сожалению, в ближайшее время нет доступных слотов."
+            no_slots_message("😔 К сожалению, в ближайшее время нет доступных слотов.")
         )
         return
     
-    message = "🕐 <b>Ближайшие доступные слоты:</b>\n\n"
-    
-    current_date = None
-    for slot in next_slots:
-        slot_date = slot['date']
-        if slot_date != current_date:
-            current_date = slot_date
-            message += f"\n📅 <b>{scheduler.format_date_local(slot_date)}</b>\n"
-        
-        message += f"   • {slot['start_local']} - {slot['end_local']}\n"
+    message = format_slots_list(next_slots, get_user_tz(context, user_id))
     
     message += "\n\nДля записи используйте команду /book"
     
@@ -448,40 +707,45 @@ async def my_bookings_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     
     bookings = db.get_active_bookings_for_user(user_id)
+    entries = get_waitlist_entries(user_id)
     
-    if not bookings:
+    if not bookings and not entries:
         await update.message.reply_text(
             "У вас пока нет активных записей.\n\n"
             "Используйте /book для записи на консультацию."
         )
         return
     
-    message = "📋 <b>Ваши записи:</b>\n\n"
-    
-    tz = pytz.timezone(config.PRIMARY_TZ)
-    
-    for booking in bookings:
-        start_utc = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
-        start_local = start_utc.astimezone(tz)
-        
-        status_emoji = "✅" if booking['status'] == 'confirmed' else "⏳"
-        
-        message += f"{status_emoji} {start_local.strftime('%d.%m.%Y в %H:%M')}\n"
-        
-        if booking['event_link']:
-            message += f"   <a href=\"{booking['event_link']}\">Ссылка на событие</a>\n"
-        
-        message += "\n"
-    
-    message += "Для отмены записи свяжитесь с психологом."
+    tz_name = get_user_tz(context, user_id)
     
     await update.message.reply_text(
-        message,
+        format_my_bookings(bookings, entries, tz_name),
         parse_mode='HTML',
-        disable_web_page_preview=True
+        disable_web_page_preview=True,
+        reply_markup=my_bookings_keyboard(bookings, entries, user_id, tz_name)
     )
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика загрузки расписания (только для администраторов)"""
+    if update.effective_user.id not in config.ADMIN_TELEGRAM_IDS:
+        return
+    
+    # /stats [дней]
+    try:
+        days = int(context.args[0]) if context.args else config.STATS_DEFAULT_DAYS
+    except ValueError:
+        await update.message.reply_text("Использование: /stats [количество дней]")
+        return
+    
+    end_day = datetime.now(pytz.timezone(config.PRIMARY_TZ)).date() + timedelta(days=1)
+    start_day = end_day - timedelta(days=days)
+    
+    stats = await asyncio.to_thread(collect_stats, db, start_day, end_day)
+    
+    await update.message.reply_text(format_stats(stats))
+
+
 async def book_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Записаться'"""
     query = update.callback_query
@@ -504,7 +768,7 @@ async def book_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return ConversationHandler.END
     
-    return await show_date_selection(update, context)
+    return await show_service_selection(update, context)
 
 
 async def my_bookings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -514,12 +778,13 @@ async def my_bookings_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     
     user_id = update.effective_user.id
     bookings = db.get_active_bookings_for_user(user_id)
+    entries = get_waitlist_entries(user_id)
     
-    if not bookings:
+    if not bookings and not entries:
         keyboard = [
-            [InlineKeyboardButton("📅 Записаться", callback_data="book_start")],
+            [InlineKeyboardButton("📅 Записаться", callback_data=callbacks.encode('book_start'))],
             [InlineKeyboardButton("🆘 SOS", url="tg://user?id=783321437"),
-             InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+             InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -530,37 +795,13 @@ async def my_bookings_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return
     
-    message = "📋 <b>Ваши записи:</b>\n\n"
-    
-    tz = pytz.timezone(config.PRIMARY_TZ)
-    
-    for booking in bookings:
-        start_utc = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
-        start_local = start_utc.astimezone(tz)
-        
-        status_emoji = "✅" if booking['status'] == 'confirmed' else "⏳"
-        
-        message += f"{status_emoji} {start_local.strftime('%d.%m.%Y в %H:%M')}\n"
-        
-        if booking['event_link']:
-            message += f"   <a href=\"{booking['event_link']}\">Ссылка на событие</a>\n"
-        
-        message += "\n"
-    
-    message += "Для отмены записи свяжитесь с психологом."
-    
-    keyboard = [
-        [InlineKeyboardButton("📅 Записаться ещё раз", callback_data="book_start")],
-        [InlineKeyboardButton("🆘 SOS", url="tg://user?id=783321437"),
-         InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    tz_name = get_user_tz(context, user_id)
     
     await query.message.edit_text(
-        message,
+        format_my_bookings(bookings, entries, tz_name),
         parse_mode='HTML',
         disable_web_page_preview=True,
-        reply_markup=reply_markup
+        reply_markup=my_bookings_keyboard(bookings, entries, user_id, tz_name)
     )
 
 
@@ -577,39 +818,30 @@ async def slots_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    next_slots = scheduler.get_next_available_slots(limit=10)
+    next_slots = await scheduler.next_available_slots(limit=10)
     
     if not next_slots:
         keyboard = [
             [InlineKeyboardButton("🆘 SOS", url="tg://user?id=783321437"),
-             InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+             InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.message.edit_text(
-            "😔 К сожалению, в ближайшее время нет доступных слотов.\n\n"
-            "Свяжитесь с психологом для уточнения расписания.",
+            no_slots_message("😔 К сожалению, в ближайшее время нет доступных слотов.\n\n"
+                             "Свяжитесь с психологом для уточнения расписания."),
             reply_markup=reply_markup
         )
         return
     
-    message = "🕐 <b>Ближайшие доступные слоты:</b>\n\n"
-    
-    current_date = None
-    for slot in next_slots:
-        slot_date = slot['date']
-        if slot_date != current_date:
-            current_date = slot_date
-            message += f"\n📅 <b>{scheduler.format_date_local(slot_date)}</b>\n"
-        
-        message += f"   • {slot['start_local']} - {slot['end_local']}\n"
+    message = format_slots_list(next_slots, get_user_tz(context, user_id))
     
     message += "\n\nДля записи нажмите кнопку ниже."
     
     keyboard = [
-        [InlineKeyboardButton("📅 Записаться", callback_data="book_start")],
+        [InlineKeyboardButton("📅 Записаться", callback_data=callbacks.encode('book_start'))],
         [InlineKeyboardButton("🆘 SOS", url="tg://user?id=783321437"),
-         InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+         InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -647,26 +879,76 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 Нажмите кнопку ниже, чтобы начать запись.
 """
-    
+
     keyboard = [
-        [InlineKeyboardButton("📅 Записаться на консультацию", callback_data="book_start")],
-        [InlineKeyboardButton("📋 Мои записи", callback_data="my_bookings"),
-         InlineKeyboardButton("🕐 Доступные слоты", callback_data="slots")],
+        [InlineKeyboardButton("📅 Записаться на консультацию", callback_data=callbacks.encode('book_start'))],
+        [InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings')),
+         InlineKeyboardButton("🕐 Доступные слоты", callback_data=callbacks.encode('slots'))],
         [InlineKeyboardButton("🆘 SOS - Связаться с психологом", url="tg://user?id=783321437")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
+        [InlineKeyboardButton("🌍 Часовой пояс", callback_data=callbacks.encode('timezone')),
+         InlineKeyboardButton("ℹ️ Помощь", callback_data=callbacks.encode('help'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.message.edit_text(welcome_message, reply_markup=reply_markup)
 
 
+def timezone_keyboard(current_tz: str, user_id: int) -> InlineKeyboardMarkup:
+    """Клавиатура выбора часового пояса"""
+    buttons = [
+        InlineKeyboardButton(
+            ("✅ " if tz_name == current_tz else "") + tz_info['name'],
+            callback_data=callbacks.encode('tz', tz_name, user_id=user_id)
+        )
+        for tz_name, tz_info in config.CLIENT_TIMEZONES.items()
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор часового пояса (команда /timezone и кнопка меню)"""
+    user_id = update.effective_user.id
+    current_tz = get_user_tz(context, user_id)
+    message = (
+        f"🌍 Сейчас время показывается {timefmt.tz_label(current_tz)}.\n\n"
+        "Выберите часовой пояс, в котором вам удобнее видеть время записи:"
+    )
+    
+    if update.message:
+        await update.message.reply_text(message, reply_markup=timezone_keyboard(current_tz, user_id))
+    else:
+        await update.callback_query.answer()
+        await update.callback_query.message.edit_text(message, reply_markup=timezone_keyboard(current_tz, user_id))
+
+
+async def timezone_selected(update: Update, context: ContextTypes.DEFAULT_TYPE, tz_name: str):
+    """Обработчик выбора часового пояса"""
+    query = update.callback_query
+    await query.answer()
+    
+    if tz_name not in config.CLIENT_TIMEZONES:
+        return
+    
+    db.set_user_timezone(update.effective_user.id, tz_name)
+    context.user_data['timezone'] = tz_name
+    
+    await query.message.edit_text(
+        f"✅ Теперь время показывается {timefmt.tz_label(tz_name)}.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))
+        ]])
+    )
+
+
 async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Отмена'"""
     query = update.callback_query
     await query.answer()
     
     keyboard = [
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -679,6 +961,571 @@ async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик устаревших кнопок (старый формат или завершенный диалог)"""
+    await update.callback_query.answer(
+        "⚠️ Эта кнопка устарела. Начните заново: /start",
+        show_alert=True
+    )
+
+
+# === Отмена и перенос записи клиентом ===
+
+def get_changeable_booking(user_id: int, booking_code: str) -> Optional[dict]:
+    """Активная запись клиента, которую еще можно отменить или перенести"""
+    booking = db.get_booking(callbacks.from_base36(booking_code))
+    if (booking is None or booking['client_telegram_id'] != user_id
+            or booking['status'] not in ('pending', 'confirmed')
+            or booking_start(booking) < change_deadline()):
+        return None
+    return booking
+
+
+def describe_booking(booking: dict, tz_name: str) -> str:
+    """Дата, время и услуга записи для сообщений"""
+    start_utc = booking_start(booking)
+    service = scheduler.get_service(booking['service_type'])
+    return (f"📅 {timefmt.format_date(start_utc, tz_name)}\n"
+            f"🕐 {timefmt.format_time(start_utc, tz_name)} ({timefmt.tz_label(tz_name)})\n"
+            f"🗂 {service['name']}")
+
+
+async def booking_unchangeable(query):
+    """Ответ, если запись не найдена или менять ее уже поздно"""
+    await query.message.edit_text(
+        "⚠️ Эту запись уже нельзя изменить в боте.\n"
+        f"Отменить или перенести запись можно не позднее чем за {config.CLIENT_CHANGE_MIN_HOURS} ч. "
+        "до начала, позже - свяжитесь, пожалуйста, с психологом.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings'))
+        ]])
+    )
+
+
+async def booking_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, booking_code: str):
+    """Подтверждение отмены записи"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    booking = get_changeable_booking(user_id, booking_code)
+    if booking is None:
+        await booking_unchangeable(query)
+        return
+    
+    await query.message.edit_text(
+        "Отменить запись?\n\n" + describe_booking(booking, get_user_tz(context, user_id)),
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✖️ Да, отменить", callback_data=callbacks.encode(
+                'booking_cancel_confirm', booking_code, user_id=user_id
+            ))],
+            [InlineKeyboardButton("🔙 Назад", callback_data=callbacks.encode('my_bookings'))]
+        ])
+    )
+
+
+async def booking_cancel_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, booking_code: str):
+    """Отменить запись: ответ сразу после изменения в БД, календарь - в фоне"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    booking = db.cancel_client_booking(callbacks.from_base36(booking_code), user_id,
+                                       change_deadline().isoformat())
+    if booking is None:
+        await booking_unchangeable(query)
+        return
+    
+    scheduler.invalidate_availability()
+    
+    await query.message.edit_text(
+        "✅ Запись отменена.\n\n" + describe_booking(booking, get_user_tz(context, user_id)),
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📅 Записаться", callback_data=callbacks.encode('book_start')),
+             InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings'))]
+        ])
+    )
+    run_in_background(sync_booking_change(context.bot, booking, None))
+
+
+async def booking_move(update: Update, context: ContextTypes.DEFAULT_TYPE, booking_code: str):
+    """Перенос записи: выбор новой даты"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    booking = get_changeable_booking(user_id, booking_code)
+    if booking is None:
+        await booking_unchangeable(query)
+        return
+    
+    slot_counts = await scheduler.free_slot_counts(booking['service_type'])
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{scheduler.format_date_local(day)} ({count})",
+            callback_data=callbacks.encode('move_date', booking_code, callbacks.encode_date(day),
+                                           user_id=user_id)
+        )]
+        for day, count in list(slot_counts.items())[:9]
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=callbacks.encode('my_bookings'))])
+    
+    tz_name = get_user_tz(context, user_id)
+    if slot_counts:
+        message = "🔁 Перенос записи\n\n" + describe_booking(booking, tz_name) + "\n\nВыберите новую дату:"
+    else:
+        message = no_slots_message("😔 К сожалению, в ближайшее время нет свободных слотов для переноса.")
+    
+    await query.message.edit_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def move_date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             booking_code: str, date_code: str):
+    """Перенос записи: выбор нового времени"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    booking = get_changeable_booking(user_id, booking_code)
+    if booking is None:
+        await booking_unchangeable(query)
+        return
+    
+    day = callbacks.decode_date(date_code)
+    tz_name = get_user_tz(context, user_id)
+    slots = await scheduler.available_slots(day, booking['service_type'])
+    
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{timefmt.format_time(slot['start_utc'], tz_name)} - {timefmt.format_time(slot['end_utc'], tz_name)}",
+            callback_data=callbacks.encode('move_slot', booking_code, callbacks.encode_datetime(slot['start_utc']),
+                                           user_id=user_id)
+        )]
+        for slot in slots[:12]
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Другая дата", callback_data=callbacks.encode(
+        'booking_move', booking_code, user_id=user_id
+    ))])
+    
+    if slots:
+        message = f"🔁 Новое время на {scheduler.format_date_local(day)}:"
+        if tz_name != config.PRIMARY_TZ:
+            message += f"\n({timefmt.tz_label(tz_name)})"
+        message += stale_data_notice()
+    else:
+        message = f"😔 На {scheduler.format_date_local(day)} свободного времени уже нет."
+    
+    await query.message.edit_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def move_slot_selected(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             booking_code: str, start_code: str):
+    """Перенести запись: одна транзакция в БД, ответ сразу, календарь - в фоне"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    booking = db.get_booking(callbacks.from_base36(booking_code))
+    if booking is None:
+        await booking_unchangeable(query)
+        return
+    
+    service = scheduler.get_service(booking['service_type'])
+    start_time_utc = callbacks.decode_datetime(start_code)
+    end_time_utc = start_time_utc + timedelta(minutes=service['duration'])
+    retry_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔙 Выбрать другое время", callback_data=callbacks.encode(
+            'booking_move', booking_code, user_id=user_id
+        ))
+    ]])
+    
+    min_start = datetime.now(pytz.utc) + timedelta(hours=config.MIN_HOURS_BEFORE_BOOKING)
+    if start_time_utc < min_start:
+        await query.message.edit_text(
+            "😔 Это время уже недоступно для записи.\n"
+            "Пожалуйста, выберите другое время.",
+            reply_markup=retry_markup
+        )
+        return
+    
+    # Кнопка могла устареть: время заняли в календаре или другой записью
+    day = start_time_utc.astimezone(scheduler.primary_tz).date()
+    slots = await scheduler.available_slots(day, service['key'])
+    if not any(slot['start_utc'] == start_time_utc for slot in slots):
+        await query.message.edit_text(
+            "😔 К сожалению, это время уже занято.\n"
+            "Пожалуйста, выберите другое время.",
+            reply_markup=retry_markup
+        )
+        return
+    
+    old = db.reschedule_booking(booking['id'], user_id, change_deadline().isoformat(),
+                                start_time_utc.isoformat(), end_time_utc.isoformat())
+    if old is None:
+        if get_changeable_booking(user_id, booking_code) is None:
+            await booking_unchangeable(query)
+        else:
+            await query.message.edit_text(
+                "😔 К сожалению, это время уже занято.\n"
+                "Пожалуйста, выберите другое время.",
+                reply_markup=retry_markup
+            )
+        return
+    
+    scheduler.invalidate_availability()
+    new = dict(old, start_time_utc=start_time_utc.isoformat(), end_time_utc=end_time_utc.isoformat())
+    tz_name = get_user_tz(context, user_id)
+    
+    await query.message.edit_text(
+        "✅ Запись перенесена.\n\n" + describe_booking(new, tz_name) +
+        f"\n\n(было: {timefmt.format_datetime(booking_start(old), tz_name)})",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings')),
+            InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))
+        ]])
+    )
+    run_in_background(sync_booking_change(context.bot, old, new))
+
+
+async def sync_booking_change(bot, old: dict, new: Optional[dict]):
+    """
+    Календарь и лист ожидания после отмены (new=None) или переноса записи
+    Клиент к этому моменту уже получил ответ. Перенос - events.patch того
+    же события (id и ссылка сохраняются), отмена - удаление события.
+    Освободившееся старое время предлагается листу ожидания. Если
+    календарь не обновился, расхождение исправит сверка (reconcile_job).
+    """
+    event_id = old['google_event_id']
+    if event_id and GOOGLE_CALENDAR_ENABLED and calendar_client:
+        if new is None:
+            results = await asyncio.to_thread(
+                calendar_client.delete_events, config.GOOGLE_CALENDAR_ID, [event_id]
+            )
+            synced = all(results.values())
+        else:
+            synced = await asyncio.to_thread(
+                calendar_client.move_event, config.GOOGLE_CALENDAR_ID, event_id,
+                booking_start(new), datetime.fromisoformat(new['end_time_utc']).replace(tzinfo=pytz.utc)
+            ) is not None
+        if not synced:
+            logger.error(f"Календарь не обновлен после изменения записи {old['id']} (событие {event_id})")
+    
+    offers = await asyncio.to_thread(waitlist.offer_cancelled, db, [old])
+    await send_waitlist_offers(bot, offers)
+
+
+# === Лист ожидания ===
+
+async def waitlist_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор даты для подписки на освободившееся время"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    service = scheduler.get_service(context.user_data.get('service_type'))
+    
+    keyboard = [
+        [InlineKeyboardButton(
+            scheduler.format_date_local(day),
+            callback_data=callbacks.encode('waitlist_date', service['key'], callbacks.encode_date(day),
+                                           user_id=user_id)
+        )]
+        for day in scheduler.get_available_dates()[:10]
+    ]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=callbacks.encode('cancel'))])
+    
+    await query.message.edit_text(
+        f"🔔 Лист ожидания: {service['name']}\n\n"
+        "Выберите дату. Если на нее освободится время, бот сразу сообщит "
+        f"и закрепит его за вами на {config.WAITLIST_HOLD_MINUTES} минут.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return SELECTING_DATE
+
+
+async def waitlist_date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 service_type: str, date_code: str):
+    """Выбор диапазона времени для подписки"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    day = callbacks.decode_date(date_code)
+    
+    keyboard = [
+        [InlineKeyboardButton(name, callback_data=callbacks.encode(
+            'waitlist_join', service_type, date_code, code, user_id=user_id
+        ))]
+        for code, (name, _, _) in waitlist.RANGES.items()
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Другая дата", callback_data=callbacks.encode('waitlist'))])
+    
+    await query.message.edit_text(
+        f"🔔 {scheduler.format_date_local(day)}: в какое время вам удобно?\n"
+        f"({timefmt.tz_label(config.PRIMARY_TZ)})",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return SELECTING_DATE
+
+
+async def waitlist_join(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                        service_type: str, date_code: str, range_code: str):
+    """Подписаться на освободившееся время"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    day = callbacks.decode_date(date_code)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 Мои записи", callback_data=callbacks.encode('my_bookings')),
+         InlineKeyboardButton("🏠 Главное меню", callback_data=callbacks.encode('main_menu'))]
+    ])
+    
+    if len(get_waitlist_entries(user_id)) >= config.WAITLIST_MAX_ENTRIES_PER_USER:
+        await query.message.edit_text(
+            f"⚠️ У вас уже {config.WAITLIST_MAX_ENTRIES_PER_USER} подписок в листе ожидания.\n"
+            "Отмените одну из них в разделе «Мои записи».",
+            reply_markup=keyboard
+        )
+        return ConversationHandler.END
+    
+    name, from_time, to_time = waitlist.RANGES.get(range_code, waitlist.RANGES['a'])
+    db.add_waitlist_entry(user_id, day.isoformat(), from_time, to_time,
+                          scheduler.get_service(service_type)['key'])
+    
+    await query.message.edit_text(
+        f"✅ Вы в листе ожидания: {scheduler.format_date_local(day)}, {name.lower()}.\n\n"
+        "Если время освободится, бот сразу пришлет сообщение с кнопкой записи.",
+        reply_markup=keyboard
+    )
+    return ConversationHandler.END
+
+
+async def waitlist_leave(update: Update, context: ContextTypes.DEFAULT_TYPE, entry_code: str):
+    """Отписаться (кнопка в 'Мои записи')"""
+    db.delete_waitlist_entry(callbacks.from_base36(entry_code), update.effective_user.id)
+    await my_bookings_callback(update, context)
+
+
+async def waitlist_book(update: Update, context: ContextTypes.DEFAULT_TYPE, start_code: str):
+    """Записаться на время из предложения листа ожидания"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    start_time_utc = callbacks.decode_datetime(start_code)
+    hold = db.get_slot_hold(start_time_utc.isoformat(), user_id)
+    if hold is None:
+        await query.answer(
+            "⌛ Время больше не закреплено за вами. Посмотрите свободные слоты: /book",
+            show_alert=True
+        )
+        return
+    
+    if not check_max_bookings(user_id):
+        await query.answer(
+            f"⚠️ У вас уже максимальное количество активных записей ({config.MAX_ACTIVE_BOOKINGS_PER_USER}).",
+            show_alert=True
+        )
+        return
+    
+    # Дальше - как при выборе слота; бронь снимается вместе с созданием записи
+    await slot_selected(update, context, hold['service_type'], start_code)
+
+
+async def waitlist_skip(update: Update, context: ContextTypes.DEFAULT_TYPE, start_code: str):
+    """Отказаться от предложенного времени - оно сразу уходит следующему"""
+    query = update.callback_query
+    await query.answer()
+    
+    start_time_utc = callbacks.decode_datetime(start_code)
+    hold = db.release_slot_hold(start_time_utc.isoformat(), update.effective_user.id)
+    await query.message.edit_text("Хорошо, предложим это время следующему в очереди.")
+    
+    if hold:
+        await send_waitlist_offers(context.bot, await asyncio.to_thread(waitlist.offer_released, db, [hold]))
+
+
+async def send_waitlist_offers(bot, offers: list):
+    """Разослать предложения листа ожидания (брони изменились)"""
+    scheduler.invalidate_availability()
+    hold_changed.set()
+    if offers:
+        await waitlist.send_offers(db, bot, offers)
+
+
+# === Приоритеты обновлений ===
+
+# Подтверждение записи обрабатывается раньше остального и не отклоняется
+COMMIT_ACTIONS = frozenset({'slot', 'waitlist_book', 'booking_cancel_confirm', 'move_slot'})
+# Просмотр: при перегрузке отклоняется первым
+BROWSE_ACTIONS = frozenset({'slots', 'my_bookings', 'help', 'main_menu', 'choose_date', 'date', 'timezone',
+                            'waitlist', 'waitlist_date', 'booking_move', 'move_date'})
+BROWSE_COMMANDS = frozenset({'/slots', '/mybookings', '/help'})
+
+
+def update_priority(update: object) -> int:
+    """Приоритет обновления для OrderedUpdateProcessor"""
+    if not isinstance(update, Update):
+        return PRIORITY_DEFAULT
+    if update.callback_query:
+        action = callbacks.action_of(update.callback_query.data)
+        if action in COMMIT_ACTIONS:
+            return PRIORITY_COMMIT
+        if action in BROWSE_ACTIONS:
+            return PRIORITY_BROWSE
+        return PRIORITY_DEFAULT
+    
+    message = update.effective_message
+    words = message.text.split(maxsplit=1) if message and message.text else []
+    if words and words[0].split('@', 1)[0] in BROWSE_COMMANDS:
+        return PRIORITY_BROWSE
+    return PRIORITY_DEFAULT
+
+
+# === Фоновые задачи ===
+
+background_tasks = []
+health_server = None
+hold_changed = asyncio.Event()  # Брони листа ожидания изменились в этом процессе
+pending_tasks = set()  # Работа после ответа клиенту (календарь, лист ожидания)
+
+
+def run_in_background(coroutine):
+    """Выполнить после ответа клиенту; ошибка пишется в лог"""
+    async def guarded():
+        try:
+            await coroutine
+        except Exception as e:
+            logger.error(f"Ошибка фоновой операции: {e}")
+    
+    task = asyncio.create_task(guarded())
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+
+
+update_processor = OrderedUpdateProcessor(update_priority)
+
+
+async def run_periodic(interval_seconds: float, job, name: str):
+    """Выполнять job каждые interval_seconds секунд"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой задачи {name}: {e}")
+
+
+async def archive_job():
+    """Перенести старые записи в архив (в отдельном потоке)"""
+    result = await asyncio.to_thread(db.archive_old_bookings)
+    logger.info(
+        f"Архивация: перенесено {result['archived']}, "
+        f"rate limits удалено {result['rate_limits_deleted']}, "
+        f"освобождено страниц {result['pages_reclaimed']}"
+    )
+
+
+async def backup_job():
+    """Снять резервную копию БД (в отдельном потоке)"""
+    result = await asyncio.to_thread(backup.create_backup, db.db_path)
+    logger.info(
+        f"Резервная копия: {result['path']}, {result['size']} байт, "
+        f"{result['seconds']} с, удалено старых {result['removed']}"
+    )
+
+
+async def waitlist_hold_watcher(bot):
+    """
+    Передавать истекшие брони листа ожидания следующим подписчикам
+    Просыпается к истечению ближайшей брони (одно чтение MIN по индексу)
+    или когда брони изменились; брони, созданные manage.py в другом
+    процессе, замечаются не позже чем через WAITLIST_HOLD_CHECK_SECONDS.
+    """
+    while True:
+        delay = config.WAITLIST_HOLD_CHECK_SECONDS
+        try:
+            expires_at = await asyncio.to_thread(db.get_next_hold_expiry)
+            if expires_at:
+                remaining = (datetime.fromisoformat(expires_at) - datetime.now(pytz.utc)).total_seconds()
+                delay = min(delay, max(remaining, 0))
+        except Exception as e:
+            logger.error(f"Ошибка чтения броней листа ожидания: {e}")
+        
+        try:
+            await asyncio.wait_for(hold_changed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        hold_changed.clear()
+        
+        try:
+            expired = await asyncio.to_thread(db.pop_expired_slot_holds)
+            if expired:
+                offers = await asyncio.to_thread(waitlist.offer_released, db, expired)
+                logger.info(f"Лист ожидания: истекло броней {len(expired)}, новых предложений {len(offers)}")
+                await send_waitlist_offers(bot, offers)
+        except Exception as e:
+            logger.error(f"Ошибка передачи броней листа ожидания: {e}")
+
+
+async def reconcile_job():
+    """Сверить записи с календарем и исправить расхождения (в отдельном потоке)"""
+    result = await asyncio.to_thread(reconcile.reconcile, db, calendar_client)
+    logger.info(
+        f"Сверка с календарем: записей {result['bookings']}, событий {result['events']}, "
+        f"расхождений {len(result['issues'])}, исправлено {result['repaired']}, {result['seconds']} с"
+    )
+    if result['repaired']:
+        scheduler.invalidate_availability()
+    unresolved = [issue for issue in result['issues'] if not issue['repaired']]
+    if unresolved:
+        logger.warning(f"Сверка с календарем: не исправлено расхождений {len(unresolved)}\n"
+                       + '\n'.join(reconcile.format_issue(issue) for issue in unresolved))
+
+
+async def token_refresh_job():
+    """Заранее обновить токен Google, чтобы запросы клиентов его не ждали"""
+    if await asyncio.to_thread(calendar_client.refresh_if_needed):
+        logger.info("Токен Google Calendar обновлен")
+
+
+async def post_init(application: Application):
+    """Запуск фоновых задач после инициализации приложения"""
+    global health_server
+    background_tasks.append(asyncio.create_task(
+        run_periodic(config.ARCHIVE_INTERVAL_HOURS * 3600, archive_job, 'archive')
+    ))
+    if config.BACKUP_INTERVAL_HOURS:
+        background_tasks.append(asyncio.create_task(
+            run_periodic(config.BACKUP_INTERVAL_HOURS * 3600, backup_job, 'backup')
+        ))
+    if GOOGLE_CALENDAR_ENABLED and calendar_client:
+        background_tasks.append(asyncio.create_task(
+            run_periodic(config.GOOGLE_TOKEN_CHECK_INTERVAL_SECONDS, token_refresh_job, 'token_refresh')
+        ))
+        if config.RECONCILE_INTERVAL_HOURS:
+            background_tasks.append(asyncio.create_task(
+                run_periodic(config.RECONCILE_INTERVAL_HOURS * 3600, reconcile_job, 'reconcile')
+            ))
+    background_tasks.append(asyncio.create_task(waitlist_hold_watcher(application.bot)))
+    if config.HEALTH_PORT:
+        monitor = HealthMonitor(db, calendar_client, update_processor)
+        background_tasks.append(asyncio.create_task(monitor.run()))
+        health_server = await monitor.start_server()
+
+
+async def post_shutdown(application: Application):
+    """Остановка фоновых задач"""
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    # Дать завершиться начатым изменениям календаря
+    if pending_tasks:
+        await asyncio.wait(list(pending_tasks), timeout=config.GOOGLE_HTTP_TIMEOUT)
+    if health_server:
+        health_server.close()
+
+
 def main():
     """Запуск бота"""
     if not config.TELEGRAM_BOT_TOKEN:
@@ -686,39 +1533,71 @@ def main():
         return
     
     # Создать приложение
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(update_processor)
+        .build()
+    )
+    
+    # Таблица маршрутизации inline-кнопок
+    router = callbacks.CallbackRouter()
+    router.register('book_start', traced(book_start_callback))
+    router.register('service', traced(service_selected))
+    router.register('choose_date', traced(choose_date_callback))
+    router.register('date', traced(date_selected))
+    router.register('slot', traced(slot_selected))
+    router.register('cancel', traced(cancel_callback))
+    router.register('help', traced(help_callback))
+    router.register('my_bookings', traced(my_bookings_callback))
+    router.register('slots', traced(slots_callback))
+    router.register('main_menu', traced(main_menu_callback))
+    router.register('timezone', traced(timezone_command))
+    router.register('tz', traced(timezone_selected))
+    router.register('waitlist', traced(waitlist_callback))
+    router.register('waitlist_date', traced(waitlist_date_selected))
+    router.register('waitlist_join', traced(waitlist_join))
+    router.register('waitlist_leave', traced(waitlist_leave))
+    router.register('waitlist_book', traced(waitlist_book))
+    router.register('waitlist_skip', traced(waitlist_skip))
+    router.register('booking_cancel', traced(booking_cancel))
+    router.register('booking_cancel_confirm', traced(booking_cancel_confirm))
+    router.register('booking_move', traced(booking_move))
+    router.register('move_date', traced(move_date_selected))
+    router.register('move_slot', traced(move_slot_selected))
     
     # Conversation handler для процесса записи
     booking_conv_handler = ConversationHandler(
         entry_points=[
-            CommandHandler('book', book_command),
-            CallbackQueryHandler(book_start_callback, pattern='^book_start$')
+            CommandHandler('book', traced(book_command)),
+            router.handler('book_start')
         ],
         states={
-            SELECTING_DATE: [
-                CallbackQueryHandler(date_selected, pattern='^date_'),
-                CallbackQueryHandler(book_start_callback, pattern='^book_start$')
-            ],
-            SELECTING_SLOT: [
-                CallbackQueryHandler(slot_selected, pattern='^slot_'),
-                CallbackQueryHandler(book_start_callback, pattern='^book_start$')
-            ],
+            SELECTING_SERVICE: [router.handler('service', 'book_start')],
+            SELECTING_DATE: [router.handler('date', 'choose_date', 'book_start',
+                                            'waitlist', 'waitlist_date', 'waitlist_join')],
+            SELECTING_SLOT: [router.handler('slot', 'choose_date', 'book_start')],
         },
-        fallbacks=[
-            CallbackQueryHandler(cancel_callback, pattern='^cancel$')
-        ],
+        fallbacks=[router.handler('cancel')],
     )
     
     # Добавить обработчики
-    application.add_handler(CommandHandler('start', start_command))
-    application.add_handler(CommandHandler('help', help_command))
-    application.add_handler(CommandHandler('slots', slots_command))
-    application.add_handler(CommandHandler('mybookings', my_bookings_command))
+    application.add_handler(CommandHandler('start', traced(start_command)))
+    application.add_handler(CommandHandler('help', traced(help_command)))
+    application.add_handler(CommandHandler('slots', traced(slots_command)))
+    application.add_handler(CommandHandler('mybookings', traced(my_bookings_command)))
+    application.add_handler(CommandHandler('stats', traced(stats_command)))
+    application.add_handler(CommandHandler('timezone', traced(timezone_command)))
     application.add_handler(booking_conv_handler)
-    application.add_handler(CallbackQueryHandler(help_callback, pattern='^help$'))
-    application.add_handler(CallbackQueryHandler(my_bookings_callback, pattern='^my_bookings$'))
-    application.add_handler(CallbackQueryHandler(slots_callback, pattern='^slots$'))
-    application.add_handler(CallbackQueryHandler(main_menu_callback, pattern='^main_menu$'))
+    application.add_handler(router.handler('help', 'my_bookings', 'slots', 'main_menu', 'timezone', 'tz'))
+    application.add_handler(router.handler('waitlist', 'waitlist_date', 'waitlist_join',
+                                           'waitlist_leave', 'waitlist_book', 'waitlist_skip'))
+    application.add_handler(router.handler('booking_cancel', 'booking_cancel_confirm',
+                                           'booking_move', 'move_date', 'move_slot'))
+    # Кнопки из сообщений старого формата и вне диалога записи
+    application.add_handler(CallbackQueryHandler(traced(stale_callback)))
     
     # Запустить бота
     logger.info("Бот запущен...")
@@ -0,0 +1,211 @@
+"""
+Компактные callback_data для inline-кнопок и маршрутизация по таблице
+
+Формат: <версия><id действия><аргументы через ':'>[!<время выдачи>.<подпись>]
+Действия с аргументами подписываются HMAC (с привязкой к Telegram ID
+пользователя и ко времени выдачи кнопки), поэтому время слота или дату в
+кнопке нельзя подделать, а старые кнопки (старше CALLBACK_MAX_AGE_HOURS)
+не принимаются. Число аргументов каждого действия фиксировано.
+Время передается в минутах от эпохи, даты - в днях, оба в base36, так что
+callback_data укладывается в лимит Telegram в 64 байта с большим запасом.
+"""
+import base64
+import hashlib
+import hmac
+from datetime import datetime, date, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import pytz
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ContextTypes
+import config
+
+
+VERSION = '1'
+MAX_CALLBACK_DATA_BYTES = 64
+SIGNATURE_BYTES = 6
+
+# Действие -> (id, подписывать ли, число аргументов)
+ACTIONS = {
+    'book_start': ('a', False, 0),
+    'my_bookings': ('b', False, 0),
+    'slots': ('c', False, 0),
+    'help': ('d', False, 0),
+    'main_menu': ('e', False, 0),
+    'cancel': ('f', False, 0),
+    'choose_date': ('g', False, 0),
+    'timezone': ('h', False, 0),
+    'service': ('s', True, 1),
+    'date': ('t', True, 1),
+    'slot': ('u', True, 2),
+    'tz': ('z', True, 1),
+    'waitlist': ('i', False, 0),
+    'waitlist_date': ('j', True, 2),
+    'waitlist_join': ('k', True, 3),
+    'waitlist_leave': ('l', True, 1),
+    'waitlist_book': ('o', True, 1),
+    'waitlist_skip': ('p', True, 1),
+    'booking_cancel': ('m', True, 1),
+    'booking_cancel_confirm': ('n', True, 1),
+    'booking_move': ('q', True, 1),
+    'move_date': ('r', True, 2),
+    'move_slot': ('v', True, 2),
+}
+_ACTIONS_BY_ID = {action_id: name for name, (action_id, _, _) in ACTIONS.items()}
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+_EPOCH_DATE = date(1970, 1, 1)
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _secret() -> bytes:
+    """Ключ подписи: CALLBACK_SECRET или производный от токена бота"""
+    if config.CALLBACK_SECRET:
+        return config.CALLBACK_SECRET.encode()
+    return hashlib.sha256(b'callback:' + config.TELEGRAM_BOT_TOKEN.encode()).digest()
+
+
+def _sign(payload: str, user_id: int) -> str:
+    digest = hmac.new(_secret(), f"{user_id}:{payload}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_BYTES]).decode()
+
+
+# === Аргументы ===
+
+def to_base36(value: int) -> str:
+    if value < 0:
+        raise ValueError("Отрицательные значения не поддерживаются")
+    digits = ''
+    while True:
+        value, remainder = divmod(value, 36)
+        digits = _DIGITS[remainder] + digits
+        if not value:
+            return digits
+
+
+def from_base36(value: str) -> int:
+    return int(value, 36)
+
+
+def encode_datetime(dt: datetime) -> str:
+    """Время (с точностью до минуты) -> минуты от эпохи в base36"""
+    return to_base36(int((dt - _EPOCH).total_seconds() // 60))
+
+
+def decode_datetime(value: str) -> datetime:
+    return _EPOCH + timedelta(minutes=from_base36(value))
+
+
+def encode_date(day: date) -> str:
+    """Дата -> дни от эпохи в base36"""
+    return to_base36((day - _EPOCH_DATE).days)
+
+
+def decode_date(value: str) -> date:
+    return _EPOCH_DATE + timedelta(days=from_base36(value))
+
+
+# === Кодек ===
+
+def encode(action: str, *args: str, user_id: Optional[int] = None) -> str:
+    """
+    Собрать callback_data для действия
+    Для подписываемых действий нужен user_id того, кому показывается кнопка.
+    """
+    action_id, signed, arg_count = ACTIONS[action]
+    if len(args) != arg_count:
+        raise ValueError(f"Действию {action} нужно аргументов: {arg_count}")
+    for arg in args:
+        if not arg or ':' in arg or '!' in arg:
+            raise ValueError(f"Недопустимый аргумент callback: {arg!r}")
+    
+    payload = VERSION + action_id + ':'.join(args)
+    if signed:
+        if user_id is None:
+            raise ValueError(f"Для действия {action} нужен user_id")
+        payload += '!' + encode_datetime(datetime.now(pytz.utc))
+        payload += '.' + _sign(payload, user_id)
+    
+    if len(payload.encode()) > MAX_CALLBACK_DATA_BYTES:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA_BYTES} байт: {payload}")
+    return payload
+
+
+def action_of(data: object) -> Optional[str]:
+    """Действие по callback_data без проверки подписи (None - чужой формат)"""
+    if not isinstance(data, str) or len(data) < 2 or data[0] != VERSION:
+        return None
+    return _ACTIONS_BY_ID.get(data[1])
+
+
+def decode(data: str, user_id: int) -> Optional[Tuple[str, List[str]]]:
+    """
+    Разобрать callback_data: (действие, аргументы)
+    None - неизвестный формат, неверная подпись, устаревшая кнопка или
+    не то число аргументов.
+    """
+    action = action_of(data)
+    if action is None:
+        return None
+    
+    _, signed, arg_count = ACTIONS[action]
+    payload = data
+    if signed:
+        signed_part, _, signature = data.rpartition('.')
+        payload, _, issued = signed_part.rpartition('!')
+        if not payload or not hmac.compare_digest(signature.encode(),
+                                                   _sign(signed_part, user_id).encode()):
+            return None
+        try:
+            age = datetime.now(pytz.utc) - decode_datetime(issued)
+        except ValueError:
+            return None
+        if age > timedelta(hours=config.CALLBACK_MAX_AGE_HOURS):
+            return None
+    elif '!' in data:
+        return None
+    
+    body = payload[2:]
+    args = body.split(':') if body else []
+    if len(args) != arg_count:
+        return None
+    return action, args
+
+
+# === Маршрутизация ===
+
+Handler = Callable[..., Awaitable]
+
+
+class CallbackRouter:
+    """
+    Таблица действие -> обработчик
+    Обработчик вызывается как handler(update, context, *args) с уже
+    проверенными аргументами из callback_data.
+    """
+    
+    def __init__(self):
+        self.handlers: Dict[str, Handler] = {}
+    
+    def register(self, action: str, handler: Handler):
+        if action not in ACTIONS:
+            raise KeyError(f"Неизвестное действие: {action}")
+        self.handlers[action] = handler
+    
+    def handler(self, *actions: str) -> CallbackQueryHandler:
+        """CallbackQueryHandler для набора действий (проверка - поиск в множестве)"""
+        accepted = frozenset(actions)
+        return CallbackQueryHandler(
+            self.dispatch,
+            pattern=lambda data: action_of(data) in accepted
+        )
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        decoded = decode(query.data, update.effective_user.id)
+        
+        if decoded is None:
+            await query.answer("⚠️ Кнопка устарела или недействительна. Начните заново: /start", show_alert=True)
+            return None
+        
+        action, args = decoded
+        return await self.handlers[action](update, context, *args)
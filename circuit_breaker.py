@@ -0,0 +1,128 @@
+"""
+Автоматический выключатель (circuit breaker) для внешних сервисов
+
+Состояния:
+- closed: вызовы идут как обычно, подряд идущие ошибки считаются;
+- open: после failure_threshold ошибок подряд вызовы сразу отклоняются,
+  не дожидаясь таймаута сервиса;
+- half_open: по истечении паузы пропускается один пробный вызов - успех
+  закрывает выключатель, ошибка снова открывает его с удвоенной паузой.
+
+Пауза растет экспоненциально до max_reset_seconds и уменьшается на
+случайную долю (jitter), чтобы несколько процессов не пробовали сервис
+одновременно.
+"""
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен: выключатель открыт"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float,
+                 max_reset_seconds: float, jitter: float = 0.2):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.jitter = jitter
+        
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0  # Ошибок подряд
+        self._opened_times = 0  # Открытий подряд (для роста паузы)
+        self._retry_at = 0.0
+        self._probe_in_flight = False
+        
+        # Метрики
+        self._counters = {
+            'successes': 0,
+            'failures': 0,
+            'short_circuited': 0,
+            'opened': 0,
+        }
+        self._state_since = time.time()
+        self._last_failure_at: Optional[float] = None
+        self._last_error: Optional[str] = None
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+    
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() >= self._retry_at:
+            self._set_state(HALF_OPEN)
+        return self._state
+    
+    def _set_state(self, state: str):
+        if state != self._state:
+            self._state = state
+            self._state_since = time.time()
+    
+    def _pause(self) -> float:
+        pause = min(self.reset_seconds * 2 ** (self._opened_times - 1), self.max_reset_seconds)
+        return pause * (1 - random.uniform(0, self.jitter))
+    
+    def allow(self) -> bool:
+        """Можно ли выполнить вызов (в half_open - только один пробный)"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._counters['short_circuited'] += 1
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self._counters['successes'] += 1
+            self._failures = 0
+            self._opened_times = 0
+            self._probe_in_flight = False
+            self._set_state(CLOSED)
+    
+    def record_failure(self, error: Optional[BaseException] = None):
+        with self._lock:
+            self._counters['failures'] += 1
+            self._failures += 1
+            self._last_failure_at = time.time()
+            self._last_error = repr(error) if error is not None else None
+            
+            # Вызов, начатый до открытия, паузу не продлевает
+            if self._state == OPEN:
+                return
+            
+            probe_failed = self._state == HALF_OPEN
+            self._probe_in_flight = False
+            if probe_failed or self._failures >= self.failure_threshold:
+                self._opened_times += 1
+                self._counters['opened'] += 1
+                self._retry_at = time.monotonic() + self._pause()
+                self._set_state(OPEN)
+    
+    def get_metrics(self) -> Dict:
+        """Состояние и счетчики для мониторинга"""
+        with self._lock:
+            state = self._current_state()
+            return dict(
+                self._counters,
+                name=self.name,
+                state=state,
+                state_since=self._state_since,
+                consecutive_failures=self._failures,
+                retry_in_seconds=max(self._retry_at - time.monotonic(), 0) if state == OPEN else 0,
+                last_failure_at=self._last_failure_at,
+                last_error=self._last_error,
+            )
@@ -9,24 +9,159 @@ load_dotenv()
 # Telegram Bot
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+# Ключ подписи callback_data (по умолчанию выводится из токена бота)
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET', '')
+CALLBACK_MAX_AGE_HOURS = 24  # Кнопки с аргументами (слот, запись) старше - недействительны
 
 # Google Calendar
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID', '')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET', '')
 GOOGLE_CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID', 'primary')
 
+# Файл OAuth-токена Google (старое значение *.pickle заменяется на *.json,
+# сам pickle переносится в JSON при первом запуске)
+GOOGLE_TOKEN_PATH = os.getenv('GOOGLE_TOKEN_FILE', 'data/token.json')
+if GOOGLE_TOKEN_PATH.endswith('.pickle'):
+    GOOGLE_TOKEN_PATH = GOOGLE_TOKEN_PATH[:-len('.pickle')] + '.json'
+GOOGLE_TOKEN_REFRESH_MARGIN_MINUTES = 10  # Обновлять токен заранее, до истечения
+GOOGLE_TOKEN_CHECK_INTERVAL_SECONDS = 60  # Период проверки срока действия токена
+
+# Логирование
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json или text
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0.1'))  # Доля DEBUG-записей
+LOG_QUEUE_SIZE = 10000  # Записей в очереди; при переполнении новые отбрасываются
+
+# Параллельная обработка обновлений (порядок для каждого пользователя сохраняется)
+UPDATE_MAX_RUNNING = 16  # Одновременно работающих обработчиков
+UPDATE_SHED_QUEUE_SIZE = 32  # При стольких ожидающих просмотр слотов отклоняется
+UPDATE_MAX_IN_FLIGHT = 256  # Всего принятых обновлений, включая ожидающие
+
+# Health-эндпоинты (/health/live, /health/ready); HEALTH_PORT=0 - выключены
+HEALTH_HOST = os.getenv('HEALTH_HOST', '0.0.0.0')
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '0'))
+HEALTH_CHECK_INTERVAL_SECONDS = 5  # Период замеров (ответы берутся из последнего)
+HEALTH_MAX_LOOP_LAG_MS = 1000  # Большая задержка event loop - бот не жив
+HEALTH_DB_PROBE_INTERVAL_SECONDS = 60  # Период пробной записи в БД
+HEALTH_MAX_DB_WRITE_MS = 1000  # Более медленная запись в БД - бот не готов
+
 # Database
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'data/psybooking.db')
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '50'))  # Запросы дольше - в лог с планом
 
 # Timezone
 PRIMARY_TZ = 'Europe/Minsk'
 
+# Часовые пояса, которые клиент может выбрать для отображения времени
+CLIENT_TIMEZONES = {
+    'Europe/Minsk': {'name': 'Минск', 'genitive': 'Минска'},
+    'Europe/Moscow': {'name': 'Москва', 'genitive': 'Москвы'},
+    'Europe/Kyiv': {'name': 'Киев', 'genitive': 'Киева'},
+    'Europe/Warsaw': {'name': 'Варшава', 'genitive': 'Варшавы'},
+    'Europe/Vilnius': {'name': 'Вильнюс', 'genitive': 'Вильнюса'},
+    'Europe/Berlin': {'name': 'Берлин', 'genitive': 'Берлина'},
+    'Europe/London': {'name': 'Лондон', 'genitive': 'Лондона'},
+    'Asia/Tbilisi': {'name': 'Тбилиси', 'genitive': 'Тбилиси'},
+    'Asia/Almaty': {'name': 'Алматы', 'genitive': 'Алматы'},
+    'America/New_York': {'name': 'Нью-Йорк', 'genitive': 'Нью-Йорка'},
+}
+
 # Booking settings
 MIN_HOURS_BEFORE_BOOKING = 3
-SESSION_DURATION_MINUTES = 60
 MAX_ACTIVE_BOOKINGS_PER_USER = 3
 RATE_LIMIT_REQUESTS_PER_MINUTE = 10
 DAYS_AHEAD_TO_SHOW = 14
+CLIENT_CHANGE_MIN_HOURS = 24  # Клиент сам отменяет или переносит запись не позже чем за столько часов
+
+# Waitlist
+WAITLIST_HOLD_MINUTES = 15  # Освободившееся время закреплено за подписчиком
+WAITLIST_HOLD_CHECK_SECONDS = 60  # Не реже - проверка броней, созданных manage.py
+WAITLIST_MAX_ENTRIES_PER_USER = 5
+
+# Service types: длительность и перерыв после сессии в минутах.
+# Слоты услуги идут от начала рабочего дня с шагом duration + buffer.
+SERVICE_TYPES = {
+    'individual': {
+        'name': 'Индивидуальная консультация',
+        'duration': 50,
+        'buffer': 10,
+        'price': '',
+    },
+    'couple': {
+        'name': 'Парная консультация',
+        'duration': 90,
+        'buffer': 15,
+        'price': '',
+    },
+    'intro': {
+        'name': 'Вводная встреча',
+        'duration': 30,
+        'buffer': 0,
+        'price': '',
+    },
+}
+DEFAULT_SERVICE_TYPE = 'individual'
+
+# Availability grid
+AVAILABILITY_GRID_MINUTES = 5  # Размер ячейки сетки доступности
+FREEBUSY_MAX_DAYS = 90  # Максимальный период одного запроса freebusy (ограничение API)
+
+# Google API: пул соединений, таймауты (секунды) и маски полей ответов
+GOOGLE_HTTP_POOL_SIZE = 4  # Одновременных запросов к API
+GOOGLE_HTTP_TIMEOUT = 10  # Таймаут по умолчанию
+GOOGLE_HTTP_TIMEOUTS = {
+    'freebusy': 10,
+    'events.insert': 15,
+    'events.get': 10,
+    'events.patch': 15,
+    'events.list': 20,
+    'events.delete': 10,
+    'batch': 30,
+}
+GOOGLE_BATCH_SIZE = 50  # Запросов в одном batch-вызове (ограничение API - 50 для Calendar)
+GOOGLE_LIST_PAGE_SIZE = 2500  # Событий на страницу events.list (максимум API)
+
+# Локальная имитация Google Calendar API вместо настоящего (тесты, замеры)
+GOOGLE_CALENDAR_FAKE = os.getenv('GOOGLE_CALENDAR_FAKE', '').lower() in ('1', 'true', 'yes')
+GOOGLE_CALENDAR_FAKE_LATENCY_MS = float(os.getenv('GOOGLE_CALENDAR_FAKE_LATENCY_MS', '0'))
+GOOGLE_CALENDAR_FAKE_ERROR_RATE = float(os.getenv('GOOGLE_CALENDAR_FAKE_ERROR_RATE', '0'))
+
+# Google Calendar: автоматический выключатель и работа при недоступности API
+CALENDAR_BREAKER_FAILURE_THRESHOLD = 3  # Ошибок подряд до открытия
+CALENDAR_BREAKER_RESET_SECONDS = 30  # Первая пауза до пробного запроса
+CALENDAR_BREAKER_MAX_RESET_SECONDS = 600  # Максимальная пауза
+CALENDAR_BREAKER_JITTER = 0.2  # Случайное уменьшение паузы (доля)
+CALENDAR_STALE_MAX_AGE_MINUTES = 180  # Сохраненная занятость старше - не используется
+CALENDAR_BUSY_CACHE_SIZE = 32  # Ответов freebusy на календарь
+GOOGLE_HTTP_USER_AGENT = 'psybooking-bot'
+GOOGLE_API_FIELDS = {
+    'freebusy': 'calendars',
+    'events.insert': 'id,htmlLink',
+    'events.patch': 'id,htmlLink',
+    'events.list': 'nextPageToken,items(id,status,start,end,updated,htmlLink,extendedProperties/private/booking_id)',
+    'events.get': 'id,status,summary,description,start,end,htmlLink,updated',
+}
+
+# Сверка записей с Google Calendar
+RECONCILE_INTERVAL_HOURS = float(os.getenv('RECONCILE_INTERVAL_HOURS', '6'))  # Из бота; 0 - выключена
+RECONCILE_DAYS_AHEAD = 60  # Горизонт сверки от текущего момента
+RECONCILE_PENDING_GRACE_MINUTES = 10  # Более свежие pending-записи еще создаются ботом
+
+# Archive
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_INTERVAL_HOURS = 24
+
+# Backup
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'data/backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '14'))  # Сколько последних снимков хранить
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '0'))  # Снимки из бота; 0 - выключены
+BACKUP_PAGES_PER_STEP = 256  # Страниц за один шаг онлайн-копии
+BACKUP_STEP_SLEEP_SECONDS = 0.01  # Пауза между шагами (запись в БД не ждет всю копию)
+
+# Statistics
+STATS_DEFAULT_DAYS = 30
+STATS_ROLLUP_MIN_DAYS = 180  # Для периодов длиннее - кэш почасовых агрегатов
 
 # Admin
 ADMIN_TELEGRAM_IDS = [int(x) for x in os.getenv('ADMIN_TELEGRAM_IDS', '').split(',') if x]
@@ -1,11 +1,426 @@
 """
 Модуль для работы с базой данных SQLite
 """
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Tuple, Iterable, Iterator
 import config
 import os
+from db_trace import TracingConnection, explain, format_plan
+
+
+# Частые запросы (проверяются командой manage.py db indexes)
+SQL_ACTIVE_BOOKINGS_FOR_USER = '''
+    SELECT * FROM bookings
+    WHERE client_telegram_id = ?
+    AND status IN ('pending', 'confirmed')
+    AND start_time_utc >= datetime('now')
+    ORDER BY start_time_utc
+'''
+
+SQL_BOOKINGS_OVERLAPPING = '''
+    SELECT * FROM bookings
+    WHERE status IN ('pending', 'confirmed')
+    AND start_time_utc < ?
+    AND end_time_utc > ?
+    ORDER BY start_time_utc
+'''
+
+SQL_BOOKINGS_STARTING_IN = '''
+    SELECT * FROM bookings
+    WHERE status IN ('pending', 'confirmed')
+    AND start_time_utc >= ?
+    AND start_time_utc < ?
+    ORDER BY start_time_utc
+'''
+
+SQL_FUTURE_BOOKINGS = '''
+    SELECT * FROM bookings
+    WHERE start_time_utc >= datetime('now')
+    AND status IN ('pending', 'confirmed')
+    ORDER BY start_time_utc
+'''
+
+SQL_RATE_LIMIT_CLEANUP = '''
+    DELETE FROM rate_limits
+    WHERE request_time < datetime('now', '-' || ? || ' minutes')
+'''
+
+SQL_RATE_LIMIT_COUNT = '''
+    SELECT COUNT(*) as count FROM rate_limits
+    WHERE user_id = ?
+    AND request_time >= datetime('now', '-' || ? || ' minutes')
+'''
+
+# Подписчики листа ожидания, чей диапазон включает освободившееся время
+# и кому это время еще не предлагалось (в порядке подписки)
+SQL_WAITLIST_MATCHES = '''
+    SELECT * FROM waitlist
+    WHERE date = ?
+    AND from_time <= ?
+    AND to_time > ?
+    AND id NOT IN (SELECT waitlist_id FROM waitlist_offers WHERE start_time_utc = ?)
+    ORDER BY id
+'''
+
+SQL_SLOT_HOLDS_OVERLAPPING = '''
+    SELECT * FROM slot_holds
+    WHERE start_time_utc < ?
+    AND end_time_utc > ?
+    AND expires_at > ?
+'''
+
+# Запрос, пример параметров, индекс, который он должен использовать
+HOT_QUERIES = {
+    'active_bookings_for_user': (SQL_ACTIVE_BOOKINGS_FOR_USER, (1,), 'idx_bookings_client_time'),
+    'bookings_overlapping': (SQL_BOOKINGS_OVERLAPPING,
+                             ('2030-01-02T00:00:00+00:00', '2030-01-01T00:00:00+00:00'),
+                             'idx_bookings_status_end'),
+    'bookings_starting_in': (SQL_BOOKINGS_STARTING_IN,
+                             ('2030-01-01T00:00:00+00:00', '2030-01-02T00:00:00+00:00'),
+                             'idx_bookings_status_time'),
+    'future_bookings': (SQL_FUTURE_BOOKINGS, (), 'idx_bookings_status_time'),
+    'rate_limit_cleanup': (SQL_RATE_LIMIT_CLEANUP, (1,), 'idx_rate_limits_time'),
+    'rate_limit_count': (SQL_RATE_LIMIT_COUNT, (1, 1), 'sqlite_autoindex_rate_limits_1'),
+    'waitlist_matches': (SQL_WAITLIST_MATCHES,
+                         ('2030-01-01', '10:00', '10:00', '2030-01-01T07:00:00+00:00'),
+                         'idx_waitlist_date_range'),
+}
+
+
+def _service_buffer(service_type: Optional[str]) -> int:
+    """Перерыв после сессии услуги в минутах (у записей без услуги - 0, как в расписании)"""
+    return config.SERVICE_TYPES.get(service_type, {}).get('buffer', 0)
+
+
+def _busy_interval(start_time_utc: str, end_time_utc: str,
+                   service_type: Optional[str]) -> Tuple[datetime, datetime]:
+    """Время, которое занимает запись: [start, end + перерыв услуги)"""
+    return (datetime.fromisoformat(start_time_utc),
+            datetime.fromisoformat(end_time_utc) + timedelta(minutes=_service_buffer(service_type)))
+
+
+# === Схема ===
+
+BOOKINGS_COLUMNS = (
+    'id, client_telegram_id, client_username, client_first_name, '
+    'client_last_name, start_time_utc, end_time_utc, status, '
+    'google_event_id, event_link, created_at, updated_at, service_type'
+)
+
+
+def _create_all_bookings_view(cursor: sqlite3.Cursor):
+    """Все записи: рабочая таблица + архив (пересоздается при смене колонок)"""
+    cursor.execute('DROP VIEW IF EXISTS all_bookings')
+    cursor.execute(f'''
+        CREATE VIEW all_bookings AS
+        SELECT {BOOKINGS_COLUMNS} FROM bookings
+        UNION ALL
+        SELECT {BOOKINGS_COLUMNS} FROM bookings_history
+    ''')
+
+
+def _create_bookings_indexes(cursor: sqlite3.Cursor):
+    """Индексы bookings (создаются заново и после пересоздания таблицы)"""
+    # Активные записи по времени начала (будущие, отмена диапазона)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_status_time
+        ON bookings(status, start_time_utc)
+    ''')
+    
+    # Активные записи, пересекающие период (end_time_utc > начала периода)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_status_end
+        ON bookings(status, end_time_utc)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_client_time
+        ON bookings(client_telegram_id, start_time_utc)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_time 
+        ON bookings(start_time_utc)
+    ''')
+
+
+def _migration_1_initial(cursor: sqlite3.Cursor):
+    """
+    Исходная схема
+    Все операции идемпотентны: БД, созданные до появления user_version
+    (версия 0), приводятся к этой схеме без потери данных.
+    """
+    # Таблица настроек
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица рабочих часов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS working_hours (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day_of_week INTEGER NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            is_active INTEGER DEFAULT 1,
+            UNIQUE(day_of_week)
+        )
+    ''')
+    
+    # Таблица записей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_telegram_id INTEGER NOT NULL,
+            client_username TEXT,
+            client_first_name TEXT,
+            client_last_name TEXT,
+            start_time_utc TEXT NOT NULL,
+            end_time_utc TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            google_event_id TEXT,
+            event_link TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            service_type TEXT,
+            UNIQUE(start_time_utc)
+        )
+    ''')
+    
+    # Архив старых записей (та же структура + время архивации)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bookings_history (
+            id INTEGER PRIMARY KEY,
+            client_telegram_id INTEGER NOT NULL,
+            client_username TEXT,
+            client_first_name TEXT,
+            client_last_name TEXT,
+            start_time_utc TEXT NOT NULL,
+            end_time_utc TEXT NOT NULL,
+            status TEXT,
+            google_event_id TEXT,
+            event_link TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            service_type TEXT
+        )
+    ''')
+    
+    # Колонки, добавленные после создания таблиц
+    for table in ('bookings', 'bookings_history'):
+        cursor.execute(f'PRAGMA table_info({table})')
+        columns = {row['name'] for row in cursor.fetchall()}
+        if 'service_type' not in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN service_type TEXT')
+    
+    # Персональные настройки клиентов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            telegram_id INTEGER PRIMARY KEY,
+            timezone TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Исключения расписания: закрытые периоды и особые часы на даты
+    # (даты локальные, end_date включительно)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_exceptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('closed', 'hours')),
+            start_time TEXT,
+            end_time TEXT,
+            note TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица для rate limiting
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            user_id INTEGER NOT NULL,
+            request_time TEXT NOT NULL,
+            PRIMARY KEY (user_id, request_time)
+        )
+    ''')
+    
+    # Почасовые агрегаты по записям (кэш для статистики за длинные периоды)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS booking_hourly_stats (
+            day TEXT NOT NULL,
+            weekday INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            bookings INTEGER NOT NULL,
+            cancelled INTEGER NOT NULL,
+            booked_minutes REAL NOT NULL,
+            lead_hours_sum REAL NOT NULL,
+            lead_count INTEGER NOT NULL,
+            PRIMARY KEY (day, hour)
+        )
+    ''')
+    
+    _create_all_bookings_view(cursor)
+    
+    # Индексы
+    # Одиночные индексы по status и client_telegram_id заменены составными:
+    # по status выбирались все прошедшие confirmed-записи
+    cursor.execute('DROP INDEX IF EXISTS idx_bookings_status')
+    cursor.execute('DROP INDEX IF EXISTS idx_bookings_client')
+    
+    _create_bookings_indexes(cursor)
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_history_time 
+        ON bookings_history(start_time_utc)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_schedule_exceptions_end
+        ON schedule_exceptions(end_date)
+    ''')
+    
+    # Очистка старых записей rate limit при каждой проверке
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_rate_limits_time
+        ON rate_limits(request_time)
+    ''')
+    
+    # Инициализация настроек по умолчанию
+    cursor.execute('''
+        INSERT OR IGNORE INTO settings (key, value) 
+        VALUES ('primary_tz', ?)
+    ''', (config.PRIMARY_TZ,))
+    
+    cursor.execute('''
+        INSERT OR IGNORE INTO settings (key, value) 
+        VALUES ('min_hours_before_booking', ?)
+    ''', (str(config.MIN_HOURS_BEFORE_BOOKING),))
+    
+    # Рабочие часы по умолчанию (Пн-Пт 10:00-19:00)
+    default_hours = [
+        (1, '10:00', '19:00', 1),  # Понедельник
+        (2, '10:00', '19:00', 1),  # Вторник
+        (3, '10:00', '19:00', 1),  # Среда
+        (4, '10:00', '19:00', 1),  # Четверг
+        (5, '10:00', '19:00', 1),  # Пятница
+        (6, '10:00', '14:00', 0),  # Суббота (неактивна)
+        (0, '10:00', '14:00', 0),  # Воскресенье (неактивно)
+    ]
+    
+    for day, start, end, active in default_hours:
+        cursor.execute('''
+            INSERT OR IGNORE INTO working_hours 
+            (day_of_week, start_time, end_time, is_active)
+            VALUES (?, ?, ?, ?)
+        ''', (day, start, end, active))
+
+
+def _migration_2_waitlist(cursor: sqlite3.Cursor):
+    """
+    Лист ожидания; время отмененной записи снова можно занять
+    UNIQUE(start_time_utc) распространялся и на отмененные записи. Это
+    ограничение таблицы, поэтому bookings пересоздается с теми же id и
+    счетчиком AUTOINCREMENT (id архива не должны повторяться), а
+    уникальность остается только у активных записей.
+    """
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'bookings'")
+    row = cursor.fetchone()
+    sequence = row['seq'] if row else 0
+    
+    cursor.execute('DROP VIEW IF EXISTS all_bookings')
+    cursor.execute('''
+        CREATE TABLE bookings_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_telegram_id INTEGER NOT NULL,
+            client_username TEXT,
+            client_first_name TEXT,
+            client_last_name TEXT,
+            start_time_utc TEXT NOT NULL,
+            end_time_utc TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            google_event_id TEXT,
+            event_link TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            service_type TEXT
+        )
+    ''')
+    cursor.execute(f'INSERT INTO bookings_new ({BOOKINGS_COLUMNS}) SELECT {BOOKINGS_COLUMNS} FROM bookings')
+    cursor.execute('DROP TABLE bookings')
+    cursor.execute('ALTER TABLE bookings_new RENAME TO bookings')
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'bookings'")
+    cursor.execute('''
+        INSERT INTO sqlite_sequence (name, seq)
+        VALUES ('bookings', MAX(?, (SELECT IFNULL(MAX(id), 0) FROM bookings)))
+    ''', (sequence,))
+    
+    _create_bookings_indexes(cursor)
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_active_start
+        ON bookings(start_time_utc) WHERE status IN ('pending', 'confirmed')
+    ''')
+    _create_all_bookings_view(cursor)
+    
+    # Подписки на освободившееся время: локальная дата и диапазон
+    # времени начала [from_time, to_time) в PRIMARY_TZ
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            from_time TEXT NOT NULL,
+            to_time TEXT NOT NULL,
+            service_type TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(telegram_id, date, from_time, to_time)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_waitlist_date_range
+        ON waitlist(date, from_time, to_time)
+    ''')
+    
+    # Кому какое освободившееся время уже предлагалось
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist_offers (
+            start_time_utc TEXT NOT NULL,
+            waitlist_id INTEGER NOT NULL,
+            PRIMARY KEY (start_time_utc, waitlist_id)
+        )
+    ''')
+    
+    # Время, придержанное для подписчика: другим клиентам недоступно до expires_at
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS slot_holds (
+            start_time_utc TEXT PRIMARY KEY,
+            end_time_utc TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            waitlist_id INTEGER NOT NULL,
+            service_type TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_slot_holds_expires
+        ON slot_holds(expires_at)
+    ''')
+
+
+# (версия, миграция) по возрастанию версии; новая миграция - в конец списка
+MIGRATIONS = [
+    (1, _migration_1_initial),
+    (2, _migration_2_waitlist),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 
 class Database:
@@ -22,111 +437,63 @@ class Database:
     
     def _get_connection(self) -> sqlite3.Connection:
         """Получить соединение с БД"""
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, factory=TracingConnection)
         conn.row_factory = sqlite3.Row
         return conn
     
     def _init_db(self):
-        """Инициализация базы данных"""
+        """
+        Создать или обновить схему БД
+        Версия схемы хранится в PRAGMA user_version: для готовой БД это
+        одно чтение без транзакции записи. Миграции выполняются в одной
+        транзакции BEGIN IMMEDIATE, версия перечитывается под блокировкой -
+        одновременный запуск бота и manage.py не применит миграцию дважды.
+        """
         conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица настроек
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица рабочих часов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS working_hours (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                day_of_week INTEGER NOT NULL,
-                start_time TEXT NOT NULL,
-                end_time TEXT NOT NULL,
-                is_active INTEGER DEFAULT 1,
-                UNIQUE(day_of_week)
-            )
-        ''')
-        
-        # Таблица записей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_telegram_id INTEGER NOT NULL,
-                client_username TEXT,
-                client_first_name TEXT,
-                client_last_name TEXT,
-                start_time_utc TEXT NOT NULL,
-                end_time_utc TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                google_event_id TEXT,
-                event_link TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(start_time_utc)
-            )
-        ''')
-        
-        # Таблица для rate limiting
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS rate_limits (
-                user_id INTEGER NOT NULL,
-                request_time TEXT NOT NULL,
-                PRIMARY KEY (user_id, request_time)
-            )
-        ''')
-        
-        # Индексы
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_bookings_status 
-            ON bookings(status)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_bookings_client 
-            ON bookings(client_telegram_id)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_bookings_time 
-            ON bookings(start_time_utc)
-        ''')
-        
-        # Инициализация настроек по умолчанию
-        cursor.execute('''
-            INSERT OR IGNORE INTO settings (key, value) 
-            VALUES ('primary_tz', ?)
-        ''', (config.PRIMARY_TZ,))
-        
-        cursor.execute('''
-            INSERT OR IGNORE INTO settings (key, value) 
-            VALUES ('min_hours_before_booking', ?)
-        ''', (str(config.MIN_HOURS_BEFORE_BOOKING),))
-        
-        # Рабочие часы по умолчанию (Пн-Пт 10:00-19:00)
-        default_hours = [
-            (1, '10:00', '19:00', 1),  # Понедельник
-            (2, '10:00', '19:00', 1),  # Вторник
-            (3, '10:00', '19:00', 1),  # Среда
-            (4, '10:00', '19:00', 1),  # Четверг
-            (5, '10:00', '19:00', 1),  # Пятница
-            (6, '10:00', '14:00', 0),  # Суббота (неактивна)
-            (0, '10:00', '14:00', 0),  # Воскресенье (неактивно)
-        ]
-        
-        for day, start, end, active in default_hours:
-            cursor.execute('''
-                INSERT OR IGNORE INTO working_hours 
-                (day_of_week, start_time, end_time, is_active)
-                VALUES (?, ?, ?, ?)
-            ''', (day, start, end, active))
-        
-        conn.commit()
-        conn.close()
+        try:
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+                return
+            
+            # Для новой БД: освобождать страницы через incremental_vacuum
+            # (вне транзакции; для существующей БД переключается в archive_old_bookings)
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for target, migration in MIGRATIONS:
+                if target > version:
+                    migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+        finally:
+            conn.close()
+    
+    # === Диагностика ===
+    
+    def explain_query(self, sql: str, params=()) -> str:
+        """План выполнения запроса (EXPLAIN QUERY PLAN) в виде дерева"""
+        conn = self._get_connection()
+        try:
+            return format_plan(explain(conn, sql, params))
+        finally:
+            conn.close()
+    
+    def check_hot_queries(self) -> List[Dict]:
+        """
+        Проверить, что частые запросы (HOT_QUERIES) используют свои индексы
+        Возвращает name, expected_index, ok, plan для каждого запроса.
+        """
+        results = []
+        for name, (sql, params, index) in HOT_QUERIES.items():
+            plan = self.explain_query(sql, params)
+            results.append({
+                'name': name,
+                'expected_index': index,
+                'ok': re.search(rf'INDEX {index}\b', plan) is not None,
+                'plan': plan,
+            })
+        return results
     
     # === Settings ===
     
@@ -150,6 +517,30 @@ class Database:
         conn.commit()
         conn.close()
     
+    # === User Settings ===
+    
+    def get_user_timezone(self, telegram_id: int) -> Optional[str]:
+        """Часовой пояс клиента (None - не выбран)"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT timezone FROM user_settings WHERE telegram_id = ?', (telegram_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row['timezone'] if row else None
+    
+    def set_user_timezone(self, telegram_id: int, timezone_name: str):
+        """Сохранить часовой пояс клиента"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO user_settings (telegram_id, timezone, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(telegram_id) DO UPDATE
+            SET timezone = excluded.timezone, updated_at = CURRENT_TIMESTAMP
+        ''', (telegram_id, timezone_name))
+        conn.commit()
+        conn.close()
+    
     # === Working Hours ===
     
     def get_working_hours(self) -> List[Dict]:
@@ -191,37 +582,152 @@ class Database:
         conn.commit()
         conn.close()
     
+    # === Schedule Exceptions ===
+    
+    SCHEDULE_VERSION_KEY = 'schedule_exceptions_version'
+    
+    def _bump_schedule_version(self, cursor: sqlite3.Cursor):
+        """Увеличить версию исключений (по ней процессы обновляют свой индекс)"""
+        cursor.execute('''
+            INSERT INTO settings (key, value, updated_at)
+            VALUES (?, '1', CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET
+                value = CAST(value AS INTEGER) + 1,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (self.SCHEDULE_VERSION_KEY,))
+    
+    def get_schedule_version(self) -> int:
+        """Версия исключений расписания (0 - исключения не менялись)"""
+        return int(self.get_setting(self.SCHEDULE_VERSION_KEY) or 0)
+    
+    def add_schedule_exception(self, start_date: str, end_date: str, kind: str,
+                               start_time: Optional[str] = None, end_time: Optional[str] = None,
+                               note: Optional[str] = None) -> int:
+        """
+        Добавить исключение расписания на даты [start_date, end_date]
+        kind: 'closed' - не работать, 'hours' - работать start_time-end_time
+        вместо обычных часов. Возвращает ID исключения.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO schedule_exceptions (start_date, end_date, kind, start_time, end_time, note)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (start_date, end_date, kind, start_time, end_time, note))
+        exception_id = cursor.lastrowid
+        self._bump_schedule_version(cursor)
+        conn.commit()
+        conn.close()
+        return exception_id
+    
+    def delete_schedule_exception(self, exception_id: int) -> bool:
+        """Удалить исключение расписания"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM schedule_exceptions WHERE id = ?', (exception_id,))
+        affected = cursor.rowcount
+        if affected:
+            self._bump_schedule_version(cursor)
+        conn.commit()
+        conn.close()
+        return affected > 0
+    
+    def get_schedule_exceptions(self, from_date: Optional[str] = None) -> List[Dict]:
+        """Исключения расписания, действующие с from_date и позже (по умолчанию все)"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM schedule_exceptions
+            WHERE end_date >= ?
+            ORDER BY start_date, id
+        ''', (from_date or '',))
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+    
     # === Bookings ===
     
     def create_booking(self, client_telegram_id: int, client_username: Optional[str],
                       client_first_name: Optional[str], client_last_name: Optional[str],
-                      start_time_utc: str, end_time_utc: str) -> Optional[int]:
+                      start_time_utc: str, end_time_utc: str,
+                      service_type: Optional[str] = None) -> Optional[int]:
         """
         Создать новую запись
-        Возвращает ID записи или None при ошибке (например, слот занят)
+        Возвращает ID записи или None при ошибке (например, время занято
+        другой записью с учетом перерывов или бронью листа ожидания)
         """
         conn = self._get_connection()
         cursor = conn.cursor()
         
         try:
+            cursor.execute('BEGIN IMMEDIATE')
+            if self._overlaps_booking(cursor, start_time_utc, end_time_utc, service_type):
+                conn.close()
+                return None
+            if not self._claim_held_time(cursor, client_telegram_id, start_time_utc, end_time_utc):
+                conn.close()
+                return None
+            
             cursor.execute('''
                 INSERT INTO bookings 
                 (client_telegram_id, client_username, client_first_name, 
-                 client_last_name, start_time_utc, end_time_utc, status)
-                VALUES (?, ?, ?, ?, ?, ?, 'pending')
+                 client_last_name, start_time_utc, end_time_utc, status, service_type)
+                VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)
             ''', (client_telegram_id, client_username, client_first_name,
-                  client_last_name, start_time_utc, end_time_utc))
-            
+                  client_last_name, start_time_utc, end_time_utc, service_type))
             booking_id = cursor.lastrowid
             conn.commit()
             conn.close()
             return booking_id
-            
+        
         except sqlite3.IntegrityError as e:
-            # Слот уже занят (UNIQUE constraint)
+            # Слот уже занят (уникальное время начала активной записи)
             conn.close()
             return None
     
+    @staticmethod
+    def _overlaps_booking(cursor: sqlite3.Cursor, start_time_utc: str, end_time_utc: str,
+                          service_type: Optional[str], exclude_id: Optional[int] = None) -> bool:
+        """
+        Пересекается ли время с активной записью (внутри транзакции)
+        Как и в расписании, новая запись занимает [start, end + перерыв своей
+        услуги), каждая существующая - свое время вместе со своим перерывом.
+        Уникальный индекс ловит только совпадение начала, а услуги разной
+        длительности пересекаются и при разных началах.
+        exclude_id - переносимая запись (ее старое время освобождается).
+        """
+        start, end = _busy_interval(start_time_utc, end_time_utc, service_type)
+        max_buffer = max(service['buffer'] for service in config.SERVICE_TYPES.values())
+        
+        cursor.execute(SQL_BOOKINGS_OVERLAPPING,
+                       (end.isoformat(), (start - timedelta(minutes=max_buffer)).isoformat()))
+        for booking in cursor.fetchall():
+            if booking['id'] == exclude_id:
+                continue
+            _, booking_end = _busy_interval(booking['start_time_utc'], booking['end_time_utc'],
+                                            booking['service_type'])
+            if booking_end > start:
+                return True
+        return False
+    
+    def _claim_held_time(self, cursor: sqlite3.Cursor, client_telegram_id: int,
+                         start_time_utc: str, end_time_utc: str) -> bool:
+        """
+        Проверить брони листа ожидания на время записи (внутри транзакции)
+        Время, придержанное за другим клиентом, занято - False. Бронь самого
+        клиента выполнена: снимается вместе с его подпиской.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        cursor.execute(SQL_SLOT_HOLDS_OVERLAPPING, (end_time_utc, start_time_utc, now))
+        holds = cursor.fetchall()
+        if any(hold['telegram_id'] != client_telegram_id for hold in holds):
+            return False
+        
+        for hold in holds:
+            cursor.execute('DELETE FROM slot_holds WHERE start_time_utc = ?', (hold['start_time_utc'],))
+            self._delete_waitlist_entries(cursor, [hold['waitlist_id']])
+        return True
+    
     def update_booking_with_google_event(self, booking_id: int, 
                                         google_event_id: str, event_link: str):
         """Обновить запись данными из Google Calendar"""
@@ -236,6 +742,25 @@ class Database:
         conn.commit()
         conn.close()
     
+    def update_bookings_with_google_events(self, updates: List[Tuple[int, str, str]]) -> int:
+        """
+        update_booking_with_google_event для многих записей одной транзакцией
+        updates - (booking_id, google_event_id, event_link). Отмененные за
+        это время записи не подтверждаются. Возвращает число обновленных.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            UPDATE bookings 
+            SET google_event_id = ?, event_link = ?, 
+                status = 'confirmed', updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status IN ('pending', 'confirmed')
+        ''', [(event_id, link, booking_id) for booking_id, event_id, link in updates])
+        affected = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return affected
+    
     def get_booking(self, booking_id: int) -> Optional[Dict]:
         """Получить запись по ID"""
         conn = self._get_connection()
@@ -249,13 +774,7 @@ class Database:
         """Получить активные записи пользователя"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM bookings 
-            WHERE client_telegram_id = ? 
-            AND status IN ('pending', 'confirmed')
-            AND start_time_utc >= datetime('now')
-            ORDER BY start_time_utc
-        ''', (client_telegram_id,))
+        cursor.execute(SQL_ACTIVE_BOOKINGS_FOR_USER, (client_telegram_id,))
         rows = cursor.fetchall()
         conn.close()
         return [dict(row) for row in rows]
@@ -264,13 +783,7 @@ class Database:
         """Получить все активные записи в диапазоне дат"""
         conn = self._get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM bookings 
-            WHERE status IN ('pending', 'confirmed')
-            AND start_time_utc < ?
-            AND end_time_utc > ?
-            ORDER BY start_time_utc
-        ''', (end_utc, start_utc))
+        cursor.execute(SQL_BOOKINGS_OVERLAPPING, (end_utc, start_utc))
         rows = cursor.fetchall()
         conn.close()
         return [dict(row) for row in rows]
@@ -285,24 +798,610 @@ class Database:
             WHERE id = ?
         ''', (booking_id,))
         affected = cursor.rowcount
+        if affected:
+            cursor.execute('SELECT start_time_utc FROM bookings WHERE id = ?', (booking_id,))
+            self._invalidate_stats_rollups(cursor, [cursor.fetchone()['start_time_utc']])
         conn.commit()
         conn.close()
         return affected > 0
     
+    def cancel_bookings_in_range(self, start_utc: str, end_utc: str) -> List[Dict]:
+        """
+        Отменить все активные записи, начинающиеся в [start_utc, end_utc)
+        Выборка и отмена выполняются в одной транзакции.
+        Возвращает отмененные записи.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(SQL_BOOKINGS_STARTING_IN, (start_utc, end_utc))
+        bookings = [dict(row) for row in cursor.fetchall()]
+        
+        if bookings:
+            ids = [booking['id'] for booking in bookings]
+            placeholders = ','.join('?' * len(ids))
+            cursor.execute(f'''
+                UPDATE bookings
+                SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                WHERE id IN ({placeholders})
+            ''', ids)
+            self._invalidate_stats_rollups(cursor, [booking['start_time_utc'] for booking in bookings])
+        
+        conn.commit()
+        conn.close()
+        
+        for booking in bookings:
+            booking['status'] = 'cancelled'
+        return bookings
+    
+    def _get_changeable_booking(self, cursor: sqlite3.Cursor, booking_id: int,
+                                client_telegram_id: int, not_before_utc: str) -> Optional[Dict]:
+        """Активная запись клиента, начинающаяся не раньше not_before_utc"""
+        cursor.execute('''
+            SELECT * FROM bookings
+            WHERE id = ? AND client_telegram_id = ?
+            AND status IN ('pending', 'confirmed')
+            AND start_time_utc >= ?
+        ''', (booking_id, client_telegram_id, not_before_utc))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def cancel_client_booking(self, booking_id: int, client_telegram_id: int,
+                              not_before_utc: str) -> Optional[Dict]:
+        """
+        Отмена записи самим клиентом
+        Отменяется только его активная запись, начинающаяся не раньше
+        not_before_utc. Возвращает запись (до отмены) или None.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        booking = self._get_changeable_booking(cursor, booking_id, client_telegram_id, not_before_utc)
+        if booking:
+            cursor.execute('''
+                UPDATE bookings
+                SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (booking_id,))
+        conn.commit()
+        conn.close()
+        return booking
+    
+    def reschedule_booking(self, booking_id: int, client_telegram_id: int, not_before_utc: str,
+                           start_time_utc: str, end_time_utc: str) -> Optional[Dict]:
+        """
+        Перенести запись клиента на другое время
+        Одна транзакция и один UPDATE: id, статус и событие календаря
+        сохраняются, старое время освобождается в тот же момент, когда
+        занимается новое. Новое время с перерывом услуги не должно
+        пересекаться с другой активной записью или бронью листа ожидания
+        другого клиента.
+        Возвращает запись до переноса или None.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            booking = self._get_changeable_booking(cursor, booking_id, client_telegram_id, not_before_utc)
+            if booking is None:
+                return None
+            if self._overlaps_booking(cursor, start_time_utc, end_time_utc,
+                                      booking['service_type'], exclude_id=booking_id):
+                return None
+            if not self._claim_held_time(cursor, client_telegram_id, start_time_utc, end_time_utc):
+                return None
+            
+            cursor.execute('''
+                UPDATE bookings
+                SET start_time_utc = ?, end_time_utc = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (start_time_utc, end_time_utc, booking_id))
+            conn.commit()
+            return booking
+        
+        except sqlite3.IntegrityError:
+            # Новое время уже занято
+            return None
+        finally:
+            conn.close()
+    
     def get_all_future_bookings(self) -> List[Dict]:
         """Получить все будущие записи"""
         conn = self._get_connection()
         cursor = conn.cursor()
+        cursor.execute(SQL_FUTURE_BOOKINGS)
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+    
+    def list_bookings(self, limit: int = 50, after: Optional[Tuple[str, int]] = None,
+                      statuses: Optional[List[str]] = None,
+                      client_telegram_id: Optional[int] = None,
+                      start_utc: Optional[str] = None,
+                      end_utc: Optional[str] = None,
+                      include_history: bool = False) -> List[Dict]:
+        """
+        Получить страницу записей, упорядоченных по (start_time_utc, id)
+        Keyset-пагинация: after - (start_time_utc, id) последней записи
+        предыдущей страницы. Запрос идет по idx_bookings_time без OFFSET,
+        поэтому стоимость страницы не зависит от ее номера.
+        include_history - вместе с архивом (представление all_bookings).
+        """
+        conditions = []
+        params = []
+        if after:
+            conditions.append('(start_time_utc, id) > (?, ?)')
+            params.extend(after)
+        if start_utc:
+            conditions.append('start_time_utc >= ?')
+            params.append(start_utc)
+        if end_utc:
+            conditions.append('start_time_utc < ?')
+            params.append(end_utc)
+        if statuses:
+            conditions.append(f"status IN ({','.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if client_telegram_id is not None:
+            conditions.append('client_telegram_id = ?')
+            params.append(client_telegram_id)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        table = 'all_bookings' if include_history else 'bookings'
+        params.append(limit)
+        
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT * FROM {table} {where}
+            ORDER BY start_time_utc, id
+            LIMIT ?
+        ''', params)
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+    
+    # === Statistics ===
+    
+    # Почасовая агрегация записей по локальному дню/часу начала
+    # (смещение передается модификатором вида '+180 minutes')
+    _HOURLY_STATS_SQL = '''
+        SELECT date(start_time_utc, :offset) AS day,
+               CAST(strftime('%w', start_time_utc, :offset) AS INTEGER) AS weekday,
+               CAST(strftime('%H', start_time_utc, :offset) AS INTEGER) AS hour,
+               COUNT(*) AS bookings,
+               SUM(status = 'cancelled') AS cancelled,
+               SUM(CASE WHEN status != 'cancelled'
+                        THEN (julianday(end_time_utc) - julianday(start_time_utc)) * 1440
+                        ELSE 0 END) AS booked_minutes,
+               TOTAL((julianday(start_time_utc) - julianday(created_at)) * 24) AS lead_hours_sum,
+               COUNT(created_at) AS lead_count
+        FROM all_bookings
+        WHERE start_time_utc >= :start_utc AND start_time_utc < :end_utc
+        GROUP BY day, hour
+    '''
+    
+    def refresh_stats_rollups(self, offset_minutes: int, until_day: str, until_utc: str) -> str:
+        """
+        Досчитать почасовые агрегаты для дней до until_day (не включая)
+        Пересчитываются только дни после последнего обновления.
+        Возвращает день, до которого агрегаты актуальны.
+        """
+        rollup_until = self.get_setting('stats_rollup_until')
+        if rollup_until and rollup_until >= until_day:
+            return rollup_until
+        
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        # Начало пересчета: первый день без агрегатов (или самая ранняя запись)
+        if rollup_until:
+            from_utc = self._local_day_start_utc(rollup_until, offset_minutes)
+        else:
+            cursor.execute('SELECT MIN(start_time_utc) AS first FROM all_bookings')
+            from_utc = cursor.fetchone()['first'] or until_utc
+        
+        cursor.execute('DELETE FROM booking_hourly_stats WHERE day >= ?', (rollup_until or '',))
+        cursor.execute(f'''
+            INSERT INTO booking_hourly_stats
+            (day, weekday, hour, bookings, cancelled, booked_minutes, lead_hours_sum, lead_count)
+            {self._HOURLY_STATS_SQL}
+        ''', {'offset': f'{offset_minutes:+d} minutes', 'start_utc': from_utc, 'end_utc': until_utc})
         cursor.execute('''
-            SELECT * FROM bookings 
-            WHERE start_time_utc >= datetime('now')
-            AND status IN ('pending', 'confirmed')
+            INSERT OR REPLACE INTO settings (key, value, updated_at)
+            VALUES ('stats_rollup_until', ?, CURRENT_TIMESTAMP)
+        ''', (until_day,))
+        conn.commit()
+        conn.close()
+        return until_day
+    
+    def clear_stats_rollups(self):
+        """Удалить кэш агрегатов (будет пересчитан при следующем запросе)"""
+        conn = self._get_connection()
+        self._reset_stats_rollups(conn.cursor())
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def _reset_stats_rollups(cursor: sqlite3.Cursor):
+        cursor.execute('DELETE FROM booking_hourly_stats')
+        cursor.execute("DELETE FROM settings WHERE key = 'stats_rollup_until'")
+    
+    @staticmethod
+    def _invalidate_stats_rollups(cursor: sqlite3.Cursor, start_times: Iterable[str]):
+        """
+        Сбросить кэш агрегатов, если изменились записи уже агрегированных дней
+        (в той же транзакции). Агрегаты - по локальным дням до
+        stats_rollup_until; запись локального дня раньше него начинается
+        не позже этой даты по UTC.
+        """
+        cursor.execute("SELECT value FROM settings WHERE key = 'stats_rollup_until'")
+        row = cursor.fetchone()
+        if row and any(start[:10] <= row['value'] for start in start_times):
+            Database._reset_stats_rollups(cursor)
+    
+    @staticmethod
+    def _local_day_start_utc(day: str, offset_minutes: int) -> str:
+        """Начало локального дня (YYYY-MM-DD) в UTC в формате БД"""
+        start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+        return (start - timedelta(minutes=offset_minutes)).isoformat()
+    
+    def get_booking_stats(self, start_day: str, end_day: str, offset_minutes: int,
+                          rollup_until: Optional[str] = None) -> Dict:
+        """
+        Агрегаты по записям за локальные дни [start_day, end_day)
+        Если задан rollup_until, дни до него берутся из booking_hourly_stats,
+        остальные считаются по таблицам записей.
+        Возвращает by_weekday, by_hour и totals (все считается в SQL).
+        """
+        live_from = max(start_day, rollup_until) if rollup_until else start_day
+        params = {
+            'offset': f'{offset_minutes:+d} minutes',
+            'start_utc': self._local_day_start_utc(live_from, offset_minutes),
+            'end_utc': self._local_day_start_utc(end_day, offset_minutes),
+            'rollup_from': start_day,
+            'rollup_to': min(end_day, rollup_until) if rollup_until else start_day,
+        }
+        
+        hourly_cte = f'''
+            WITH hourly AS (
+                SELECT day, weekday, hour, bookings, cancelled,
+                       booked_minutes, lead_hours_sum, lead_count
+                FROM booking_hourly_stats
+                WHERE day >= :rollup_from AND day < :rollup_to
+                UNION ALL
+                {self._HOURLY_STATS_SQL}
+            )
+        '''
+        aggregates = '''
+            SUM(bookings) AS bookings,
+            SUM(cancelled) AS cancelled,
+            TOTAL(booked_minutes) AS booked_minutes
+        '''
+        
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            {hourly_cte}
+            SELECT weekday, {aggregates} FROM hourly GROUP BY weekday ORDER BY weekday
+        ''', params)
+        by_weekday = [dict(row) for row in cursor.fetchall()]
+        
+        cursor.execute(f'''
+            {hourly_cte}
+            SELECT hour, {aggregates} FROM hourly GROUP BY hour ORDER BY hour
+        ''', params)
+        by_hour = [dict(row) for row in cursor.fetchall()]
+        
+        cursor.execute(f'''
+            {hourly_cte}
+            SELECT {aggregates},
+                   TOTAL(lead_hours_sum) AS lead_hours_sum,
+                   TOTAL(lead_count) AS lead_count
+            FROM hourly
+        ''', params)
+        totals = dict(cursor.fetchone())
+        
+        conn.close()
+        return {'by_weekday': by_weekday, 'by_hour': by_hour, 'totals': totals}
+    
+    def get_no_show_candidates(self, start_utc: str, end_utc: str, limit: int = 20) -> List[Dict]:
+        """
+        Прошедшие записи, так и оставшиеся в статусе pending
+        (запись не была подтверждена - кандидаты на неявку)
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM all_bookings
+            WHERE status = 'pending'
+            AND start_time_utc >= ? AND start_time_utc < ?
             ORDER BY start_time_utc
-        ''')
+            LIMIT ?
+        ''', (start_utc, end_utc, limit))
         rows = cursor.fetchall()
         conn.close()
         return [dict(row) for row in rows]
     
+    # === Export / Import ===
+    
+    BOOKING_IMPORT_FIELDS = (
+        'client_telegram_id', 'client_username', 'client_first_name',
+        'client_last_name', 'start_time_utc', 'end_time_utc', 'status',
+        'google_event_id', 'event_link', 'created_at', 'service_type'
+    )
+    
+    def iter_bookings(self, start_utc: Optional[str] = None, end_utc: Optional[str] = None,
+                      statuses: Optional[List[str]] = None,
+                      batch_size: int = 500) -> Iterator[Dict]:
+        """
+        Потоково выдать записи (по start_time_utc), не загружая их все в память
+        Фильтры: start_utc <= start_time_utc < end_utc, статус из statuses
+        """
+        conditions = []
+        params = []
+        if start_utc:
+            conditions.append('start_time_utc >= ?')
+            params.append(start_utc)
+        if end_utc:
+            conditions.append('start_time_utc < ?')
+            params.append(end_utc)
+        if statuses:
+            conditions.append(f"status IN ({','.join('?' * len(statuses))})")
+            params.extend(statuses)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        conn = self._get_connection()
+        try:
+            cursor = conn.execute(f'''
+                SELECT * FROM bookings {where}
+                ORDER BY start_time_utc
+            ''', params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            conn.close()
+    
+    def import_bookings(self, rows: Iterable[Dict], chunk_size: int = 500) -> Dict:
+        """
+        Импортировать записи пачками (executemany, транзакция на пачку)
+        Активные записи, пересекающиеся с учетом перерывов с активной записью
+        в БД или принятой ранее в этом импорте, не вставляются и попадают
+        в conflicts.
+        Возвращает {'inserted': int, 'conflicts': [start_time_utc, ...]}
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        columns = ', '.join(self.BOOKING_IMPORT_FIELDS)
+        placeholders = ', '.join('?' * len(self.BOOKING_IMPORT_FIELDS))
+        insert_sql = f'INSERT OR IGNORE INTO bookings ({columns}) VALUES ({placeholders})'
+        starts_index = self.BOOKING_IMPORT_FIELDS.index('start_time_utc')
+        
+        inserted = 0
+        conflicts = []
+        
+        def flush(chunk: List[Dict]):
+            nonlocal inserted
+            cursor.execute('BEGIN IMMEDIATE')
+            # Принятые в этой пачке активные записи - в БД их еще нет
+            accepted = []
+            values = []
+            for row in chunk:
+                # Время занимают только активные записи
+                if row.get('status', 'pending') in ('pending', 'confirmed'):
+                    start, end = _busy_interval(row['start_time_utc'], row['end_time_utc'],
+                                                row.get('service_type'))
+                    if (self._overlaps_booking(cursor, row['start_time_utc'], row['end_time_utc'],
+                                               row.get('service_type'))
+                            or any(other_start < end and other_end > start
+                                   for other_start, other_end in accepted)):
+                        conflicts.append(row['start_time_utc'])
+                        continue
+                    accepted.append((start, end))
+                values.append(tuple(row.get(field) for field in self.BOOKING_IMPORT_FIELDS))
+            
+            cursor.executemany(insert_sql, values)
+            # Импорт прошедших записей меняет уже посчитанные агрегаты
+            self._invalidate_stats_rollups(cursor, [value[starts_index] for value in values])
+            conn.commit()
+            inserted += len(values)
+        
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    flush(chunk)
+                    chunk = []
+            if chunk:
+                flush(chunk)
+        finally:
+            conn.close()
+        
+        return {'inserted': inserted, 'conflicts': conflicts}
+    
+    # === Waitlist ===
+    
+    def add_waitlist_entry(self, telegram_id: int, date: str, from_time: str, to_time: str,
+                           service_type: str) -> Optional[int]:
+        """
+        Подписаться на освободившееся время
+        date - локальная дата (YYYY-MM-DD), [from_time, to_time) - диапазон
+        времени начала ('HH:MM', конец дня - '24:00').
+        Возвращает ID подписки или None, если такая подписка уже есть.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO waitlist (telegram_id, date, from_time, to_time, service_type)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (telegram_id, date, from_time, to_time, service_type))
+            entry_id = cursor.lastrowid
+            conn.commit()
+            return entry_id
+        except sqlite3.IntegrityError:
+            return None
+        finally:
+            conn.close()
+    
+    def get_waitlist(self, from_date: str, telegram_id: Optional[int] = None) -> List[Dict]:
+        """Подписки на даты начиная с from_date (всех или одного пользователя)"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM waitlist
+            WHERE date >= ? AND (? IS NULL OR telegram_id = ?)
+            ORDER BY date, from_time, id
+        ''', (from_date, telegram_id, telegram_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+    
+    @staticmethod
+    def _delete_waitlist_entries(cursor: sqlite3.Cursor, ids: List[int]) -> int:
+        placeholders = ','.join('?' * len(ids))
+        cursor.execute(f'DELETE FROM waitlist_offers WHERE waitlist_id IN ({placeholders})', ids)
+        cursor.execute(f'DELETE FROM waitlist WHERE id IN ({placeholders})', ids)
+        return cursor.rowcount
+    
+    def delete_waitlist_entry(self, entry_id: int, telegram_id: int) -> bool:
+        """Отписаться (только от своей подписки)"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM waitlist WHERE id = ? AND telegram_id = ?', (entry_id, telegram_id))
+        deleted = False
+        if cursor.fetchone():
+            deleted = self._delete_waitlist_entries(cursor, [entry_id]) > 0
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    def cleanup_waitlist(self, before_date: str) -> int:
+        """Удалить подписки на прошедшие даты, возвращает число удаленных"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM waitlist WHERE date < ?', (before_date,))
+        ids = [row['id'] for row in cursor.fetchall()]
+        deleted = self._delete_waitlist_entries(cursor, ids) if ids else 0
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    def hold_slot_for_waiter(self, start_time_utc: str, end_time_utc: str,
+                             local_date: str, local_time: str, service_types: List[str],
+                             expires_at: str) -> Optional[Dict]:
+        """
+        Придержать освободившееся время для следующего подписчика
+        Подписчик - первый по порядку подписки на local_date с диапазоном,
+        включающим local_time, услугой из service_types и без предложения
+        этого времени ранее. Поиск и бронь - в одной транзакции; время не
+        должно быть занято активной записью или действующей бронью.
+        Возвращает бронь (slot_holds) или None, если подписчиков не осталось.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DELETE FROM slot_holds WHERE start_time_utc = ? AND expires_at <= ?',
+                           (start_time_utc, now))
+            cursor.execute(SQL_SLOT_HOLDS_OVERLAPPING, (end_time_utc, start_time_utc, now))
+            if cursor.fetchone():
+                return None
+            cursor.execute(SQL_BOOKINGS_OVERLAPPING, (end_time_utc, start_time_utc))
+            if cursor.fetchone():
+                return None
+            
+            cursor.execute(SQL_WAITLIST_MATCHES, (local_date, local_time, local_time, start_time_utc))
+            entry = next((row for row in cursor if row['service_type'] in service_types), None)
+            if entry is None:
+                return None
+            
+            hold = {
+                'start_time_utc': start_time_utc,
+                'end_time_utc': end_time_utc,
+                'telegram_id': entry['telegram_id'],
+                'waitlist_id': entry['id'],
+                'service_type': entry['service_type'],
+                'expires_at': expires_at,
+            }
+            cursor.execute('''
+                INSERT INTO slot_holds
+                (start_time_utc, end_time_utc, telegram_id, waitlist_id, service_type, expires_at)
+                VALUES (:start_time_utc, :end_time_utc, :telegram_id, :waitlist_id, :service_type, :expires_at)
+            ''', hold)
+            cursor.execute('INSERT INTO waitlist_offers (start_time_utc, waitlist_id) VALUES (?, ?)',
+                           (start_time_utc, entry['id']))
+            conn.commit()
+            return hold
+        finally:
+            conn.close()
+    
+    def get_slot_hold(self, start_time_utc: str, telegram_id: int) -> Optional[Dict]:
+        """Действующая бронь времени для пользователя"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM slot_holds
+            WHERE start_time_utc = ? AND telegram_id = ? AND expires_at > ?
+        ''', (start_time_utc, telegram_id, datetime.now(timezone.utc).isoformat()))
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+    
+    def get_slot_holds(self, start_utc: str, end_utc: str) -> List[Dict]:
+        """Действующие брони, пересекающие период"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute(SQL_SLOT_HOLDS_OVERLAPPING, (end_utc, start_utc, datetime.now(timezone.utc).isoformat()))
+        rows = cursor.fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+    
+    def release_slot_hold(self, start_time_utc: str, telegram_id: int) -> Optional[Dict]:
+        """Снять бронь пользователя (отказ от предложения), возвращает снятую бронь"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT * FROM slot_holds WHERE start_time_utc = ? AND telegram_id = ?',
+                       (start_time_utc, telegram_id))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('DELETE FROM slot_holds WHERE start_time_utc = ?', (start_time_utc,))
+        conn.commit()
+        conn.close()
+        return dict(row) if row else None
+    
+    def pop_expired_slot_holds(self) -> List[Dict]:
+        """Удалить истекшие брони и вернуть их"""
+        now = datetime.now(timezone.utc).isoformat()
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT * FROM slot_holds WHERE expires_at <= ? ORDER BY expires_at', (now,))
+        holds = [dict(row) for row in cursor.fetchall()]
+        if holds:
+            cursor.execute('DELETE FROM slot_holds WHERE expires_at <= ?', (now,))
+        conn.commit()
+        conn.close()
+        return holds
+    
+    def get_next_hold_expiry(self) -> Optional[str]:
+        """Время истечения ближайшей брони (по индексу, без перебора)"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT MIN(expires_at) FROM slot_holds')
+        expires_at = cursor.fetchone()[0]
+        conn.close()
+        return expires_at
+    
     # === Rate Limiting ===
     
     def check_rate_limit(self, user_id: int, max_requests: int = 10, 
@@ -315,17 +1414,10 @@ class Database:
         cursor = conn.cursor()
         
         # Удалить старые записи
-        cursor.execute('''
-            DELETE FROM rate_limits 
-            WHERE request_time < datetime('now', '-' || ? || ' minutes')
-        ''', (window_minutes,))
+        cursor.execute(SQL_RATE_LIMIT_CLEANUP, (window_minutes,))
         
         # Посчитать запросы пользователя за последнюю минуту
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM rate_limits 
-            WHERE user_id = ? 
-            AND request_time >= datetime('now', '-' || ? || ' minutes')
-        ''', (user_id, window_minutes))
+        cursor.execute(SQL_RATE_LIMIT_COUNT, (user_id, window_minutes))
         
         count = cursor.fetchone()['count']
         
@@ -343,13 +1435,104 @@ class Database:
         conn.close()
         return True
     
-    def cleanup_old_rate_limits(self):
-        """Очистить старые записи rate limiting"""
+    def cleanup_old_rate_limits(self) -> int:
+        """Очистить старые записи rate limiting, возвращает число удаленных строк"""
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute('''
             DELETE FROM rate_limits 
             WHERE request_time < datetime('now', '-1 hour')
         ''')
+        affected = cursor.rowcount
         conn.commit()
         conn.close()
+        return affected
+    
+    # === Archive ===
+    
+    def archive_old_bookings(self, older_than_days: int = config.ARCHIVE_AFTER_DAYS,
+                             batch_size: int = config.ARCHIVE_BATCH_SIZE) -> Dict:
+        """
+        Перенести записи старше older_than_days в bookings_history
+        Перенос идет пачками по batch_size, каждая пачка - отдельная транзакция,
+        чтобы не держать блокировку записи долго.
+        После переноса чистит rate_limits и освобождает страницы через
+        incremental_vacuum.
+        Возвращает словарь со статистикой.
+        """
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).replace(microsecond=0)
+        cutoff_str = cutoff.isoformat()
+        
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        archived = 0
+        while True:
+            cursor.execute('''
+                SELECT id FROM bookings
+                WHERE start_time_utc < ?
+                ORDER BY start_time_utc
+                LIMIT ?
+            ''', (cutoff_str, batch_size))
+            ids = [row['id'] for row in cursor.fetchall()]
+            
+            if not ids:
+                break
+            
+            placeholders = ','.join('?' * len(ids))
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO bookings_history
+                (id, client_telegram_id, client_username, client_first_name,
+                 client_last_name, start_time_utc, end_time_utc, status,
+                 google_event_id, event_link, created_at, updated_at, service_type)
+                SELECT id, client_telegram_id, client_username, client_first_name,
+                       client_last_name, start_time_utc, end_time_utc, status,
+                       google_event_id, event_link, created_at, updated_at, service_type
+                FROM bookings WHERE id IN ({placeholders})
+            ''', ids)
+            cursor.execute(f'DELETE FROM bookings WHERE id IN ({placeholders})', ids)
+            conn.commit()
+            archived += len(ids)
+        
+        conn.close()
+        
+        rate_limits_deleted = self.cleanup_old_rate_limits()
+        # Подписки на прошедшие даты (с запасом в день на часовой пояс)
+        yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+        waitlist_deleted = self.cleanup_waitlist(yesterday.isoformat())
+        pages_reclaimed, page_size = self._incremental_vacuum()
+        
+        return {
+            'cutoff': cutoff_str,
+            'archived': archived,
+            'rate_limits_deleted': rate_limits_deleted,
+            'waitlist_deleted': waitlist_deleted,
+            'pages_reclaimed': pages_reclaimed,
+            'bytes_reclaimed': pages_reclaimed * page_size,
+        }
+    
+    def _incremental_vacuum(self) -> Tuple[int, int]:
+        """
+        Вернуть свободные страницы файлу БД
+        Возвращает (освобождено страниц, размер страницы)
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+        pages_before = cursor.execute('PRAGMA page_count').fetchone()[0]
+        
+        # БД, созданная до включения auto_vacuum, переключается один раз
+        # через полный VACUUM (режим нельзя сменить иначе)
+        if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('VACUUM')
+        else:
+            # executescript прогоняет прагму до конца (execute освобождает
+            # только одну страницу за шаг)
+            conn.executescript('PRAGMA incremental_vacuum')
+        
+        pages_after = cursor.execute('PRAGMA page_count').fetchone()[0]
+        conn.close()
+        
+        return max(pages_before - pages_after, 0), page_size
@@ -0,0 +1,191 @@
+"""
+Трассировка SQL-запросов к SQLite
+
+TracingConnection (фабрика для sqlite3.connect) замеряет время каждого
+запроса: выполнение и выборку строк курсором. Время копится по "форме"
+запроса - тексту без лишних пробелов и со свернутыми списками
+плейсхолдеров (IN (?, ?, ?) -> IN (?...)).
+
+Запрос дольше DB_SLOW_QUERY_MS пишется в лог; для каждой формы один раз
+к записи добавляется EXPLAIN QUERY PLAN, снятый на том же соединении с
+теми же параметрами.
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Dict, List, Optional, Sequence
+import config
+
+
+logger = logging.getLogger(__name__)
+
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_stats: Dict[str, Dict] = {}
+_explained = set()
+_lock = threading.Lock()
+
+
+def query_shape(sql: str) -> str:
+    """Нормализованный текст запроса (ключ статистики)"""
+    shape = ' '.join(sql.split())
+    return re.sub(r'\?(\s*,\s*\?)+', '?...', shape)
+
+
+def format_plan(rows: Sequence) -> str:
+    """Строки EXPLAIN QUERY PLAN -> дерево с отступами"""
+    depth = {0: 0}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, 0) + 1
+        lines.append('  ' * (depth[node_id] - 1) + detail)
+    return '\n'.join(lines)
+
+
+def explain(conn: sqlite3.Connection, sql: str, params=()) -> List[tuple]:
+    """EXPLAIN QUERY PLAN запроса (кортежи id, parent, notused, detail)"""
+    cursor = sqlite3.Cursor(conn)
+    cursor.row_factory = None
+    try:
+        return cursor.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    finally:
+        cursor.close()
+
+
+def _record(conn: sqlite3.Connection, sql: str, params, elapsed: float):
+    shape = query_shape(sql)
+    elapsed_ms = elapsed * 1000
+    slow = elapsed_ms >= config.DB_SLOW_QUERY_MS
+    
+    with _lock:
+        stats = _stats.setdefault(shape, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'slow': 0})
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        if slow:
+            stats['slow'] += 1
+        need_plan = slow and shape not in _explained and shape.upper().startswith(_EXPLAINABLE)
+        if need_plan:
+            _explained.add(shape)
+    
+    if not slow:
+        return
+    
+    message = f"Медленный запрос ({elapsed_ms:.1f} мс): {shape}"
+    if need_plan:
+        try:
+            message += '\n' + format_plan(explain(conn, sql, params))
+        except sqlite3.Error as e:
+            message += f"\n(план не получен: {e})"
+    logger.warning(message)
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Курсор, замеряющий выполнение и выборку каждого запроса"""
+    
+    def __init__(self, conn: 'TracingConnection'):
+        super().__init__(conn)
+        self._pending = None  # [sql, params, накопленное время]
+        conn._cursors.add(self)
+    
+    def _start(self, sql: str, params, started: float):
+        self._pending = [sql, params, time.perf_counter() - started]
+    
+    def _add(self, started: float):
+        if self._pending:
+            self._pending[2] += time.perf_counter() - started
+    
+    def finish(self):
+        """Учесть запрос (вызывается, когда выборка закончена)"""
+        if self._pending:
+            sql, params, elapsed = self._pending
+            self._pending = None
+            _record(self.connection, sql, params, elapsed)
+    
+    def execute(self, sql: str, parameters=()):
+        self.finish()
+        started = time.perf_counter()
+        result = super().execute(sql, parameters)
+        self._start(sql, parameters, started)
+        return result
+    
+    def executemany(self, sql: str, seq_of_parameters):
+        self.finish()
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        result = super().executemany(sql, seq_of_parameters)
+        self._start(sql, seq_of_parameters[0] if seq_of_parameters else (), started)
+        self.finish()
+        return result
+    
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._add(started)
+        if row is None:
+            self.finish()
+        return row
+    
+    def fetchmany(self, size: Optional[int] = None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add(started)
+        if not rows:
+            self.finish()
+        return rows
+    
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._add(started)
+        self.finish()
+        return rows
+    
+    def close(self):
+        self.finish()
+        super().close()
+    
+    def __del__(self):
+        # Курсор отброшен без выборки до конца: conn.execute(...).fetchone()
+        self.finish()
+
+
+class TracingConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого - TracingCursor"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = weakref.WeakSet()
+    
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+    
+    # Connection.execute создает курсор в обход cursor()
+    def execute(self, sql: str, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql: str, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def close(self):
+        # Запросы, выборка которых не дошла до конца (fetchone одной строки)
+        for cursor in list(self._cursors):
+            cursor.finish()
+        super().close()
+
+
+def get_query_stats(limit: int = 20) -> List[Dict]:
+    """Формы запросов с наибольшим суммарным временем (в этом процессе)"""
+    with _lock:
+        items = [dict(stats, query=shape) for shape, stats in _stats.items()]
+    items.sort(key=lambda item: item['total_ms'], reverse=True)
+    return items[:limit]
+
+
+def reset_query_stats():
+    with _lock:
+        _stats.clear()
+        _explained.clear()
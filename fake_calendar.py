@@ -0,0 +1,402 @@
+"""
+Локальная имитация Google Calendar API v3 (без сети и учетных данных)
+
+FakeCalendarService повторяет интерфейс объекта service из
+googleapiclient в объеме, который использует GoogleCalendarClient:
+calendarList().list, freebusy().query, events().insert/get/patch/delete/list
+и new_batch_http_request. Запрос выполняется методом execute(), как у
+настоящего клиента, ошибки - googleapiclient.errors.HttpError.
+
+Для тестов и замеров настраиваются:
+- latency/latency_jitter - задержка каждого HTTP-вызова (секунды);
+- error_rate/error_status - доля случайных ошибок сервиса;
+- quota_per_minute - лимит вызовов в минуту (сверх него - 429);
+- fail_next(status, count) - ошибка ровно для следующих count вызовов.
+
+Подключение: GoogleCalendarClient(service=FakeCalendarService()) или
+GOOGLE_CALENDAR_FAKE=1 для бота и manage.py.
+"""
+import collections
+import copy
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+BATCH_MAX_REQUESTS = 1000
+LIST_MAX_RESULTS = 2500
+
+_REASONS = {
+    400: 'badRequest',
+    403: 'forbidden',
+    404: 'notFound',
+    410: 'deleted',
+    429: 'rateLimitExceeded',
+    500: 'backendError',
+    503: 'backendError',
+}
+
+
+def _http_error(status: int, message: str, uri: str = 'fake://calendar') -> HttpError:
+    content = json.dumps({'error': {
+        'code': status,
+        'message': message,
+        'errors': [{'reason': _REASONS.get(status, 'error'), 'message': message}],
+    }}).encode()
+    return HttpError(httplib2.Response({'status': status}), content, uri=uri)
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(timezone.utc)
+
+
+def _event_bounds(event: Dict) -> Tuple[datetime, datetime]:
+    """Начало и конец события в UTC (для событий на весь день - полночь UTC)"""
+    bounds = []
+    for key in ('start', 'end'):
+        value = event[key]
+        if 'dateTime' in value:
+            bounds.append(_parse_time(value['dateTime']))
+        else:
+            bounds.append(datetime.fromisoformat(value['date']).replace(tzinfo=timezone.utc))
+    return bounds[0], bounds[1]
+
+
+def _format_time(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# === Маска полей (partial response) ===
+
+def _parse_fields(fields: str) -> Dict[str, Any]:
+    """'items(id,start),nextPageToken' -> {'items': {'id': None, 'start': None}, 'nextPageToken': None}"""
+    def parse(pos: int) -> Tuple[Dict[str, Any], int]:
+        result: Dict[str, Any] = {}
+        name = ''
+        while pos < len(fields):
+            char = fields[pos]
+            if char == '(':
+                result[name.strip()], pos = parse(pos + 1)
+                name = ''
+            elif char == ')':
+                break
+            elif char == ',':
+                if name.strip():
+                    result[name.strip()] = None
+                name = ''
+            else:
+                name += char
+            pos += 1
+        if name.strip():
+            result[name.strip()] = None
+        return result, pos
+    
+    return parse(0)[0]
+
+
+def _apply_fields(data: Any, mask: Optional[Dict[str, Any]]) -> Any:
+    if mask is None:
+        return data
+    if isinstance(data, list):
+        return [_apply_fields(item, mask) for item in data]
+    if not isinstance(data, dict):
+        return data
+    
+    result = {}
+    for name, sub_mask in mask.items():
+        # Путь через '/' (start/dateTime) - вложенная маска
+        head, _, rest = name.partition('/')
+        if head not in data:
+            continue
+        if rest:
+            sub_mask = {rest: sub_mask}
+        result[head] = _apply_fields(data[head], sub_mask)
+    return result
+
+
+# === Запросы ===
+
+class FakeRequest:
+    """Аналог googleapiclient.http.HttpRequest: выполняется через execute()"""
+    
+    def __init__(self, service: 'FakeCalendarService', operation: str,
+                 handler: Callable[[], Dict], fields: Optional[str] = None):
+        self.service = service
+        self.operation = operation
+        self.handler = handler
+        self.fields = fields
+        self.headers: Dict[str, str] = {}
+    
+    def _run(self) -> Dict:
+        """Выполнить без задержки и учета квоты (для запросов внутри batch)"""
+        result = self.handler()
+        return _apply_fields(result, _parse_fields(self.fields)) if self.fields else result
+    
+    def execute(self, http=None, num_retries: int = 0) -> Dict:
+        self.service._before_call(self.operation)
+        return self._run()
+
+
+class FakeBatchRequest:
+    """Аналог BatchHttpRequest: один HTTP-вызов, ответы - через callback"""
+    
+    def __init__(self, service: 'FakeCalendarService', callback: Optional[Callable] = None):
+        self.service = service
+        self.callback = callback
+        self._requests: List[Tuple[str, FakeRequest, Optional[Callable]]] = []
+        self._next_id = 0
+    
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None,
+            request_id: Optional[str] = None):
+        if request_id is None:
+            self._next_id += 1
+            request_id = str(self._next_id)
+        if any(existing == request_id for existing, _, _ in self._requests):
+            raise KeyError(f"Повторный request_id: {request_id}")
+        self._requests.append((request_id, request, callback))
+    
+    def execute(self, http=None):
+        if len(self._requests) > BATCH_MAX_REQUESTS:
+            raise _http_error(400, f"Batch содержит больше {BATCH_MAX_REQUESTS} запросов")
+        self.service._before_call('batch')
+        
+        for request_id, request, callback in self._requests:
+            response, exception = None, None
+            try:
+                self.service._count(request.operation)
+                response = request._run()
+            except HttpError as error:
+                exception = error
+            for handler in (callback, self.callback):
+                if handler:
+                    handler(request_id, response, exception)
+
+
+class _Resource:
+    """Коллекция методов (events(), freebusy(), calendarList())"""
+    
+    def __init__(self, **methods: Callable[..., FakeRequest]):
+        for name, method in methods.items():
+            setattr(self, name, method)
+
+
+# === Сервис ===
+
+class FakeCalendarService:
+    def __init__(self, latency: float = 0.0, latency_jitter: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503,
+                 quota_per_minute: Optional[int] = None, seed: Optional[int] = None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.quota_per_minute = quota_per_minute
+        
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # calendar_id -> {event_id: событие}
+        self.calendars: Dict[str, Dict[str, Dict]] = collections.defaultdict(dict)
+        self._forced_errors: collections.deque = collections.deque()
+        self._call_times: collections.deque = collections.deque()
+        self.calls: collections.Counter = collections.Counter()
+    
+    # --- Управление поведением ---
+    
+    def fail_next(self, status: int = 503, count: int = 1):
+        """Следующие count HTTP-вызовов завершатся ошибкой status"""
+        with self._lock:
+            self._forced_errors.extend([status] * count)
+    
+    def add_event(self, calendar_id: str, start: datetime, end: datetime,
+                  summary: str = 'Занято', **fields) -> Dict:
+        """Добавить событие напрямую, без вызова API (подготовка данных)"""
+        with self._lock:
+            return self._store_event(calendar_id, dict(
+                fields,
+                summary=summary,
+                start={'dateTime': start.isoformat()},
+                end={'dateTime': end.isoformat()},
+            ))
+    
+    def get_metrics(self) -> Dict:
+        """Число вызовов по операциям"""
+        with self._lock:
+            return dict(self.calls)
+    
+    # --- Выполнение вызова ---
+    
+    def _count(self, operation: str):
+        with self._lock:
+            self.calls[operation] += 1
+    
+    def _before_call(self, operation: str):
+        """Квота, внедренные ошибки и задержка одного HTTP-вызова"""
+        with self._lock:
+            self.calls[operation] += 1
+            now = time.monotonic()
+            
+            if self.quota_per_minute is not None:
+                while self._call_times and now - self._call_times[0] >= 60:
+                    self._call_times.popleft()
+                if len(self._call_times) >= self.quota_per_minute:
+                    raise _http_error(429, "Rate Limit Exceeded")
+                self._call_times.append(now)
+            
+            status = self._forced_errors.popleft() if self._forced_errors else None
+            if status is None and self.error_rate and self._random.random() < self.error_rate:
+                status = self.error_status
+            delay = self.latency + (self._random.uniform(0, self.latency_jitter)
+                                    if self.latency_jitter else 0)
+        
+        if delay:
+            time.sleep(delay)
+        if status is not None:
+            raise _http_error(status, f"Внедренная ошибка ({operation})")
+    
+    # --- Хранилище событий ---
+    
+    def _store_event(self, calendar_id: str, body: Dict) -> Dict:
+        event_id = body.get('id') or uuid.uuid4().hex
+        now = _format_time(datetime.now(timezone.utc))
+        event = copy.deepcopy(body)
+        event.update({
+            'id': event_id,
+            'status': body.get('status', 'confirmed'),
+            'htmlLink': f"https://calendar.google.com/calendar/event?eid={event_id}",
+            'created': now,
+            'updated': now,
+            'etag': f'"{uuid.uuid4().int % 10 ** 16}"',
+        })
+        _event_bounds(event)  # Проверка формата start/end
+        self.calendars[calendar_id][event_id] = event
+        return copy.deepcopy(event)
+    
+    def _find_event(self, calendar_id: str, event_id: str) -> Dict:
+        event = self.calendars.get(calendar_id, {}).get(event_id)
+        if event is None:
+            raise _http_error(404, "Not Found")
+        return event
+    
+    # --- API ---
+    
+    def calendarList(self) -> _Resource:
+        def list_(**kwargs) -> FakeRequest:
+            def handler():
+                with self._lock:
+                    ids = list(self.calendars) or ['primary']
+                return {'items': [{'id': calendar_id, 'summary': calendar_id} for calendar_id in ids]}
+            return FakeRequest(self, 'calendarList.list', handler, kwargs.get('fields'))
+        return _Resource(list=list_)
+    
+    def freebusy(self) -> _Resource:
+        def query(body: Dict, fields: Optional[str] = None) -> FakeRequest:
+            def handler():
+                time_min = _parse_time(body['timeMin'])
+                time_max = _parse_time(body['timeMax'])
+                calendars = {}
+                with self._lock:
+                    for item in body.get('items', []):
+                        intervals = sorted(
+                            (max(start, time_min), min(end, time_max))
+                            for start, end in (
+                                _event_bounds(event)
+                                for event in self.calendars.get(item['id'], {}).values()
+                                if event['status'] != 'cancelled'
+                                and event.get('transparency') != 'transparent'
+                            )
+                            if start < time_max and end > time_min
+                        )
+                        merged: List[List[datetime]] = []
+                        for start, end in intervals:
+                            if merged and start <= merged[-1][1]:
+                                merged[-1][1] = max(merged[-1][1], end)
+                            else:
+                                merged.append([start, end])
+                        calendars[item['id']] = {'busy': [
+                            {'start': _format_time(start), 'end': _format_time(end)}
+                            for start, end in merged
+                        ]}
+                return {
+                    'kind': 'calendar#freeBusy',
+                    'timeMin': body['timeMin'],
+                    'timeMax': body['timeMax'],
+                    'calendars': calendars,
+                }
+            return FakeRequest(self, 'freebusy', handler, fields)
+        return _Resource(query=query)
+    
+    def events(self) -> _Resource:
+        def insert(calendarId: str, body: Dict, fields: Optional[str] = None, **kwargs) -> FakeRequest:
+            def handler():
+                with self._lock:
+                    return self._store_event(calendarId, body)
+            return FakeRequest(self, 'events.insert', handler, fields)
+        
+        def get(calendarId: str, eventId: str, fields: Optional[str] = None, **kwargs) -> FakeRequest:
+            def handler():
+                with self._lock:
+                    return copy.deepcopy(self._find_event(calendarId, eventId))
+            return FakeRequest(self, 'events.get', handler, fields)
+        
+        def patch(calendarId: str, eventId: str, body: Dict, fields: Optional[str] = None,
+                  **kwargs) -> FakeRequest:
+            def handler():
+                with self._lock:
+                    event = self._find_event(calendarId, eventId)
+                    if event['status'] == 'cancelled':
+                        raise _http_error(410, "Resource has been deleted")
+                    event.update(copy.deepcopy(body))
+                    event['updated'] = _format_time(datetime.now(timezone.utc))
+                    return copy.deepcopy(event)
+            return FakeRequest(self, 'events.patch', handler, fields)
+        
+        def delete(calendarId: str, eventId: str, **kwargs) -> FakeRequest:
+            def handler():
+                with self._lock:
+                    event = self._find_event(calendarId, eventId)
+                    if event['status'] == 'cancelled':
+                        raise _http_error(410, "Resource has been deleted")
+                    # Как в Google: удаленное событие остается со статусом cancelled
+                    event['status'] = 'cancelled'
+                    event['updated'] = _format_time(datetime.now(timezone.utc))
+                    return {}
+            return FakeRequest(self, 'events.delete', handler)
+        
+        def list_(calendarId: str, timeMin: Optional[str] = None, timeMax: Optional[str] = None,
+                  pageToken: Optional[str] = None, maxResults: int = 250,
+                  showDeleted: bool = False, fields: Optional[str] = None, **kwargs) -> FakeRequest:
+            def handler():
+                if maxResults > LIST_MAX_RESULTS:
+                    raise _http_error(400, f"maxResults больше {LIST_MAX_RESULTS}")
+                time_min = _parse_time(timeMin) if timeMin else None
+                time_max = _parse_time(timeMax) if timeMax else None
+                
+                with self._lock:
+                    events = []
+                    for event in self.calendars.get(calendarId, {}).values():
+                        if event['status'] == 'cancelled' and not showDeleted:
+                            continue
+                        start, end = _event_bounds(event)
+                        if (time_min and end <= time_min) or (time_max and start >= time_max):
+                            continue
+                        events.append((start, event['id'], event))
+                events.sort(key=lambda item: item[:2])
+                
+                offset = int(pageToken) if pageToken else 0
+                page = [copy.deepcopy(event) for _, _, event in events[offset:offset + maxResults]]
+                result = {'kind': 'calendar#events', 'items': page}
+                if offset + maxResults < len(events):
+                    result['nextPageToken'] = str(offset + maxResults)
+                return result
+            return FakeRequest(self, 'events.list', handler, fields)
+        
+        return _Resource(insert=insert, get=get, patch=patch, delete=delete, list=list_)
+    
+    def new_batch_http_request(self, callback: Optional[Callable] = None) -> FakeBatchRequest:
+        return FakeBatchRequest(self, callback)
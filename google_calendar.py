@@ -1,75 +1,218 @@
 """
 Модуль для работы с Google Calendar API
 """
-import os
-import pickle
-import json
-import base64
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Tuple
+import google_auth_httplib2
+import httplib2
 from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+import token_store
 import config
 import pytz
 
 
-SCOPES = ['https://www.googleapis.com/auth/calendar']
-TOKEN_PICKLE_PATH = 'data/token.pickle'
-CREDENTIALS_JSON_PATH = 'credentials.json'
+logger = logging.getLogger(__name__)
+
+# Ошибки вызова API: ответ с ошибкой, сеть/таймаут, открытый выключатель
+API_ERRORS = (HttpError, CircuitOpenError, httplib2.HttpLib2Error, OSError)
+
+
+class CalendarUnavailableError(Exception):
+    """Календарь недоступен и нет достаточно свежих сохраненных данных"""
+
+
+def _is_service_failure(error: BaseException) -> bool:
+    """Ошибка говорит о недоступности сервиса (а не о неверном запросе)"""
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500 or error.resp.status in (408, 429)
+    return True
+
+
+class HttpPool:
+    """
+    Пул keep-alive HTTP-соединений к Google API
+    httplib2.Http не потокобезопасен, поэтому каждый запрос берет из пула
+    свой экземпляр (с уже открытым соединением) и возвращает его после
+    выполнения. Не больше size запросов выполняются одновременно.
+    """
+    
+    def __init__(self, credentials, size: int = config.GOOGLE_HTTP_POOL_SIZE,
+                 timeout: float = config.GOOGLE_HTTP_TIMEOUT):
+        self.credentials = credentials
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+    
+    def _create(self) -> google_auth_httplib2.AuthorizedHttp:
+        return google_auth_httplib2.AuthorizedHttp(
+            self.credentials,
+            http=httplib2.Http(timeout=self.timeout)
+        )
+    
+    @staticmethod
+    def _set_timeout(http: google_auth_httplib2.AuthorizedHttp, timeout: float):
+        """Таймаут для новых и уже открытых соединений экземпляра"""
+        http.http.timeout = timeout
+        for connection in http.http.connections.values():
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+    
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """Взять соединение из пула на время одного запроса"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("Нет свободных соединений к Google API")
+        try:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                http = self._create()
+            self._set_timeout(http, timeout or self.timeout)
+            try:
+                yield http
+            finally:
+                self._idle.put(http)
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        """Закрыть простаивающие соединения"""
+        while True:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            http.http.close()
 
 
 class GoogleCalendarClient:
-    def __init__(self):
+    def __init__(self, service=None):
+        """
+        service - готовый объект API (например, FakeCalendarService для
+        тестов); без него клиент авторизуется по сохраненному токену
+        """
         self.creds = None
-        self.service = None
-        self._authenticate()
+        self.service = service
+        self.http_pool = None
+        self.breaker = CircuitBreaker(
+            'google_calendar',
+            failure_threshold=config.CALENDAR_BREAKER_FAILURE_THRESHOLD,
+            reset_seconds=config.CALENDAR_BREAKER_RESET_SECONDS,
+            max_reset_seconds=config.CALENDAR_BREAKER_MAX_RESET_SECONDS,
+            jitter=config.CALENDAR_BREAKER_JITTER
+        )
+        # Последние успешные ответы freebusy: calendar_id -> [(time_min, time_max, busy, fetched_at)]
+        self._busy_cache: Dict[str, List[Tuple[datetime, datetime, List, float]]] = {}
+        self._busy_lock = threading.Lock()
+        self._busy_metrics = {'stale_served': 0, 'unavailable': 0, 'last_stale_age_seconds': None}
+        self._refresh_lock = threading.Lock()
+        if service is None:
+            self._authenticate()
     
     def _authenticate(self):
         """Аутентификация в Google Calendar API"""
-        # Проверить сохраненный токен
-        if os.path.exists(TOKEN_PICKLE_PATH):
-            with open(TOKEN_PICKLE_PATH, 'rb') as token:
-                self.creds = pickle.load(token)
-        # Или из переменной окружения (для Bothost)
-        elif os.getenv('GOOGLE_TOKEN_PICKLE_BASE64'):
+        try:
+            self.creds = token_store.load_or_migrate()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки токена: {e}")
+            self.creds = None
+        
+        # Обновить токен сразу, если он истек или скоро истечет
+        if self.creds:
             try:
-                token_data = base64.b64decode(os.getenv('GOOGLE_TOKEN_PICKLE_BASE64'))
-                self.creds = pickle.loads(token_data)
+                self.refresh_if_needed()
             except Exception as e:
-                print(f"Ошибка загрузки токена из переменной окружения: {e}")
-                self.creds = None
-        
-        # Если нет валидных credentials, получить новые
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                except Exception as e:
-                    print(f"Ошибка обновления токена: {e}")
+                logger.error(f"Ошибка обновления токена: {e}")
+                if not self.creds.valid:
                     self.creds = None
+        
+        if not self.creds:
+            # Требуется новая авторизация
+            # НЕ ЗАПУСКАЕМ интерактивную авторизацию на сервере без GUI
+            logger.warning(
+                "Google Calendar не авторизован, бот будет работать БЕЗ Google Calendar. "
+                f"Для авторизации запустите auth_google.py локально и загрузите "
+                f"{token_store.TOKEN_PATH} на сервер или установите переменную GOOGLE_TOKEN_JSON"
+            )
+            return
+        
+        # Собственный http объекта service не используется: запросы
+        # выполняются через соединения из пула (см. _execute)
+        self.service = build('calendar', 'v3', credentials=self.creds,
+                             cache_discovery=False)
+        self.http_pool = HttpPool(self.creds)
+    
+    def refresh_if_needed(self) -> bool:
+        """
+        Обновить access token, если до истечения меньше GOOGLE_TOKEN_REFRESH_MARGIN_MINUTES
+        Вызывается фоновой задачей бота, чтобы запросы пользователей не ждали
+        обновления токена. Новый токен сохраняется в файл.
+        Возвращает True, если токен был обновлен.
+        """
+        with self._refresh_lock:
+            if not self.creds or not self.creds.refresh_token:
+                return False
             
-            if not self.creds:
-                # Требуется новая авторизация
-                # НЕ ЗАПУСКАЕМ интерактивную авторизацию на сервере без GUI
-                print("⚠️ Google Calendar не авторизован")
-                print("Для авторизации Google Calendar:")
-                print("1. Запустите auth_google.py локально")
-                print("2. Загрузите token.pickle на сервер")
-                print("3. Или установите переменную GOOGLE_TOKEN_PICKLE_BASE64")
-                print("")
-                print("Бот будет работать БЕЗ Google Calendar")
-                return
+            # expiry в google-auth - naive UTC
+            margin = timedelta(minutes=config.GOOGLE_TOKEN_REFRESH_MARGIN_MINUTES)
+            now = datetime.now(pytz.utc).replace(tzinfo=None)
+            if self.creds.token and self.creds.expiry and self.creds.expiry - margin > now:
+                return False
             
-            # Сохранить credentials
-            os.makedirs(os.path.dirname(TOKEN_PICKLE_PATH), exist_ok=True)
-            with open(TOKEN_PICKLE_PATH, 'wb') as token:
-                pickle.dump(self.creds, token)
+            self.creds.refresh(Request())
         
-        if self.creds:
-            self.service = build('calendar', 'v3', credentials=self.creds)
+        try:
+            token_store.save_credentials(self.creds)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить токен: {e}")
+        return True
+    
+    def _execute(self, operation: str, request):
+        """
+        Выполнить запрос API через соединение из пула
+        Таймаут берется из GOOGLE_HTTP_TIMEOUTS по имени операции.
+        Сжатие gzip запрашивается JSON-моделью клиента (Accept-Encoding и
+        '(gzip)' в User-Agent), ответ распаковывает httplib2.
+        Пока выключатель открыт, запрос не выполняется (CircuitOpenError).
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Google Calendar недоступен ({operation})")
+        
+        # У batch-запроса свои заголовки не задаются
+        if hasattr(request, 'headers'):
+            request.headers['user-agent'] = (
+                f"{config.GOOGLE_HTTP_USER_AGENT} {request.headers.get('user-agent', '')}".strip()
+            )
+        try:
+            if self.http_pool is None:
+                # Внедренный service (без пула соединений)
+                result = request.execute()
+            else:
+                with self.http_pool.connection(config.GOOGLE_HTTP_TIMEOUTS.get(operation)) as http:
+                    result = request.execute(http=http)
+        except Exception as error:
+            if _is_service_failure(error):
+                self.breaker.record_failure(error)
+            else:
+                self.breaker.record_success()
+            raise
+        
+        self.breaker.record_success()
+        return result
+    
+    @staticmethod
+    def _fields(operation: str) -> Optional[str]:
+        """Маска полей частичного ответа для операции (None - весь ресурс)"""
+        return config.GOOGLE_API_FIELDS.get(operation)
     
     def is_authenticated(self) -> bool:
         """Проверить, аутентифицирован ли клиент"""
@@ -81,52 +224,127 @@ class GoogleCalendarClient:
             return []
         
         try:
-            calendar_list = self.service.calendarList().list().execute()
+            calendar_list = self._execute('calendarList.list', self.service.calendarList().list())
             return calendar_list.get('items', [])
-        except HttpError as error:
-            print(f'Ошибка получения списка календарей: {error}')
+        except API_ERRORS as error:
+            logger.error(f'Ошибка получения списка календарей: {error}')
             return []
     
+    def _fetch_busy(self, calendar_id: str, time_min: datetime,
+                    time_max: datetime) -> List[Tuple[datetime, datetime]]:
+        """Запрос freebusy (ошибки не перехватываются)"""
+        body = {
+            "timeMin": time_min.isoformat(),
+            "timeMax": time_max.isoformat(),
+            "timeZone": 'UTC',
+            "items": [{"id": calendar_id}]
+        }
+        
+        freebusy_result = self._execute(
+            'freebusy',
+            self.service.freebusy().query(body=body, fields=self._fields('freebusy'))
+        )
+        calendars = freebusy_result.get('calendars', {})
+        
+        if calendar_id not in calendars:
+            return []
+        
+        # Ошибка по конкретному календарю приходит в ответе со статусом 200
+        errors = calendars[calendar_id].get('errors')
+        if errors:
+            raise CalendarUnavailableError(f"freebusy: {errors}")
+        
+        busy_intervals = []
+        for busy_period in calendars[calendar_id].get('busy', []):
+            start = datetime.fromisoformat(busy_period['start'].replace('Z', '+00:00'))
+            end = datetime.fromisoformat(busy_period['end'].replace('Z', '+00:00'))
+            busy_intervals.append((start, end))
+        
+        return busy_intervals
+    
+    def _remember_busy(self, calendar_id: str, time_min: datetime, time_max: datetime,
+                       busy_intervals: List[Tuple[datetime, datetime]]):
+        """Сохранить успешный ответ freebusy (для работы при недоступности API)"""
+        with self._busy_lock:
+            entries = [
+                entry for entry in self._busy_cache.get(calendar_id, [])
+                if not (time_min <= entry[0] and entry[1] <= time_max)  # Покрыт новым ответом
+            ]
+            entries.append((time_min, time_max, busy_intervals, time.time()))
+            self._busy_cache[calendar_id] = entries[-config.CALENDAR_BUSY_CACHE_SIZE:]
+    
+    def _cached_busy(self, calendar_id: str, time_min: datetime,
+                     time_max: datetime) -> Tuple[List[Tuple[datetime, datetime]], float]:
+        """
+        Самый свежий сохраненный ответ, покрывающий [time_min, time_max]
+        Возвращает (интервалы, возраст в секундах); если данных нет или они
+        старше CALENDAR_STALE_MAX_AGE_MINUTES - CalendarUnavailableError.
+        """
+        now = time.time()
+        with self._busy_lock:
+            covering = [
+                entry for entry in self._busy_cache.get(calendar_id, [])
+                if entry[0] <= time_min and time_max <= entry[1]
+                and now - entry[3] <= config.CALENDAR_STALE_MAX_AGE_MINUTES * 60
+            ]
+            if not covering:
+                self._busy_metrics['unavailable'] += 1
+                raise CalendarUnavailableError("Нет сохраненных данных о занятости")
+            
+            entry = max(covering, key=lambda item: item[3])
+            age = now - entry[3]
+            self._busy_metrics['stale_served'] += 1
+            self._busy_metrics['last_stale_age_seconds'] = age
+        
+        busy_intervals = [
+            (start, end) for start, end in entry[2]
+            if start < time_max and end > time_min
+        ]
+        return busy_intervals, age
+    
+    def get_busy(self, calendar_id: str, time_min: datetime,
+                 time_max: datetime) -> Tuple[List[Tuple[datetime, datetime]], Optional[float]]:
+        """
+        Занятые интервалы календаря и возраст данных
+        Возвращает (список (start, end) в UTC, возраст в секундах или None
+        для свежего ответа). Если API недоступно, отдаются последние
+        сохраненные данные; если их нет - CalendarUnavailableError.
+        """
+        if not self.service:
+            return [], None
+        
+        try:
+            busy_intervals = self._fetch_busy(calendar_id, time_min, time_max)
+        except API_ERRORS + (CalendarUnavailableError,) as error:
+            logger.error(f'Ошибка получения занятых интервалов: {error}')
+            return self._cached_busy(calendar_id, time_min, time_max)
+        
+        self._remember_busy(calendar_id, time_min, time_max, busy_intervals)
+        return busy_intervals, None
+    
     def get_busy_intervals(self, calendar_id: str, time_min: datetime, 
                           time_max: datetime) -> List[Tuple[datetime, datetime]]:
         """
         Получить занятые интервалы из календаря
         Возвращает список кортежей (start, end) в UTC
+        (при недоступности API - см. get_busy)
         """
-        if not self.service:
-            return []
-        
-        try:
-            body = {
-                "timeMin": time_min.isoformat(),
-                "timeMax": time_max.isoformat(),
-                "timeZone": 'UTC',
-                "items": [{"id": calendar_id}]
-            }
-            
-            freebusy_result = self.service.freebusy().query(body=body).execute()
-            calendars = freebusy_result.get('calendars', {})
-            
-            if calendar_id not in calendars:
-                return []
-            
-            busy_intervals = []
-            for busy_period in calendars[calendar_id].get('busy', []):
-                start = datetime.fromisoformat(busy_period['start'].replace('Z', '+00:00'))
-                end = datetime.fromisoformat(busy_period['end'].replace('Z', '+00:00'))
-                busy_intervals.append((start, end))
-            
-            return busy_intervals
-            
-        except HttpError as error:
-            print(f'Ошибка получения занятых интервалов: {error}')
-            return []
+        return self.get_busy(calendar_id, time_min, time_max)[0]
+    
+    def get_metrics(self) -> Dict:
+        """Состояние выключателя и использование сохраненных данных"""
+        with self._busy_lock:
+            busy_metrics = dict(self._busy_metrics)
+        return {'breaker': self.breaker.get_metrics(), 'busy': busy_metrics}
     
     def create_event(self, calendar_id: str, summary: str, description: str,
                     start_time: datetime, end_time: datetime, 
-                    timezone: str = config.PRIMARY_TZ) -> Optional[Dict]:
+                    timezone: str = config.PRIMARY_TZ,
+                    booking_id: Optional[int] = None) -> Optional[Dict]:
         """
         Создать событие в календаре
+        booking_id сохраняется в extendedProperties.private: если ответ на
+        вставку не дошел, сверка найдет событие и привяжет его к записи.
         Возвращает словарь с event_id и event_link
         """
         if not self.service:
@@ -156,20 +374,87 @@ class GoogleCalendarClient:
                 ],
             },
         }
+        if booking_id is not None:
+            event['extendedProperties'] = {'private': {'booking_id': str(booking_id)}}
         
         try:
-            created_event = self.service.events().insert(
-                calendarId=calendar_id, 
-                body=event
-            ).execute()
+            created_event = self._execute('events.insert', self.service.events().insert(
+                calendarId=calendar_id,
+                body=event,
+                fields=self._fields('events.insert')
+            ))
             
             return {
                 'event_id': created_event['id'],
                 'event_link': created_event.get('htmlLink', '')
             }
-            
-        except HttpError as error:
-            print(f'Ошибка создания события: {error}')
+        
+        except API_ERRORS as error:
+            logger.error(f'Ошибка создания события: {error}')
+            return None
+    
+    def list_events(self, calendar_id: str, time_min: datetime, time_max: datetime) -> List[Dict]:
+        """
+        Все события периода, включая удаленные (status = cancelled)
+        events.list по GOOGLE_LIST_PAGE_SIZE событий на страницу с маской
+        полей events.list (вместе с booking_id из extendedProperties.private). Неполный список сверять нельзя, поэтому ошибка
+        любой страницы - CalendarUnavailableError.
+        """
+        if not self.service:
+            raise CalendarUnavailableError("Google Calendar не подключен")
+        
+        events = []
+        page_token = None
+        try:
+            while True:
+                response = self._execute('events.list', self.service.events().list(
+                    calendarId=calendar_id,
+                    timeMin=time_min.isoformat(),
+                    timeMax=time_max.isoformat(),
+                    singleEvents=True,
+                    showDeleted=True,
+                    maxResults=config.GOOGLE_LIST_PAGE_SIZE,
+                    pageToken=page_token,
+                    fields=self._fields('events.list')
+                ))
+                events.extend(response.get('items', []))
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    return events
+        
+        except API_ERRORS as error:
+            raise CalendarUnavailableError(f"Не удалось получить события: {error}") from error
+    
+    def move_event(self, calendar_id: str, event_id: str, start_time: datetime,
+                   end_time: datetime, timezone: str = config.PRIMARY_TZ) -> Optional[Dict]:
+        """
+        Перенести событие на другое время (events.patch: меняются только
+        start и end, id, ссылка и напоминания сохраняются)
+        Возвращает словарь с event_id и event_link или None при ошибке
+        """
+        if not self.service:
+            return None
+        
+        tz = pytz.timezone(timezone)
+        body = {
+            'start': {'dateTime': start_time.astimezone(tz).isoformat(), 'timeZone': timezone},
+            'end': {'dateTime': end_time.astimezone(tz).isoformat(), 'timeZone': timezone},
+        }
+        
+        try:
+            event = self._execute('events.patch', self.service.events().patch(
+                calendarId=calendar_id,
+                eventId=event_id,
+                body=body,
+                fields=self._fields('events.patch')
+            ))
+            return {
+                'event_id': event['id'],
+                'event_link': event.get('htmlLink', '')
+            }
+        
+        except API_ERRORS as error:
+            logger.error(f'Ошибка переноса события: {error}')
             return None
     
     def delete_event(self, calendar_id: str, event_id: str) -> bool:
@@ -178,30 +463,72 @@ class GoogleCalendarClient:
             return False
         
         try:
-            self.service.events().delete(
+            self._execute('events.delete', self.service.events().delete(
                 calendarId=calendar_id,
                 eventId=event_id
-            ).execute()
+            ))
             return True
-            
-        except HttpError as error:
-            print(f'Ошибка удаления события: {error}')
+        
+        except API_ERRORS as error:
+            logger.error(f'Ошибка удаления события: {error}')
             return False
     
+    def delete_events(self, calendar_id: str, event_ids: List[str]) -> Dict[str, bool]:
+        """
+        Удалить несколько событий batch-запросами
+        В одном HTTP-вызове до GOOGLE_BATCH_SIZE удалений. Уже удаленные
+        события (404/410) считаются успешно удаленными.
+        Возвращает {event_id: удалено ли}
+        """
+        event_ids = list(dict.fromkeys(event_ids))
+        if not self.service:
+            return {event_id: False for event_id in event_ids}
+        
+        results = {}
+        
+        def on_response(request_id, response, exception):
+            if exception is None:
+                results[request_id] = True
+            elif isinstance(exception, HttpError) and exception.resp.status in (404, 410):
+                results[request_id] = True
+            else:
+                logger.error(f'Ошибка удаления события {request_id}: {exception}')
+                results[request_id] = False
+        
+        for i in range(0, len(event_ids), config.GOOGLE_BATCH_SIZE):
+            chunk = event_ids[i:i + config.GOOGLE_BATCH_SIZE]
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for event_id in chunk:
+                batch.add(
+                    self.service.events().delete(calendarId=calendar_id, eventId=event_id),
+                    request_id=event_id
+                )
+            
+            try:
+                self._execute('batch', batch)
+            except API_ERRORS as error:
+                logger.error(f'Ошибка batch-запроса удаления событий: {error}')
+            
+            for event_id in chunk:
+                results.setdefault(event_id, False)
+        
+        return results
+    
     def get_event(self, calendar_id: str, event_id: str) -> Optional[Dict]:
         """Получить событие по ID"""
         if not self.service:
             return None
         
         try:
-            event = self.service.events().get(
+            event = self._execute('events.get', self.service.events().get(
                 calendarId=calendar_id,
-                eventId=event_id
-            ).execute()
+                eventId=event_id,
+                fields=self._fields('events.get')
+            ))
             return event
-            
-        except HttpError as error:
-            print(f'Ошибка получения события: {error}')
+        
+        except API_ERRORS as error:
+            logger.error(f'Ошибка получения события: {error}')
             return None
 
 
@@ -210,8 +537,24 @@ _calendar_client = None
 
 
 def get_calendar_client() -> GoogleCalendarClient:
-    """Получить singleton instance календарного клиента"""
+    """
+    Получить singleton instance календарного клиента
+    При GOOGLE_CALENDAR_FAKE клиент работает с локальной имитацией API.
+    """
     global _calendar_client
     if _calendar_client is None:
-        _calendar_client = GoogleCalendarClient()
+        if config.GOOGLE_CALENDAR_FAKE:
+            from fake_calendar import FakeCalendarService
+            _calendar_client = GoogleCalendarClient(service=FakeCalendarService(
+                latency=config.GOOGLE_CALENDAR_FAKE_LATENCY_MS / 1000,
+                error_rate=config.GOOGLE_CALENDAR_FAKE_ERROR_RATE
+            ))
+        else:
+            _calendar_client = GoogleCalendarClient()
     return _calendar_client
+
+
+def set_calendar_client(client: Optional[GoogleCalendarClient]):
+    """Подменить singleton (тесты и замеры); None - создать заново при следующем вызове"""
+    global _calendar_client
+    _calendar_client = client
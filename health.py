@@ -0,0 +1,194 @@
+"""
+HTTP-эндпоинты живости и готовности бота
+
+Фоновая задача HealthMonitor раз в HEALTH_CHECK_INTERVAL_SECONDS:
+- измеряет задержку event loop (насколько позже назначенного проснулся sleep);
+- раз в HEALTH_DB_PROBE_INTERVAL_SECONDS пробует запись в SQLite (в
+  отдельном потоке) и замеряет ее время - чаще писать в файл, куда бот
+  пишет записи клиентов, незачем;
+- снимает состояние Google Calendar (авторизация, выключатель) - только из
+  памяти клиента, без запросов к Google;
+- читает глубину очереди логов и очереди обновлений.
+
+Ответ на запрос - сериализация последнего снимка, поэтому проверка со
+стороны хостинга ничего не вычисляет и не нагружает БД и Google.
+
+GET /health/live  - 200, пока event loop отвечает без большой задержки
+GET /health/ready - 200, если еще и БД принимает запись; недоступный
+                    Google Calendar готовность не снимает (бот работает
+                    на сохраненной занятости), но отражается в ответе
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional, Tuple
+import config
+from database import Database
+from circuit_breaker import CLOSED
+from logging_setup import get_queue_stats
+
+
+logger = logging.getLogger(__name__)
+
+PROBE_SETTING_KEY = 'health_probe'
+
+
+class HealthMonitor:
+    def __init__(self, db: Database, calendar_client=None, update_processor=None,
+                 interval_seconds: float = config.HEALTH_CHECK_INTERVAL_SECONDS):
+        self.db = db
+        self.calendar_client = calendar_client
+        self.update_processor = update_processor
+        self.interval_seconds = interval_seconds
+        self.started_at = time.time()
+        self._last_tick: Optional[float] = None  # time.monotonic() последнего цикла
+        self._last_db_probe: Optional[float] = None  # time.monotonic() последней записи в БД
+        self._snapshot: Dict = {
+            'loop_lag_ms': None,
+            'database': {'ok': None, 'write_ms': None, 'error': None},
+            'calendar': {'enabled': calendar_client is not None},
+            'log_queue': get_queue_stats(),
+            'updates': None,
+        }
+    
+    async def run(self):
+        """
+        Цикл измерений (запускается как фоновая задача)
+        Ошибка одного замера пишется в лог и не останавливает цикл - иначе
+        живость стала бы 503 до перезапуска бота.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + self.interval_seconds
+            await asyncio.sleep(self.interval_seconds)
+            lag = max(loop.time() - scheduled, 0)
+            
+            snapshot = dict(self._snapshot, loop_lag_ms=round(lag * 1000, 1))
+            try:
+                now = time.monotonic()
+                if (self._last_db_probe is None
+                        or now - self._last_db_probe >= config.HEALTH_DB_PROBE_INTERVAL_SECONDS):
+                    self._last_db_probe = now
+                    snapshot['database'] = await self._probe_database()
+                snapshot['calendar'] = self._calendar_state()
+                snapshot['log_queue'] = get_queue_stats()
+                if self.update_processor:
+                    snapshot['updates'] = self.update_processor.get_metrics()
+            except Exception as e:
+                logger.error(f"Ошибка замера состояния бота: {e}")
+            
+            self._snapshot = snapshot
+            self._last_tick = time.monotonic()
+    
+    async def _probe_database(self) -> Dict:
+        """Пробная запись в settings: время записи с фиксацией транзакции"""
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.db.set_setting, PROBE_SETTING_KEY, str(int(time.time())))
+        except Exception as e:
+            logger.error(f"Проверка записи в БД не удалась: {e}")
+            return {'ok': False, 'write_ms': None, 'error': str(e)}
+        
+        write_ms = round((time.perf_counter() - started) * 1000, 1)
+        return {
+            'ok': write_ms <= config.HEALTH_MAX_DB_WRITE_MS,
+            'write_ms': write_ms,
+            'error': None,
+        }
+    
+    def _calendar_state(self) -> Dict:
+        """Состояние Google Calendar из памяти клиента (без обращения к API)"""
+        client = self.calendar_client
+        if client is None:
+            return {'enabled': False}
+        
+        metrics = client.get_metrics()
+        breaker = metrics['breaker']
+        return {
+            'enabled': True,
+            'authenticated': client.is_authenticated(),
+            'token_expiry': client.creds.expiry.isoformat() + 'Z' if client.creds and client.creds.expiry else None,
+            'breaker_state': breaker['state'],
+            'consecutive_failures': breaker['consecutive_failures'],
+            'retry_in_seconds': round(breaker['retry_in_seconds'], 1),
+            'stale_served': metrics['busy']['stale_served'],
+            'degraded': not client.is_authenticated() or breaker['state'] != CLOSED,
+        }
+    
+    def _is_live(self) -> bool:
+        # Монитор еще не успел сделать ни одного замера - считается живым
+        if self._last_tick is None:
+            return True
+        lag_ms = self._snapshot['loop_lag_ms'] or 0
+        overdue = time.monotonic() - self._last_tick > self.interval_seconds * 3
+        return not overdue and lag_ms <= config.HEALTH_MAX_LOOP_LAG_MS
+    
+    def liveness(self) -> Tuple[bool, Dict]:
+        live = self._is_live()
+        return live, {
+            'status': 'ok' if live else 'fail',
+            'uptime_seconds': round(time.time() - self.started_at),
+            'loop_lag_ms': self._snapshot['loop_lag_ms'],
+        }
+    
+    def readiness(self) -> Tuple[bool, Dict]:
+        database = self._snapshot['database']
+        ready = self._is_live() and database['ok'] is True
+        calendar = self._snapshot['calendar']
+        
+        if not ready:
+            status = 'fail'
+        elif calendar.get('degraded'):
+            status = 'degraded'
+        else:
+            status = 'ok'
+        return ready, dict(
+            self._snapshot,
+            status=status,
+            checked_seconds_ago=(round(time.monotonic() - self._last_tick, 1)
+                                 if self._last_tick is not None else None),
+        )
+    
+    # === HTTP ===
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки не нужны, но их надо дочитать
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+            if path == '/health/live':
+                ok, body = self.liveness()
+                code = 200 if ok else 503
+            elif path == '/health/ready':
+                ok, body = self.readiness()
+                code = 200 if ok else 503
+            else:
+                code, body = 404, {'status': 'not_found'}
+            
+            payload = json.dumps(body, ensure_ascii=False).encode()
+            reason = {200: 'OK', 404: 'Not Found', 503: 'Service Unavailable'}[code]
+            writer.write(
+                f"HTTP/1.1 {code} {reason}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Cache-Control: no-store\r\n"
+                f"Connection: close\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def start_server(self, host: str = config.HEALTH_HOST,
+                           port: int = config.HEALTH_PORT) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Health-эндпоинты: http://{host}:{port}/health/live, /health/ready")
+        return server
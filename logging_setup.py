@@ -0,0 +1,177 @@
+"""
+Неблокирующее логирование: записи кладутся в очередь, пишет их отдельный поток
+
+Обработчик корневого логгера только ставит запись в очередь (при
+переполнении запись отбрасывается и учитывается в счетчике), поэтому
+логирование не добавляет ввода-вывода в обработку обновления. Фоновый
+QueueListener пишет записи в stdout строками JSON.
+
+Поля обновления (update_id, user_id, handler) берутся из contextvars,
+которые выставляет обертка traced() на время работы обработчика.
+DEBUG-записи прореживаются (LOG_DEBUG_SAMPLE_RATE).
+"""
+import atexit
+import contextvars
+import copy
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import config
+
+
+CONTEXT_FIELDS = ('update_id', 'user_id', 'handler')
+EXTRA_FIELDS = CONTEXT_FIELDS + ('duration_ms',)
+
+_update_context: contextvars.ContextVar[Dict] = contextvars.ContextVar('update_context', default={})
+
+_queue: Optional[queue.Queue] = None
+_queue_handler: Optional['DroppingQueueHandler'] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога -> одна строка JSON"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class ContextFilter(logging.Filter):
+    """Добавить к записи поля текущего обновления (выполняется в потоке, создавшем запись)"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field, value in _update_context.get().items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускать только долю DEBUG-записей"""
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не ждет"""
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение фиксируется сразу (аргументы могут измениться), а traceback
+        # форматирует уже поток записи
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str = config.LOG_LEVEL, fmt: str = config.LOG_FORMAT):
+    """Настроить корневой логгер на запись через очередь (повторный вызов ничего не делает)"""
+    global _queue, _queue_handler, _listener
+    if _listener is not None:
+        return
+    
+    output = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    _queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(_queue)
+    _queue_handler.addFilter(SamplingFilter(config.LOG_DEBUG_SAMPLE_RATE))
+    _queue_handler.addFilter(ContextFilter())
+    
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    
+    # Запросы getUpdates логируются httpx на INFO при каждом опросе
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    _listener = logging.handlers.QueueListener(_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописать оставшиеся записи и остановить поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_queue_stats() -> Dict:
+    """Глубина очереди логов и число отброшенных записей"""
+    return {
+        'depth': _queue.qsize() if _queue else 0,
+        'dropped': _queue_handler.dropped if _queue_handler else 0,
+    }
+
+
+def traced(handler):
+    """
+    Обертка обработчика обновлений: поля update_id/user_id/handler в логах
+    и запись о длительности обработки
+    Ошибка обработчика пишется в лог здесь (с полями обновления) и дальше
+    не передается: иначе PTB записал бы ту же трассировку еще раз, уже без
+    полей. Как и при исключении, состояние диалога не меняется (None).
+    """
+    logger = logging.getLogger('updates')
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args):
+        user = getattr(update, 'effective_user', None)
+        token = _update_context.set({
+            'update_id': getattr(update, 'update_id', None),
+            'user_id': user.id if user else None,
+            'handler': handler.__name__,
+        })
+        started = time.perf_counter()
+        try:
+            return await handler(update, context, *args)
+        except Exception:
+            logger.exception("Ошибка обработки обновления")
+            return None
+        finally:
+            logger.info("Обновление обработано",
+                        extra={'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+            _update_context.reset(token)
+    
+    return wrapper
@@ -2,12 +2,25 @@
 """
 Скрипт управления PsyBooking Bot
 """
+import time
+_STARTED = time.perf_counter()  # До импортов: --timing показывает и их стоимость
+
 import sys
+import os
+import atexit
+import csv
+import json
+import asyncio
 import argparse
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
 import pytz
 from database import Database
 from scheduler import Scheduler
+from google_calendar import CalendarUnavailableError, get_calendar_client
+from stats import collect_stats, format_stats
+import backup
+import timefmt
 import config
 
 
@@ -53,52 +66,190 @@ def set_working_hours(day: int, start: str, end: str, active: bool = True):
     print(f"✅ Рабочие часы для {days[day]} обновлены: {start}-{end} ({status})")
 
 
-def show_bookings(future_only: bool = True):
-    """Показать записи"""
+def show_exceptions(show_all: bool = False):
+    """Показать исключения расписания (по умолчанию - текущие и будущие)"""
     db = Database()
+    today = datetime.now(pytz.timezone(config.PRIMARY_TZ)).date().isoformat()
+    exceptions = db.get_schedule_exceptions(None if show_all else today)
     
-    if future_only:
-        bookings = db.get_all_future_bookings()
-        print("\n📋 Будущие записи:")
-    else:
-        # Для показа всех записей нужно добавить метод в database.py
-        bookings = db.get_all_future_bookings()
-        print("\n📋 Все записи:")
+    print("\n🗓 Исключения расписания:")
+    print("-" * 60)
     
-    if not bookings:
-        print("Нет записей")
+    if not exceptions:
+        print("Нет исключений")
+    
+    for e in exceptions:
+        period = e['start_date'] if e['start_date'] == e['end_date'] else f"{e['start_date']} - {e['end_date']}"
+        rule = "❌ Закрыто" if e['kind'] == 'closed' else f"🕐 {e['start_time']}-{e['end_time']}"
+        note = f"  ({e['note']})" if e['note'] else ''
+        print(f"#{e['id']:<4} {period:25} {rule}{note}")
+    
+    print("-" * 60)
+
+
+def parse_date_range(date_from: str, date_to: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Проверить диапазон дат YYYY-MM-DD (date_to по умолчанию = date_from)"""
+    try:
+        start = datetime.strptime(date_from, '%Y-%m-%d').date()
+        end = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else start
+    except ValueError:
+        print("❌ Неверный формат даты. Используйте YYYY-MM-DD")
+        return None
+    
+    if end < start:
+        print("❌ Дата окончания раньше даты начала")
+        return None
+    return start.isoformat(), end.isoformat()
+
+
+def add_closed_period(date_from: str, date_to: Optional[str], note: Optional[str] = None):
+    """Закрыть запись на период (отпуск, праздник)"""
+    dates = parse_date_range(date_from, date_to)
+    if not dates:
         return
     
+    db = Database()
+    exception_id = db.add_schedule_exception(dates[0], dates[1], 'closed', note=note)
+    print(f"✅ Период {dates[0]} - {dates[1]} закрыт для записи (#{exception_id})")
+    
+    # Уже существующие записи исключение не отменяет
+    start_utc, end_utc = local_date_range_to_utc(*dates)
+    bookings = db.get_bookings_for_date_range(start_utc, end_utc)
+    if bookings:
+        print(f"⚠️ В этом периоде активных записей: {len(bookings)}. Отменить их: "
+              f"python3 manage.py bookings cancel-range --from {dates[0]} --to {dates[1]}")
+
+
+def add_custom_hours(date_from: str, date_to: Optional[str], start: str, end: str,
+                     note: Optional[str] = None):
+    """Особые рабочие часы на даты (вместо обычных, в том числе в выходной)"""
+    dates = parse_date_range(date_from, date_to)
+    if not dates:
+        return
+    
+    try:
+        start_time = datetime.strptime(start, '%H:%M').strftime('%H:%M')
+        end_time = datetime.strptime(end, '%H:%M').strftime('%H:%M')
+    except ValueError:
+        print("❌ Неверный формат времени. Используйте HH:MM")
+        return
+    
+    if end_time <= start_time:
+        print("❌ Время окончания должно быть позже времени начала")
+        return
+    
+    db = Database()
+    exception_id = db.add_schedule_exception(dates[0], dates[1], 'hours',
+                                             start_time, end_time, note)
+    print(f"✅ Рабочие часы на {dates[0]} - {dates[1]}: {start_time}-{end_time} (#{exception_id})")
+
+
+def delete_exception(exception_id: int):
+    """Удалить исключение расписания"""
+    db = Database()
+    if db.delete_schedule_exception(exception_id):
+        print(f"✅ Исключение #{exception_id} удалено")
+    else:
+        print(f"❌ Исключение #{exception_id} не найдено")
+
+
+def parse_cursor(value: str) -> Tuple[str, int]:
+    """Разобрать курсор страницы вида '<start_time_utc>,<id>'"""
+    start_time_utc, booking_id = value.rsplit(',', 1)
+    return start_time_utc, int(booking_id)
+
+
+def print_booking(booking: Dict, tz):
+    """Вывести одну запись"""
+    start_utc = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
+    start_local = start_utc.astimezone(tz)
+    
+    client_name = booking['client_first_name'] or 'Неизвестно'
+    if booking['client_last_name']:
+        client_name += f" {booking['client_last_name']}"
+    if booking['client_username']:
+        client_name += f" (@{booking['client_username']})"
+    
+    status_emoji = {
+        'pending': '⏳',
+        'confirmed': '✅',
+        'cancelled': '❌'
+    }.get(booking['status'], '❓')
+    
+    print(f"ID: {booking['id']}")
+    print(f"Клиент: {client_name}")
+    print(f"Telegram ID: {booking['client_telegram_id']}")
+    print(f"Дата/время: {start_local.strftime('%d.%m.%Y %H:%M')} (Минск)")
+    if booking['service_type']:
+        print(f"Услуга: {config.SERVICE_TYPES.get(booking['service_type'], {}).get('name', booking['service_type'])}")
+    print(f"Статус: {status_emoji} {booking['status']}")
+    if booking['google_event_id']:
+        print(f"Google Event ID: {booking['google_event_id']}")
+    if booking['event_link']:
+        print(f"Ссылка: {booking['event_link']}")
     print("-" * 80)
+
+
+def show_bookings(future_only: bool = True, page_size: Optional[int] = None,
+                  after: Optional[str] = None, statuses: Optional[list] = None,
+                  client_id: Optional[int] = None, date_from: Optional[str] = None,
+                  date_to: Optional[str] = None):
+    """
+    Показать записи
+    Без page_size выводит все подходящие записи, читая их страницами;
+    с page_size - одну страницу и курсор для следующей (--after).
+    Все записи (future_only=False) выводятся вместе с архивом.
+    """
+    db = Database()
+    
+    if page_size is not None and page_size <= 0:
+        print("❌ Размер страницы должен быть больше нуля")
+        return
+    
+    try:
+        start_utc, end_utc = local_date_range_to_utc(date_from, date_to)
+        cursor = parse_cursor(after) if after else None
+    except ValueError:
+        print("❌ Неверный формат даты или курсора")
+        return
+    
+    if future_only:
+        statuses = statuses or ['pending', 'confirmed']
+        now_utc = datetime.now(pytz.utc).replace(microsecond=0).isoformat()
+        start_utc = max(start_utc, now_utc) if start_utc else now_utc
+        print("\n📋 Будущие записи:")
+    else:
+        print("\n📋 Все записи (включая архив):")
     
     tz = pytz.timezone(config.PRIMARY_TZ)
+    limit = page_size or 200
+    shown = 0
     
-    for booking in bookings:
-        start_utc = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
-        start_local = start_utc.astimezone(tz)
+    while True:
+        page = db.list_bookings(limit, cursor, statuses, client_id, start_utc, end_utc,
+                                include_history=not future_only)
+        
+        if page and shown == 0:
+            print("-" * 80)
         
-        client_name = booking['client_first_name'] or 'Неизвестно'
-        if booking['client_last_name']:
-            client_name += f" {booking['client_last_name']}"
-        if booking['client_username']:
-            client_name += f" (@{booking['client_username']})"
+        for booking in page:
+            print_booking(booking, tz)
         
-        status_emoji = {
-            'pending': '⏳',
-            'confirmed': '✅',
-            'cancelled': '❌'
-        }.get(booking['status'], '❓')
+        shown += len(page)
         
-        print(f"ID: {booking['id']}")
-        print(f"Клиент: {client_name}")
-        print(f"Telegram ID: {booking['client_telegram_id']}")
-        print(f"Дата/время: {start_local.strftime('%d.%m.%Y %H:%M')} (Минск)")
-        print(f"Статус: {status_emoji} {booking['status']}")
-        if booking['google_event_id']:
-            print(f"Google Event ID: {booking['google_event_id']}")
-        if booking['event_link']:
-            print(f"Ссылка: {booking['event_link']}")
-        print("-" * 80)
+        if page:
+            last = page[-1]
+            cursor = (last['start_time_utc'], last['id'])
+        
+        if len(page) < limit:
+            break
+        
+        if page_size:
+            print(f"Следующая страница: --after '{cursor[0]},{cursor[1]}'")
+            break
+    
+    if not shown:
+        print("Нет записей")
 
 
 def cancel_booking(booking_id: int):
@@ -116,17 +267,291 @@ def cancel_booking(booking_id: int):
     
     # Отменить в БД
     db.cancel_booking(booking_id)
+    print(f"✅ Запись {booking_id} отменена")
     
-    # TODO: Отменить событие в Google Calendar
-    # if booking['google_event_id']:
-    #     calendar_client = get_calendar_client()
-    #     calendar_client.delete_event(config.GOOGLE_CALENDAR_ID, booking['google_event_id'])
+    # Удалить событие из Google Calendar
+    deleted, failed = delete_calendar_events([booking])
+    if deleted:
+        print("🗓 Событие удалено из календаря")
+    elif failed:
+        print("⚠️ Событие в календаре не удалено, удалите его вручную")
     
-    print(f"✅ Запись {booking_id} отменена")
+    offer_to_waitlist(db, [booking])
 
 
-def show_available_slots(date_str: str = None):
-    """Показать доступные слоты на дату"""
+def offer_to_waitlist(db: Database, bookings: List[Dict]):
+    """Предложить освободившееся время подписчикам листа ожидания"""
+    # Импорт здесь по той же причине, что и в send_messages
+    import waitlist
+    from telegram import Bot
+    
+    offers = waitlist.offer_cancelled(db, bookings)
+    if not offers:
+        return
+    
+    tz = pytz.timezone(config.PRIMARY_TZ)
+    for hold in offers:
+        start = datetime.fromisoformat(hold['start_time_utc']).astimezone(tz)
+        print(f"🔔 {start.strftime('%d.%m.%Y %H:%M')} закреплено за подписчиком {hold['telegram_id']} "
+              f"до {datetime.fromisoformat(hold['expires_at']).astimezone(tz).strftime('%H:%M')}")
+    
+    if not config.TELEGRAM_BOT_TOKEN:
+        print("⚠️ TELEGRAM_BOT_TOKEN не установлен, подписчик не уведомлен")
+        return
+    
+    async def send():
+        async with Bot(config.TELEGRAM_BOT_TOKEN) as bot:
+            return await waitlist.send_offers(db, bot, offers)
+    
+    print(f"✉️ Предложений отправлено: {asyncio.run(send())}")
+
+
+def show_waitlist():
+    """Показать лист ожидания (подписки на сегодня и позже)"""
+    db = Database()
+    today = datetime.now(pytz.timezone(config.PRIMARY_TZ)).date()
+    entries = db.get_waitlist(today.isoformat())
+    
+    if not entries:
+        print("Лист ожидания пуст")
+        return
+    
+    print(f"\n🔔 Лист ожидания ({len(entries)}):")
+    print("-" * 80)
+    for entry in entries:
+        print(f"#{entry['id']:<5} {entry['date']} {entry['from_time']}-{entry['to_time']}  "
+              f"{entry['service_type']:<12} клиент {entry['telegram_id']}  (с {entry['created_at']})")
+    print("-" * 80)
+
+
+def delete_calendar_events(bookings: List[Dict]) -> Tuple[int, int]:
+    """
+    Удалить события записей из Google Calendar (batch-запросами)
+    Возвращает (удалено, не удалось удалить)
+    """
+    event_ids = [booking['google_event_id'] for booking in bookings if booking['google_event_id']]
+    if not event_ids:
+        return 0, 0
+    
+    calendar_client = get_calendar_client()
+    if not calendar_client.is_authenticated():
+        return 0, len(event_ids)
+    
+    results = calendar_client.delete_events(config.GOOGLE_CALENDAR_ID, event_ids)
+    deleted = sum(results.values())
+    return deleted, len(results) - deleted
+
+
+def cancellation_message(bookings: List[Dict], tz_name: str) -> str:
+    """Уведомление клиенту об отмене его записей"""
+    lines = ["❗ К сожалению, психолог не сможет провести консультацию, запись отменена:", ""]
+    for booking in bookings:
+        start_utc = datetime.fromisoformat(booking['start_time_utc'])
+        lines.append(f"📅 {timefmt.format_datetime(start_utc, tz_name)}")
+    lines += [
+        f"({timefmt.tz_label(tz_name)})",
+        "",
+        "Приносим извинения. Чтобы выбрать другое время, используйте /book"
+    ]
+    return '\n'.join(lines)
+
+
+async def send_messages(messages: List[Tuple[int, str]]) -> int:
+    """Отправить сообщения клиентам через бота, возвращает число отправленных"""
+    # Импорт здесь: python-telegram-bot нужен только для уведомлений,
+    # а его загрузка - заметная часть времени запуска любой команды
+    from telegram import Bot
+    from telegram.error import TelegramError
+    
+    sent = 0
+    async with Bot(config.TELEGRAM_BOT_TOKEN) as bot:
+        for chat_id, text in messages:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                sent += 1
+            except TelegramError as e:
+                print(f"⚠️ Не удалось уведомить {chat_id}: {e}")
+    return sent
+
+
+def notify_cancelled(db: Database, bookings: List[Dict]) -> int:
+    """Уведомить клиентов об отмене (одно сообщение на клиента)"""
+    by_client: Dict[int, List[Dict]] = {}
+    for booking in bookings:
+        by_client.setdefault(booking['client_telegram_id'], []).append(booking)
+    
+    messages = [
+        (client_id, cancellation_message(items, db.get_user_timezone(client_id) or config.PRIMARY_TZ))
+        for client_id, items in by_client.items()
+    ]
+    return asyncio.run(send_messages(messages))
+
+
+def cancel_range(date_from: str, date_to: str, notify: bool = True, close: bool = True):
+    """
+    Отменить все активные записи за период (болезнь, праздник)
+    close - сначала закрыть период для записи (исключение 'closed'),
+    иначе освободившееся время сразу снова доступно клиентам.
+    """
+    dates = parse_date_range(date_from, date_to)
+    if not dates:
+        return
+    
+    db = Database()
+    start_utc, end_utc = local_date_range_to_utc(*dates)
+    
+    if close:
+        exception_id = db.add_schedule_exception(dates[0], dates[1], 'closed', note='Отмена записей')
+        print(f"✅ Период {dates[0]} - {dates[1]} закрыт для записи (#{exception_id})")
+    
+    bookings = db.cancel_bookings_in_range(start_utc, end_utc)
+    if not bookings:
+        print("Нет активных записей за этот период")
+        return
+    
+    tz = pytz.timezone(config.PRIMARY_TZ)
+    print(f"\n❌ Отменено записей: {len(bookings)}")
+    print("-" * 80)
+    for booking in bookings:
+        print_booking(booking, tz)
+    
+    deleted, failed = delete_calendar_events(bookings)
+    if deleted or failed:
+        print(f"🗓 Событий удалено из календаря: {deleted}")
+    if failed:
+        print(f"⚠️ Не удалось удалить событий: {failed}, удалите их вручную")
+    
+    if not notify:
+        return
+    if not config.TELEGRAM_BOT_TOKEN:
+        print("⚠️ TELEGRAM_BOT_TOKEN не установлен, клиенты не уведомлены")
+        return
+    
+    sent = notify_cancelled(db, bookings)
+    print(f"✉️ Уведомлено клиентов: {sent}")
+
+
+EXPORT_FIELDS = ['id'] + list(Database.BOOKING_IMPORT_FIELDS) + ['updated_at']
+
+
+def local_date_range_to_utc(date_from: Optional[str],
+                            date_to: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Перевести диапазон локальных дат (YYYY-MM-DD, включительно) в границы UTC"""
+    tz = pytz.timezone(config.PRIMARY_TZ)
+    
+    def to_utc(date_str: str, days: int = 0) -> str:
+        day = datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=days)
+        return tz.localize(day).astimezone(pytz.utc).isoformat()
+    
+    start_utc = to_utc(date_from) if date_from else None
+    end_utc = to_utc(date_to, days=1) if date_to else None
+    return start_utc, end_utc
+
+
+def normalize_utc(value: str) -> str:
+    """Привести время к формату БД (ISO, UTC); время без зоны считается UTC"""
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.utc)
+    return dt.astimezone(pytz.utc).isoformat()
+
+
+def export_bookings(fmt: str, output: Optional[str], date_from: Optional[str] = None,
+                    date_to: Optional[str] = None, statuses: Optional[list] = None):
+    """Выгрузить записи в CSV или JSONL (потоково)"""
+    db = Database()
+    
+    try:
+        start_utc, end_utc = local_date_range_to_utc(date_from, date_to)
+    except ValueError:
+        print("❌ Неверный формат даты. Используйте YYYY-MM-DD", file=sys.stderr)
+        return
+    
+    out = open(output, 'w', encoding='utf-8', newline='') if output else sys.stdout
+    count = 0
+    
+    try:
+        bookings = db.iter_bookings(start_utc, end_utc, statuses)
+        
+        if fmt == 'csv':
+            writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for booking in bookings:
+                writer.writerow(booking)
+                count += 1
+        else:
+            for booking in bookings:
+                out.write(json.dumps(
+                    {field: booking[field] for field in EXPORT_FIELDS},
+                    ensure_ascii=False
+                ) + '\n')
+                count += 1
+    finally:
+        if output:
+            out.close()
+    
+    # Сводка в stderr, чтобы не смешиваться с данными при выводе в stdout
+    print(f"✅ Выгружено записей: {count}", file=sys.stderr)
+
+
+def read_import_rows(path: str, fmt: str, errors: list) -> Iterator[Dict]:
+    """Потоково прочитать строки файла импорта, пропуская некорректные"""
+    with open(path, encoding='utf-8', newline='') as f:
+        # JSONL разбирается построчно внутри try: плохая строка не прерывает импорт
+        records = csv.DictReader(f) if fmt == 'csv' else f
+        
+        for line_no, record in enumerate(records, start=1):
+            try:
+                if fmt != 'csv':
+                    if not record.strip():
+                        continue
+                    record = json.loads(record)
+                    if not isinstance(record, dict):
+                        raise ValueError('ожидается JSON-объект')
+                row = {field: record.get(field) or None for field in Database.BOOKING_IMPORT_FIELDS}
+                row['client_telegram_id'] = int(record['client_telegram_id'])
+                row['start_time_utc'] = normalize_utc(record['start_time_utc'])
+                row['end_time_utc'] = normalize_utc(record['end_time_utc'])
+                row['status'] = row['status'] or 'confirmed'
+                if not row['created_at']:
+                    row['created_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append((line_no, str(e)))
+                continue
+            yield row
+
+
+def import_bookings(path: str, fmt: Optional[str] = None, chunk_size: int = 500):
+    """Загрузить записи из CSV или JSONL"""
+    db = Database()
+    
+    if not os.path.exists(path):
+        print(f"❌ Файл не найден: {path}")
+        return
+    
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    
+    errors = []
+    result = db.import_bookings(read_import_rows(path, fmt, errors), chunk_size)
+    
+    print(f"✅ Импортировано записей: {result['inserted']}")
+    
+    if result['conflicts']:
+        print(f"⚠️ Конфликты (время уже занято): {len(result['conflicts'])}")
+        for start in result['conflicts'][:20]:
+            print(f"  {start}")
+        if len(result['conflicts']) > 20:
+            print(f"  ... и еще {len(result['conflicts']) - 20}")
+    
+    if errors:
+        print(f"❌ Некорректные строки: {len(errors)}")
+        for line_no, error in errors[:20]:
+            print(f"  строка {line_no}: {error}")
+
+
+def show_available_slots(date_str: str = None, service_type: Optional[str] = None):
+    """Показать доступные слоты на дату (по всем типам услуг или по одному)"""
     db = Database()
     scheduler = Scheduler(db)
     
@@ -144,19 +569,207 @@ def show_available_slots(date_str: str = None):
         date_obj = datetime.now(tz).date()
     
     print(f"\n🕐 Доступные слоты на {scheduler.format_date_local(date_obj)}:")
+    
+    slots_by_service = scheduler.get_available_slots_by_service(date_obj)
+    if service_type:
+        slots_by_service = {service_type: slots_by_service[service_type]}
+    
+    for key, slots in slots_by_service.items():
+        service = scheduler.get_service(key)
+        print("-" * 60)
+        print(f"{service['name']} ({service['duration']} мин)")
+        
+        if not slots:
+            print("  Нет доступных слотов")
+            continue
+        
+        for slot in slots:
+            print(f"  {slot['start_local']} - {slot['end_local']}")
+        
+        print(f"  Всего слотов: {len(slots)}")
+    
+    print("-" * 60)
+
+
+def archive(days: int = config.ARCHIVE_AFTER_DAYS):
+    """Перенести старые записи в архив и сжать БД"""
+    db = Database()
+    
+    print(f"\n🗄 Архивация записей старше {days} дней...")
+    result = db.archive_old_bookings(days)
+    
+    print("-" * 60)
+    print(f"Граница (UTC): {result['cutoff']}")
+    print(f"Перенесено в архив: {result['archived']}")
+    print(f"Удалено записей rate limit: {result['rate_limits_deleted']}")
+    print(f"Удалено устаревших подписок листа ожидания: {result['waitlist_deleted']}")
+    print(f"Освобождено страниц: {result['pages_reclaimed']} "
+          f"({result['bytes_reclaimed'] / 1024:.1f} КБ)")
+    print("-" * 60)
+
+
+def show_stats(date_from: Optional[str] = None, date_to: Optional[str] = None,
+               use_rollups: Optional[bool] = None, rebuild: bool = False):
+    """Показать статистику загрузки расписания"""
+    db = Database()
+    
+    tz = pytz.timezone(config.PRIMARY_TZ)
+    today = datetime.now(tz).date()
+    
+    try:
+        end_day = (datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else today) + timedelta(days=1)
+        start_day = (datetime.strptime(date_from, '%Y-%m-%d').date() if date_from
+                     else end_day - timedelta(days=config.STATS_DEFAULT_DAYS))
+    except ValueError:
+        print("❌ Неверный формат даты. Используйте YYYY-MM-DD")
+        return
+    
+    if rebuild:
+        db.clear_stats_rollups()
+    
+    stats = collect_stats(db, start_day, end_day, use_rollups)
+    
+    print()
+    print(format_stats(stats))
+
+
+def show_availability(days: int = 90):
+    """Показать свободное время по дням (тепловая карта) и первый свободный слот"""
+    db = Database()
+    scheduler = Scheduler(db)
+    
+    tz = pytz.timezone(config.PRIMARY_TZ)
+    today = datetime.now(tz).date()
+    
+    service = scheduler.get_service()
+    grid = scheduler.build_availability_grid(today, days)
+    free_minutes = grid.free_minutes_by_day()
+    slot_counts = grid.count_by_day(
+        grid.slot_mask(service['duration'], buffer_minutes=service['buffer'])
+    )
+    
+    print(f"\n🗓 Свободное время на {days} дней:")
+    print("-" * 60)
+    
+    for day, minutes in free_minutes.items():
+        if not minutes:
+            continue
+        bar = '█' * (minutes // 60)
+        print(f"{scheduler.format_date_local(day):16} {bar:12} "
+              f"{minutes / 60:4.1f} ч, слотов: {slot_counts[day]}")
+    
+    print("-" * 60)
+    
+    first = grid.first_free(datetime.now(pytz.utc), service['duration'],
+                            buffer_minutes=service['buffer'])
+    if first:
+        print(f"Первый свободный слот: {first.astimezone(tz).strftime('%d.%m.%Y %H:%M')}")
+    else:
+        print("Свободных слотов нет")
+
+
+def run_reconcile(days: int = config.RECONCILE_DAYS_AHEAD, apply: bool = True):
+    """Сверить записи с Google Calendar и исправить расхождения"""
+    import reconcile
+    
+    db = Database()
+    calendar_client = get_calendar_client()
+    if not calendar_client.is_authenticated():
+        print("❌ Google Calendar не подключен")
+        return
+    
+    print(f"\n🔄 Сверка записей с календарем на {days} дней вперед"
+          f"{'' if apply else ' (без исправлений)'}...")
+    try:
+        result = reconcile.reconcile(db, calendar_client, days, apply)
+    except CalendarUnavailableError as e:
+        print(f"❌ {e}")
+        return
+    
+    print("-" * 60)
+    print(reconcile.format_report(result))
+    print("-" * 60)
+
+
+def create_backup(backup_dir: str, keep: int):
+    """Снять резервную копию БД"""
+    print(f"\n💾 Резервная копия {config.DATABASE_PATH}...")
+    result = backup.create_backup(config.DATABASE_PATH, backup_dir, keep)
+    
+    print("-" * 60)
+    print(f"Файл: {result['path']}")
+    print(f"Размер: {result['size'] / 1024:.1f} КБ ({result['pages']} страниц БД)")
+    print(f"SHA-256: {result['sha256']}")
+    print(f"Время: {result['seconds']} с")
+    print(f"Удалено старых копий: {result['removed']}")
+    print("-" * 60)
+
+
+def show_backups(backup_dir: str):
+    """Показать резервные копии и результат проверки контрольных сумм"""
+    backups = backup.list_backups(backup_dir)
+    if not backups:
+        print(f"📭 Резервных копий в {backup_dir} нет")
+        return
+    
+    print(f"\n💾 Резервные копии ({backup_dir}):")
+    print("-" * 60)
+    for path in backups:
+        status = "✅" if backup.verify_backup(path) else "❌ контрольная сумма"
+        print(f"{os.path.basename(path)}  {os.path.getsize(path) / 1024:.1f} КБ  {status}")
     print("-" * 60)
+
+
+def restore_backup(path: str, yes: bool = False):
+    """Восстановить БД из резервной копии"""
+    if not os.path.exists(path):
+        print(f"❌ Файл {path} не найден")
+        return
     
-    slots = scheduler.get_available_slots(date_obj)
+    if not yes:
+        print(f"⚠️ БД {config.DATABASE_PATH} будет заменена копией {path}.")
+        print("Остановите бота перед восстановлением.")
+        if input("Продолжить? [y/N] ").strip().lower() != 'y':
+            print("Отменено")
+            return
     
-    if not slots:
-        print("Нет доступных слотов")
+    try:
+        result = backup.restore_backup(path, config.DATABASE_PATH)
+    except ValueError as e:
+        print(f"❌ {e}")
         return
     
-    for slot in slots:
-        print(f"  {slot['start_local']} - {slot['end_local']}")
+    print(f"✅ БД восстановлена из {path}")
+    if result['previous']:
+        print(f"Прежняя БД сохранена как {result['previous']}")
+
+
+def check_indexes() -> bool:
+    """Проверить, что частые запросы используют свои индексы (EXPLAIN QUERY PLAN)"""
+    db = Database()
+    results = db.check_hot_queries()
     
+    print("\n🔎 Планы частых запросов:")
+    print("-" * 60)
+    for result in results:
+        mark = "✅" if result['ok'] else "❌"
+        print(f"{mark} {result['name']} (ожидается {result['expected_index']})")
+        for line in result['plan'].splitlines():
+            print(f"     {line}")
     print("-" * 60)
-    print(f"Всего слотов: {len(slots)}")
+    
+    failed = [result['name'] for result in results if not result['ok']]
+    if failed:
+        print(f"❌ Без нужного индекса: {', '.join(failed)}")
+    else:
+        print("✅ Все запросы используют свои индексы")
+    return not failed
+
+
+def explain_query(sql: str):
+    """Показать план выполнения произвольного запроса"""
+    db = Database()
+    print(db.explain_query(sql))
 
 
 def show_settings():
@@ -175,8 +788,25 @@ def show_settings():
     print("-" * 60)
 
 
+def start_timing():
+    """Замерить открытие БД и вывести время запуска при выходе"""
+    imported = time.perf_counter()
+    Database()
+    opened = time.perf_counter()
+    
+    def report():
+        finished = time.perf_counter()
+        print(f"\n⏱ Импорты: {(imported - _STARTED) * 1000:.1f} мс, "
+              f"открытие БД: {(opened - imported) * 1000:.1f} мс, "
+              f"команда: {(finished - opened) * 1000:.1f} мс", file=sys.stderr)
+    
+    atexit.register(report)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Управление PsyBooking Bot')
+    parser.add_argument('--timing', action='store_true',
+                        help='Показать время запуска: импорты, открытие БД, команда')
     subparsers = parser.add_subparsers(dest='command', help='Команды')
     
     # init
@@ -194,24 +824,139 @@ def main():
     wh_set.add_argument('end', help='Время окончания (HH:MM)')
     wh_set.add_argument('--inactive', action='store_true', help='Сделать день неактивным')
     
+    # exceptions
+    exceptions_parser = subparsers.add_parser('exceptions',
+                                              help='Исключения расписания (отпуск, особые часы)')
+    exceptions_subparsers = exceptions_parser.add_subparsers(dest='exceptions_command')
+    
+    exceptions_show = exceptions_subparsers.add_parser('show', help='Показать исключения')
+    exceptions_show.add_argument('--all', action='store_true', help='Включая прошедшие')
+    
+    exceptions_close = exceptions_subparsers.add_parser('close', help='Закрыть запись на период')
+    exceptions_close.add_argument('--from', dest='date_from', required=True, help='С даты (YYYY-MM-DD)')
+    exceptions_close.add_argument('--to', dest='date_to', help='По дату включительно (YYYY-MM-DD)')
+    exceptions_close.add_argument('--note', help='Комментарий')
+    
+    exceptions_hours = exceptions_subparsers.add_parser('hours', help='Особые рабочие часы на даты')
+    exceptions_hours.add_argument('--from', dest='date_from', required=True, help='С даты (YYYY-MM-DD)')
+    exceptions_hours.add_argument('--to', dest='date_to', help='По дату включительно (YYYY-MM-DD)')
+    exceptions_hours.add_argument('start', help='Время начала (HH:MM)')
+    exceptions_hours.add_argument('end', help='Время окончания (HH:MM)')
+    exceptions_hours.add_argument('--note', help='Комментарий')
+    
+    exceptions_delete = exceptions_subparsers.add_parser('delete', help='Удалить исключение')
+    exceptions_delete.add_argument('id', type=int, help='ID исключения')
+    
     # bookings
     bookings_parser = subparsers.add_parser('bookings', help='Управление записями')
     bookings_subparsers = bookings_parser.add_subparsers(dest='bookings_command')
     
-    bookings_subparsers.add_parser('show', help='Показать записи')
+    show_parser = bookings_subparsers.add_parser('show', help='Показать записи')
+    show_parser.add_argument('--all', action='store_true',
+                             help='Все записи, включая прошедшие, отмененные и архив')
+    show_parser.add_argument('--page-size', type=int, help='Показать одну страницу из N записей')
+    show_parser.add_argument('--after', help='Курсор страницы (выводится после страницы)')
+    show_parser.add_argument('--status', action='append',
+                             choices=['pending', 'confirmed', 'cancelled'],
+                             help='Статус (можно указать несколько раз)')
+    show_parser.add_argument('--client', type=int, help='Telegram ID клиента')
+    show_parser.add_argument('--from', dest='date_from', help='С даты (YYYY-MM-DD)')
+    show_parser.add_argument('--to', dest='date_to', help='По дату включительно (YYYY-MM-DD)')
     
     cancel_parser = bookings_subparsers.add_parser('cancel', help='Отменить запись')
     cancel_parser.add_argument('id', type=int, help='ID записи')
     
+    cancel_range_parser = bookings_subparsers.add_parser('cancel-range',
+                                                         help='Отменить все записи за период')
+    cancel_range_parser.add_argument('--from', dest='date_from', required=True,
+                                     help='С даты (YYYY-MM-DD)')
+    cancel_range_parser.add_argument('--to', dest='date_to', required=True,
+                                     help='По дату включительно (YYYY-MM-DD)')
+    cancel_range_parser.add_argument('--no-notify', action='store_true',
+                                     help='Не уведомлять клиентов')
+    cancel_range_parser.add_argument('--keep-open', action='store_true',
+                                     help='Не закрывать период для новых записей')
+    
+    bookings_subparsers.add_parser('waitlist', help='Показать лист ожидания')
+    
+    export_parser = bookings_subparsers.add_parser('export', help='Выгрузить записи')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help='Формат')
+    export_parser.add_argument('--output', '-o', help='Файл (по умолчанию stdout)')
+    export_parser.add_argument('--from', dest='date_from', help='С даты (YYYY-MM-DD)')
+    export_parser.add_argument('--to', dest='date_to', help='По дату включительно (YYYY-MM-DD)')
+    export_parser.add_argument('--status', action='append',
+                               choices=['pending', 'confirmed', 'cancelled'],
+                               help='Статус (можно указать несколько раз)')
+    
+    import_parser = bookings_subparsers.add_parser('import', help='Загрузить записи')
+    import_parser.add_argument('file', help='Файл CSV или JSONL')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'],
+                               help='Формат (по умолчанию по расширению файла)')
+    import_parser.add_argument('--chunk-size', type=int, default=500,
+                               help='Размер пачки (строк на транзакцию)')
+    
     # slots
     slots_parser = subparsers.add_parser('slots', help='Показать доступные слоты')
     slots_parser.add_argument('--date', help='Дата (YYYY-MM-DD), по умолчанию сегодня')
+    slots_parser.add_argument('--service', choices=list(config.SERVICE_TYPES),
+                              help='Тип услуги (по умолчанию все)')
+    
+    # availability
+    availability_parser = subparsers.add_parser('availability',
+                                                help='Свободное время по дням на горизонт')
+    availability_parser.add_argument('--days', type=int, default=90, help='Горизонт в днях')
     
     # settings
     subparsers.add_parser('settings', help='Показать настройки')
     
+    # stats
+    stats_parser = subparsers.add_parser('stats', help='Статистика загрузки расписания')
+    stats_parser.add_argument('--from', dest='date_from',
+                              help=f'С даты (YYYY-MM-DD), по умолчанию {config.STATS_DEFAULT_DAYS} дней назад')
+    stats_parser.add_argument('--to', dest='date_to', help='По дату включительно (YYYY-MM-DD)')
+    rollups_group = stats_parser.add_mutually_exclusive_group()
+    rollups_group.add_argument('--rollups', dest='use_rollups', action='store_true', default=None,
+                               help='Использовать кэш дневных агрегатов')
+    rollups_group.add_argument('--no-rollups', dest='use_rollups', action='store_false',
+                               help='Считать только по таблицам записей')
+    stats_parser.add_argument('--rebuild', action='store_true', help='Пересчитать кэш агрегатов')
+    
+    # archive
+    archive_parser = subparsers.add_parser('archive', help='Перенести старые записи в архив')
+    archive_parser.add_argument('--days', type=int, default=config.ARCHIVE_AFTER_DAYS,
+                                help=f'Возраст записей в днях (по умолчанию {config.ARCHIVE_AFTER_DAYS})')
+    
+    # reconcile
+    reconcile_parser = subparsers.add_parser('reconcile', help='Сверить записи с Google Calendar')
+    reconcile_parser.add_argument('--days', type=int, default=config.RECONCILE_DAYS_AHEAD,
+                                  help=f'Горизонт в днях (по умолчанию {config.RECONCILE_DAYS_AHEAD})')
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения')
+    
+    # db
+    db_parser = subparsers.add_parser('db', help='Диагностика запросов к БД')
+    db_subparsers = db_parser.add_subparsers(dest='db_command')
+    db_subparsers.add_parser('indexes', help='Проверить индексы частых запросов')
+    db_explain = db_subparsers.add_parser('explain', help='План выполнения запроса')
+    db_explain.add_argument('sql', help='SQL-запрос (без параметров)')
+    
+    # backup
+    backup_parser = subparsers.add_parser('backup', help='Резервная копия БД')
+    backup_parser.add_argument('--dir', default=config.BACKUP_DIR,
+                               help=f'Каталог копий (по умолчанию {config.BACKUP_DIR})')
+    backup_parser.add_argument('--keep', type=int, default=config.BACKUP_KEEP,
+                               help=f'Сколько последних копий хранить (по умолчанию {config.BACKUP_KEEP})')
+    backup_parser.add_argument('--list', action='store_true', help='Показать копии и проверить их')
+    
+    # restore
+    restore_parser = subparsers.add_parser('restore', help='Восстановить БД из резервной копии')
+    restore_parser.add_argument('file', help='Файл копии (.db.gz)')
+    restore_parser.add_argument('--yes', action='store_true', help='Не спрашивать подтверждение')
+    
     args = parser.parse_args()
     
+    if args.timing:
+        start_timing()
+    
     if args.command == 'init':
         init_db()
     
@@ -223,20 +968,71 @@ def main():
         else:
             wh_parser.print_help()
     
+    elif args.command == 'exceptions':
+        if args.exceptions_command == 'show':
+            show_exceptions(args.all)
+        elif args.exceptions_command == 'close':
+            add_closed_period(args.date_from, args.date_to, args.note)
+        elif args.exceptions_command == 'hours':
+            add_custom_hours(args.date_from, args.date_to, args.start, args.end, args.note)
+        elif args.exceptions_command == 'delete':
+            delete_exception(args.id)
+        else:
+            exceptions_parser.print_help()
+    
     elif args.command == 'bookings':
         if args.bookings_command == 'show':
-            show_bookings()
+            show_bookings(not args.all, args.page_size, args.after, args.status,
+                          args.client, args.date_from, args.date_to)
         elif args.bookings_command == 'cancel':
             cancel_booking(args.id)
+        elif args.bookings_command == 'cancel-range':
+            cancel_range(args.date_from, args.date_to, not args.no_notify, not args.keep_open)
+        elif args.bookings_command == 'waitlist':
+            show_waitlist()
+        elif args.bookings_command == 'export':
+            export_bookings(args.format, args.output, args.date_from, args.date_to, args.status)
+        elif args.bookings_command == 'import':
+            import_bookings(args.file, args.format, args.chunk_size)
         else:
             bookings_parser.print_help()
     
     elif args.command == 'slots':
-        show_available_slots(args.date)
+        show_available_slots(args.date, args.service)
+    
+    elif args.command == 'availability':
+        show_availability(args.days)
     
     elif args.command == 'settings':
         show_settings()
     
+    elif args.command == 'stats':
+        show_stats(args.date_from, args.date_to, args.use_rollups, args.rebuild)
+    
+    elif args.command == 'archive':
+        archive(args.days)
+    
+    elif args.command == 'reconcile':
+        run_reconcile(args.days, not args.dry_run)
+    
+    elif args.command == 'db':
+        if args.db_command == 'indexes':
+            if not check_indexes():
+                sys.exit(1)
+        elif args.db_command == 'explain':
+            explain_query(args.sql)
+        else:
+            db_parser.print_help()
+    
+    elif args.command == 'backup':
+        if args.list:
+            show_backups(args.dir)
+        else:
+            create_backup(args.dir, args.keep)
+    
+    elif args.command == 'restore':
+        restore_backup(args.file, args.yes)
+    
     else:
         parser.print_help()
 
@@ -0,0 +1,232 @@
+"""
+Сверка записей с Google Calendar
+
+Записи и календарь могут разойтись: событие не создалось (запись осталась
+pending), психолог удалил или передвинул событие вручную, отмена или
+перенос не дошли до Google. Сверка за горизонт RECONCILE_DAYS_AHEAD:
+
+1. все события периода, включая удаленные, - постраничным events.list
+   с маской полей (одна страница - до 2500 событий);
+2. записи того же периода - одним запросом к БД;
+3. сопоставление в памяти через словарь событий по google_event_id;
+4. однозначные расхождения исправляются: записи без события привязываются
+   к уже созданному событию с их booking_id в extendedProperties.private
+   (создание, ответ на которое не дошел), иначе событие создается; записи
+   подтверждаются одной транзакцией, события отмененных записей
+   удаляются batch-запросами, событие переносится, если запись изменена
+   позже события;
+5. остальное (событие удалено или перенесено в календаре) попадает в
+   отчет - решение за психологом.
+"""
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+import config
+import timefmt
+from database import Database
+from google_calendar import GoogleCalendarClient
+
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('pending', 'confirmed')
+
+# Вид расхождения -> (описание, исправляется ли автоматически)
+KINDS = {
+    'no_event': ('Нет события в календаре', True),
+    'cancelled_event_active': ('Запись отменена, событие осталось', True),
+    'booking_moved': ('Запись перенесена, событие - нет', True),
+    'event_missing': ('Событие удалено из календаря или перенесено за горизонт', False),
+    'event_moved': ('Событие перенесено в календаре', False),
+}
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    """Время из БД или API -> datetime UTC (CURRENT_TIMESTAMP SQLite - без пояса, это UTC)"""
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return dt.astimezone(timezone.utc) if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _issue(kind: str, booking: Dict, event: Optional[Dict] = None) -> Dict:
+    return {
+        'kind': kind,
+        'booking_id': booking['id'],
+        'start_time_utc': booking['start_time_utc'],
+        'event_id': booking['google_event_id'] or None,
+        'event_start': event['start'].get('dateTime') if event and event.get('start') else None,
+        'repaired': None,
+    }
+
+
+def _event_booking_id(event: Dict) -> Optional[int]:
+    """booking_id, сохраненный ботом в extendedProperties.private события"""
+    value = event.get('extendedProperties', {}).get('private', {}).get('booking_id')
+    return int(value) if value and value.isdigit() else None
+
+
+def find_discrepancies(bookings: Iterable[Dict], events: Iterable[Dict],
+                       now: datetime) -> Tuple[List[Dict], Dict[int, Dict]]:
+    """
+    Сопоставить записи и события по google_event_id
+    Для записи без события ищется активное событие с ее booking_id -
+    оно попадает в расхождение no_event (event_id, event_link).
+    Возвращает (расхождения, записи с расхождениями по id).
+    """
+    events = list(events)
+    events_by_id = {event['id']: event for event in events}
+    events_by_booking = {}
+    for event in events:
+        booking_id = _event_booking_id(event)
+        if booking_id is not None and event.get('status') != 'cancelled':
+            events_by_booking[booking_id] = event
+    created_before = now - timedelta(minutes=config.RECONCILE_PENDING_GRACE_MINUTES)
+    
+    issues = []
+    affected = {}
+    for booking in bookings:
+        event_id = booking['google_event_id']
+        event = events_by_id.get(event_id) if event_id else None
+        event_active = event is not None and event.get('status') != 'cancelled'
+        issue = None
+        
+        if booking['status'] not in ACTIVE_STATUSES:
+            if event_active:
+                issue = _issue('cancelled_event_active', booking, event)
+        elif not event_id:
+            # Свежая pending-запись может еще создаваться ботом
+            created_at = _parse_time(booking['created_at'])
+            if created_at is None or created_at <= created_before:
+                event = events_by_booking.get(booking['id'])
+                issue = _issue('no_event', booking, event)
+                if event:
+                    issue['event_id'] = event['id']
+                    issue['event_link'] = event.get('htmlLink', '')
+        elif not event_active:
+            issue = _issue('event_missing', booking, event)
+        elif _parse_time(event['start'].get('dateTime')) != _parse_time(booking['start_time_utc']):
+            # Изменено позже - то и верно
+            booking_updated = _parse_time(booking['updated_at'])
+            event_updated = _parse_time(event.get('updated'))
+            if booking_updated and (event_updated is None or booking_updated > event_updated):
+                issue = _issue('booking_moved', booking, event)
+            else:
+                issue = _issue('event_moved', booking, event)
+        
+        if issue:
+            issues.append(issue)
+            affected[booking['id']] = booking
+    
+    return issues, affected
+
+
+def _event_text(booking: Dict) -> Tuple[str, str]:
+    """Название и описание события записи (как при записи через бота)"""
+    service = config.SERVICE_TYPES.get(booking['service_type'], config.SERVICE_TYPES[config.DEFAULT_SERVICE_TYPE])
+    client_name = ' '.join(filter(None, [booking['client_first_name'], booking['client_last_name']]))
+    client_name = client_name or str(booking['client_telegram_id'])
+    if booking['client_username']:
+        client_name += f" (@{booking['client_username']})"
+    
+    summary = f"{service['name']}: {client_name}"
+    description = (f"Клиент: {client_name}\nTelegram ID: {booking['client_telegram_id']}\n"
+                   f"Услуга: {service['name']}")
+    return summary, description
+
+
+def apply_repairs(db: Database, client: GoogleCalendarClient, issues: List[Dict],
+                  bookings: Dict[int, Dict], calendar_id: str = config.GOOGLE_CALENDAR_ID):
+    """Исправить расхождения, которые исправляются автоматически (отмечает repaired)"""
+    confirmed = []
+    to_delete = {}
+    
+    for issue in issues:
+        booking = bookings[issue['booking_id']]
+        start = _parse_time(booking['start_time_utc'])
+        end = _parse_time(booking['end_time_utc'])
+        
+        if issue['kind'] == 'no_event' and issue['event_id']:
+            # Событие уже создано - только привязать
+            issue['repaired'] = True
+            confirmed.append((booking['id'], issue['event_id'], issue['event_link']))
+        
+        elif issue['kind'] == 'no_event':
+            summary, description = _event_text(booking)
+            result = client.create_event(calendar_id, summary, description, start, end,
+                                         booking_id=booking['id'])
+            issue['repaired'] = result is not None
+            if result:
+                issue['event_id'] = result['event_id']
+                confirmed.append((booking['id'], result['event_id'], result['event_link']))
+        
+        elif issue['kind'] == 'booking_moved':
+            issue['repaired'] = client.move_event(calendar_id, issue['event_id'], start, end) is not None
+        
+        elif issue['kind'] == 'cancelled_event_active':
+            to_delete[issue['event_id']] = issue
+    
+    # Удаления - batch-запросами, подтверждения записей - одной транзакцией
+    if to_delete:
+        for event_id, deleted in client.delete_events(calendar_id, list(to_delete)).items():
+            to_delete[event_id]['repaired'] = deleted
+    if confirmed:
+        db.update_bookings_with_google_events(confirmed)
+
+
+def reconcile(db: Database, client: GoogleCalendarClient,
+              days_ahead: int = config.RECONCILE_DAYS_AHEAD, apply: bool = True,
+              calendar_id: str = config.GOOGLE_CALENDAR_ID) -> Dict:
+    """
+    Сверить записи, начинающиеся в ближайшие days_ahead дней, с календарем
+    apply=False - только отчет. Недоступный календарь -
+    CalendarUnavailableError (по неполному списку событий не сверяем).
+    Возвращает bookings, events, issues, counts, repaired, seconds.
+    """
+    started = time.monotonic()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    end = now + timedelta(days=days_ahead)
+    
+    events = client.list_events(calendar_id, now, end)
+    bookings = list(db.iter_bookings(now.isoformat(), end.isoformat()))
+    issues, affected = find_discrepancies(bookings, events, now)
+    
+    if apply and issues:
+        apply_repairs(db, client, issues, affected, calendar_id)
+    
+    return {
+        'bookings': len(bookings),
+        'events': len(events),
+        'issues': issues,
+        'counts': dict(Counter(issue['kind'] for issue in issues)),
+        'repaired': sum(1 for issue in issues if issue['repaired']),
+        'seconds': round(time.monotonic() - started, 2),
+    }
+
+
+def format_issue(issue: Dict, tz_name: str = config.PRIMARY_TZ) -> str:
+    """Строка отчета о расхождении"""
+    description, automatic = KINDS[issue['kind']]
+    if issue['repaired']:
+        state = 'исправлено'
+    elif issue['repaired'] is False:
+        state = 'не удалось исправить'
+    elif automatic:
+        state = 'будет исправлено'
+    else:
+        state = 'нужно решение'
+    start = timefmt.format_datetime(_parse_time(issue['start_time_utc']), tz_name)
+    return f"#{issue['booking_id']} {start}: {description} - {state}"
+
+
+def format_report(result: Dict, tz_name: str = config.PRIMARY_TZ) -> str:
+    """Текстовый отчет сверки"""
+    lines = [
+        f"Записей: {result['bookings']}, событий: {result['events']}, "
+        f"расхождений: {len(result['issues'])}, исправлено: {result['repaired']} "
+        f"({result['seconds']} с)"
+    ]
+    lines.extend('  ' + format_issue(issue, tz_name) for issue in result['issues'])
+    return '\n'.join(lines)
@@ -0,0 +1,80 @@
+"""
+Индекс исключений расписания (отпуск, праздники, особые часы)
+
+Исключения могут пересекаться, поэтому при построении индекса они
+разрезаются на непересекающиеся отрезки дат с уже выбранным правилом:
+закрытый период важнее особых часов, из нескольких особых часов действуют
+добавленные позже. Правило на дату ищется бинарным поиском по началам
+отрезков - O(log n) без обращения к БД и календарю.
+"""
+from bisect import bisect_right
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def _priority(exception: Dict) -> Tuple[int, int]:
+    return (1 if exception['kind'] == 'closed' else 0, exception['id'])
+
+
+class ExceptionIndex:
+    def __init__(self, exceptions: Iterable[Dict] = ()):
+        # Отрезки [starts[i], ends[i]) с правилом rules[i], по возрастанию
+        self.starts: List[date] = []
+        self.ends: List[date] = []
+        self.rules: List[Dict] = []
+        self._build(list(exceptions))
+    
+    def _build(self, exceptions: List[Dict]):
+        intervals = sorted((
+            (date.fromisoformat(e['start_date']),
+             date.fromisoformat(e['end_date']) + timedelta(days=1),
+             e)
+            for e in exceptions
+            if e['start_date'] <= e['end_date']
+        ), key=lambda interval: interval[0])
+        boundaries = sorted({start for start, _, _ in intervals} | {end for _, end, _ in intervals})
+        
+        active = []
+        next_interval = 0
+        for i, boundary in enumerate(boundaries[:-1]):
+            while next_interval < len(intervals) and intervals[next_interval][0] <= boundary:
+                active.append(intervals[next_interval])
+                next_interval += 1
+            active = [interval for interval in active if interval[1] > boundary]
+            if not active:
+                continue
+            
+            rule = max((interval[2] for interval in active), key=_priority)
+            segment_end = boundaries[i + 1]
+            
+            # Соседние отрезки с тем же правилом объединяются
+            if self.rules and self.rules[-1] is rule and self.ends[-1] == boundary:
+                self.ends[-1] = segment_end
+            else:
+                self.starts.append(boundary)
+                self.ends.append(segment_end)
+                self.rules.append(rule)
+    
+    def __len__(self) -> int:
+        return len(self.starts)
+    
+    def get(self, day: date) -> Optional[Dict]:
+        """Действующее на дату исключение (None - обычное расписание)"""
+        i = bisect_right(self.starts, day) - 1
+        if i >= 0 and day < self.ends[i]:
+            return self.rules[i]
+        return None
+    
+    def working_hours(self, day: date, regular: Optional[Dict]) -> Optional[Tuple[str, str]]:
+        """
+        Рабочие часы на дату с учетом исключений: ('HH:MM', 'HH:MM') или None
+        regular - рабочие часы дня недели из working_hours (или None)
+        """
+        exception = self.get(day)
+        if exception is None:
+            if regular and regular['is_active']:
+                return regular['start_time'], regular['end_time']
+            return None
+        if exception['kind'] == 'closed':
+            return None
+        return exception['start_time'], exception['end_time']
@@ -6,7 +6,12 @@ from typing import List, Dict, Tuple, Optional
 import pytz
 import config
 from database import Database
-from google_calendar import get_calendar_client
+from google_calendar import get_calendar_client, CalendarUnavailableError
+from circuit_breaker import CLOSED
+from availability import AvailabilityGrid
+from schedule_exceptions import ExceptionIndex
+from singleflight import SingleFlight
+import timefmt
 
 
 class Scheduler:
@@ -14,150 +19,236 @@ class Scheduler:
         self.db = db
         self.calendar_client = get_calendar_client()
         self.primary_tz = pytz.timezone(config.PRIMARY_TZ)
+        self._exceptions = ExceptionIndex()
+        self._exceptions_version = None
+        # Одинаковые одновременные запросы доступности считаются один раз
+        self._flights = SingleFlight()
+        self._availability_version = 0
+        # Когда получены данные календаря, по которым построено последнее
+        # расписание (None - свежий ответ freebusy)
+        self._busy_fetched_at: Optional[datetime] = None
     
-    def get_available_slots(self, date: datetime.date, 
-                           calendar_id: str = config.GOOGLE_CALENDAR_ID) -> List[Dict]:
+    @staticmethod
+    def get_service(service_type: Optional[str] = None) -> Dict:
+        """Параметры типа услуги (по умолчанию - DEFAULT_SERVICE_TYPE)"""
+        key = service_type if service_type in config.SERVICE_TYPES else config.DEFAULT_SERVICE_TYPE
+        return dict(config.SERVICE_TYPES[key], key=key)
+    
+    def get_exception_index(self) -> ExceptionIndex:
         """
-        Получить доступные слоты для конкретной даты
-        Возвращает список словарей с ключами:
-        - start_utc: datetime
-        - end_utc: datetime
-        - start_local: str (форматированное время)
-        - end_local: str (форматированное время)
+        Индекс исключений расписания
+        Перестраивается, только если исключения изменились (в том числе
+        из manage.py в другом процессе) - проверка по версии в settings.
         """
-        # Получить рабочие часы для этого дня недели
-        day_of_week = date.weekday()  # 0=Пн, 6=Вс
-        # Конвертировать в формат БД (0=Вс, 1=Пн, ..., 6=Сб)
-        db_day_of_week = (day_of_week + 1) % 7
-        
-        working_hours = self.db.get_working_hours_for_day(db_day_of_week)
+        version = self.db.get_schedule_version()
+        if version != self._exceptions_version:
+            self._exceptions = ExceptionIndex(self.db.get_schedule_exceptions())
+            self._exceptions_version = version
+        return self._exceptions
+    
+    def _get_working_hours(self):
+        """Функция: дата -> рабочие часы ('HH:MM', 'HH:MM') или None с учетом исключений"""
+        # Рабочие часы по дням недели в формате БД (0=Вс, 1=Пн, ..., 6=Сб)
+        weekly = {wh['day_of_week']: wh for wh in self.db.get_working_hours()}
+        exceptions = self.get_exception_index()
+        return lambda day: exceptions.working_hours(day, weekly.get((day.weekday() + 1) % 7))
+    
+    def is_calendar_degraded(self) -> bool:
+        """Google Calendar сейчас недоступен (выключатель не закрыт)"""
+        return (self.calendar_client.is_authenticated() and
+                self.calendar_client.breaker.state != CLOSED)
+    
+    def calendar_data_age(self) -> Optional[timedelta]:
+        """
+        Возраст данных календаря в последнем построенном расписании
+        None - данные свежие. Пока Google Calendar недоступен, слоты строятся
+        по последнему сохраненному ответу freebusy.
+        """
+        fetched_at = self._busy_fetched_at
+        return None if fetched_at is None else datetime.now(pytz.utc) - fetched_at
+    
+    def _get_busy_intervals(self, start_utc: datetime, end_utc: datetime,
+                            calendar_id: str) -> Tuple[List[Tuple[datetime, datetime]], Optional[float]]:
+        """
+        Занятые интервалы из Google Calendar и из БД за период
+        Календарь запрашивается одним freebusy на каждые FREEBUSY_MAX_DAYS дней.
+        Возвращает (интервалы, возраст данных календаря в секундах или None).
+        Если данных календаря нет совсем, период считается занятым - лучше
+        не показать слоты, чем показать занятое время свободным.
+        """
+        busy_intervals = []
+        busy_age = None
+        if self.calendar_client.is_authenticated():
+            chunk = timedelta(days=config.FREEBUSY_MAX_DAYS)
+            chunk_start = start_utc
+            while chunk_start < end_utc:
+                chunk_end = min(chunk_start + chunk, end_utc)
+                try:
+                    intervals, age = self.calendar_client.get_busy(calendar_id, chunk_start, chunk_end)
+                except CalendarUnavailableError:
+                    intervals, age = [(chunk_start, chunk_end)], None
+                busy_intervals.extend(intervals)
+                if age is not None:
+                    busy_age = max(busy_age or 0, age)
+                chunk_start = chunk_end
         
-        if not working_hours or not working_hours['is_active']:
-            return []
+        db_bookings = self.db.get_bookings_for_date_range(
+            start_utc.isoformat(),
+            end_utc.isoformat()
+        )
         
-        # Парсить рабочие часы
-        start_time_str = working_hours['start_time']  # "10:00"
-        end_time_str = working_hours['end_time']      # "19:00"
+        for booking in db_bookings:
+            start = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
+            end = datetime.fromisoformat(booking['end_time_utc']).replace(tzinfo=pytz.utc)
+            # Перерыв после сессии тоже занят
+            buffer = config.SERVICE_TYPES.get(booking.get('service_type'), {}).get('buffer', 0)
+            busy_intervals.append((start, end + timedelta(minutes=buffer)))
         
-        start_hour, start_minute = map(int, start_time_str.split(':'))
-        end_hour, end_minute = map(int, end_time_str.split(':'))
+        # Время, придержанное для подписчика листа ожидания (он записывается
+        # по кнопке из уведомления, остальным это время не показывается)
+        for hold in self.db.get_slot_holds(start_utc.isoformat(), end_utc.isoformat()):
+            busy_intervals.append((
+                datetime.fromisoformat(hold['start_time_utc']).replace(tzinfo=pytz.utc),
+                datetime.fromisoformat(hold['end_time_utc']).replace(tzinfo=pytz.utc)
+            ))
         
-        # Создать datetime объекты в локальной timezone
-        work_start_local = self.primary_tz.localize(
-            datetime.combine(date, time(start_hour, start_minute))
-        )
-        work_end_local = self.primary_tz.localize(
-            datetime.combine(date, time(end_hour, end_minute))
-        )
+        return busy_intervals, busy_age
+    
+    def build_availability_grid(self, start_date: datetime.date, days: int,
+                                calendar_id: str = config.GOOGLE_CALENDAR_ID) -> AvailabilityGrid:
+        """
+        Построить сетку доступности на days дней начиная с start_date
+        Рабочие часы читаются из БД один раз, занятость - одним запросом
+        к календарю и одним к БД на весь горизонт.
+        """
+        grid = AvailabilityGrid(start_date, days, self.primary_tz)
+        working_hours = self._get_working_hours()
         
-        # Конвертировать в UTC для работы
-        work_start_utc = work_start_local.astimezone(pytz.utc)
-        work_end_utc = work_end_local.astimezone(pytz.utc)
+        for day, _, _ in grid.day_bounds:
+            hours = working_hours(day)
+            if not hours:
+                continue
+            
+            start_hour, start_minute = map(int, hours[0].split(':'))
+            end_hour, end_minute = map(int, hours[1].split(':'))
+            
+            work_start_local = self.primary_tz.localize(
+                datetime.combine(day, time(start_hour, start_minute))
+            )
+            work_end_local = self.primary_tz.localize(
+                datetime.combine(day, time(end_hour, end_minute))
+            )
+            grid.add_working_window(
+                day,
+                work_start_local.astimezone(pytz.utc),
+                work_end_local.astimezone(pytz.utc)
+            )
         
-        # Проверить минимальное время до записи
+        # Минимальное время до записи
         min_hours = int(self.db.get_setting('min_hours_before_booking') or 
                        config.MIN_HOURS_BEFORE_BOOKING)
-        now_utc = datetime.now(pytz.utc)
-        earliest_booking = now_utc + timedelta(hours=min_hours)
-        
-        if work_end_utc < earliest_booking:
-            # Весь рабочий день уже прошел или слишком близко
-            return []
-        
-        if work_start_utc < earliest_booking:
-            work_start_utc = earliest_booking
+        grid.block_before(datetime.now(pytz.utc) + timedelta(hours=min_hours))
         
-        # Сгенерировать все возможные слоты
-        session_duration = timedelta(minutes=config.SESSION_DURATION_MINUTES)
-        all_slots = []
-        
-        current_slot_start = work_start_utc
-        while current_slot_start + session_duration <= work_end_utc:
-            all_slots.append({
-                'start_utc': current_slot_start,
-                'end_utc': current_slot_start + session_duration
-            })
-            current_slot_start += session_duration
+        if not grid.free:
+            # Рабочие часы уже прошли или слишком близко - календарь не нужен
+            return grid
         
-        if not all_slots:
-            return []
+        # Запрашивать занятость только в пределах рабочих окон
+        busy_from = max(grid.windows[0][1], grid.not_before)
+        busy_to = grid.windows[-1][2]
+        busy_intervals, grid.busy_age = self._get_busy_intervals(
+            grid.cell_time(busy_from),
+            grid.cell_time(busy_to),
+            calendar_id
+        )
+        grid.add_busy(busy_intervals)
+        self._busy_fetched_at = (None if grid.busy_age is None
+                                 else datetime.now(pytz.utc) - timedelta(seconds=grid.busy_age))
         
-        # Получить занятые интервалы из Google Calendar
-        busy_intervals = []
-        if self.calendar_client.is_authenticated():
-            busy_intervals = self.calendar_client.get_busy_intervals(
-                calendar_id,
-                work_start_utc,
-                work_end_utc
-            )
+        return grid
+    
+    def _format_slot(self, start_utc: datetime, end_utc: datetime) -> Dict:
+        """Слот с временем для отображения (в PRIMARY_TZ)"""
+        return {
+            'start_utc': start_utc,
+            'end_utc': end_utc,
+            'start_local': timefmt.format_time(start_utc),
+            'end_local': timefmt.format_time(end_utc),
+            'start_local_full': timefmt.format_datetime(start_utc),
+            'end_local_full': timefmt.format_datetime(end_utc)
+        }
+    
+    def _service_slots(self, grid: AvailabilityGrid, service: Dict) -> List[Tuple[datetime, datetime]]:
+        """Слоты услуги по уже построенной сетке"""
+        return grid.slots(service['duration'], buffer_minutes=service['buffer'])
+    
+    def get_available_slots(self, date: datetime.date, 
+                           calendar_id: str = config.GOOGLE_CALENDAR_ID,
+                           service_type: Optional[str] = None) -> List[Dict]:
+        """
+        Получить доступные слоты для конкретной даты
+        Возвращает список словарей с ключами:
+        - start_utc: datetime
+        - end_utc: datetime
+        - start_local: str (форматированное время)
+        - end_local: str (форматированное время)
+        """
+        grid = self.build_availability_grid(date, 1, calendar_id)
         
-        # Получить занятые слоты из БД
-        db_bookings = self.db.get_bookings_for_date_range(
-            work_start_utc.isoformat(),
-            work_end_utc.isoformat()
-        )
+        return [
+            self._format_slot(start_utc, end_utc)
+            for start_utc, end_utc in self._service_slots(grid, self.get_service(service_type))
+        ]
+    
+    def get_available_slots_by_service(self, date: datetime.date,
+                                       calendar_id: str = config.GOOGLE_CALENDAR_ID) -> Dict[str, List[Dict]]:
+        """
+        Доступные слоты на дату для всех типов услуг
+        Свободное время дня считается один раз (один запрос freebusy),
+        слоты каждой услуги выводятся из той же сетки.
+        """
+        grid = self.build_availability_grid(date, 1, calendar_id)
         
-        for booking in db_bookings:
-            start = datetime.fromisoformat(booking['start_time_utc']).replace(tzinfo=pytz.utc)
-            end = datetime.fromisoformat(booking['end_time_utc']).replace(tzinfo=pytz.utc)
-            busy_intervals.append((start, end))
-        
-        # Отфильтровать занятые слоты
-        available_slots = []
-        for slot in all_slots:
-            if not self._is_slot_busy(slot, busy_intervals):
-                # Конвертировать обратно в локальное время для отображения
-                start_local = slot['start_utc'].astimezone(self.primary_tz)
-                end_local = slot['end_utc'].astimezone(self.primary_tz)
-                
-                available_slots.append({
-                    'start_utc': slot['start_utc'],
-                    'end_utc': slot['end_utc'],
-                    'start_local': start_local.strftime('%H:%M'),
-                    'end_local': end_local.strftime('%H:%M'),
-                    'start_local_full': start_local.strftime('%d.%m.%Y %H:%M'),
-                    'end_local_full': end_local.strftime('%d.%m.%Y %H:%M')
-                })
-        
-        return available_slots
-    
-    def _is_slot_busy(self, slot: Dict, busy_intervals: List[Tuple[datetime, datetime]]) -> bool:
-        """Проверить, занят ли слот"""
-        slot_start = slot['start_utc']
-        slot_end = slot['end_utc']
-        
-        for busy_start, busy_end in busy_intervals:
-            # Проверка на пересечение интервалов
-            if self._intervals_overlap(slot_start, slot_end, busy_start, busy_end):
-                return True
-        
-        return False
-    
-    def _intervals_overlap(self, start1: datetime, end1: datetime, 
-                          start2: datetime, end2: datetime) -> bool:
-        """Проверить пересечение двух интервалов"""
-        return start1 < end2 and start2 < end1
+        return {
+            key: [
+                self._format_slot(start_utc, end_utc)
+                for start_utc, end_utc in self._service_slots(grid, self.get_service(key))
+            ]
+            for key in config.SERVICE_TYPES
+        }
     
     def get_available_dates(self, days_ahead: int = config.DAYS_AHEAD_TO_SHOW) -> List[datetime.date]:
         """
         Получить список дат, на которые можно записаться
-        (дни с активными рабочими часами)
+        (дни с рабочими часами с учетом исключений расписания)
         """
         available_dates = []
         today = datetime.now(self.primary_tz).date()
-        
-        working_hours = self.db.get_working_hours()
-        active_days = {wh['day_of_week'] for wh in working_hours if wh['is_active']}
+        working_hours = self._get_working_hours()
         
         for i in range(days_ahead):
             check_date = today + timedelta(days=i)
-            day_of_week = (check_date.weekday() + 1) % 7  # Конвертировать в формат БД
-            
-            if day_of_week in active_days:
+            if working_hours(check_date):
                 available_dates.append(check_date)
         
         return available_dates
     
+    def get_free_slot_counts(self, days_ahead: int = config.DAYS_AHEAD_TO_SHOW,
+                             service_type: Optional[str] = None) -> Dict[datetime.date, int]:
+        """
+        Число свободных слотов услуги по датам горизонта (только даты со слотами)
+        Считается за один проход по сетке всего горизонта: один запрос
+        freebusy вместо get_available_slots на каждую дату.
+        """
+        service = self.get_service(service_type)
+        today = datetime.now(self.primary_tz).date()
+        grid = self.build_availability_grid(today, days_ahead)
+        
+        counts = grid.count_by_day(
+            grid.slot_mask(service['duration'], buffer_minutes=service['buffer'])
+        )
+        return {day: count for day, count in counts.items() if count}
+    
     def format_date_local(self, date: datetime.date) -> str:
         """Форматировать дату для отображения"""
         dt = datetime.combine(date, time(0, 0))
@@ -169,20 +260,61 @@ class Scheduler:
         
         return f"{weekday_name}, {dt_local.strftime('%d.%m.%Y')}"
     
-    def get_next_available_slots(self, limit: int = 10) -> List[Dict]:
+    def get_next_available_slots(self, limit: int = 10,
+                                 service_type: Optional[str] = None) -> List[Dict]:
         """
         Получить следующие доступные слоты (для быстрого просмотра)
         """
-        all_slots = []
-        dates = self.get_available_dates()
+        today = datetime.now(self.primary_tz).date()
+        grid = self.build_availability_grid(today, config.DAYS_AHEAD_TO_SHOW)
         
-        for date in dates:
-            slots = self.get_available_slots(date)
-            for slot in slots:
-                slot['date'] = date
-                all_slots.append(slot)
-                
-                if len(all_slots) >= limit:
-                    return all_slots
+        all_slots = []
+        for start_utc, end_utc in self._service_slots(grid, self.get_service(service_type))[:limit]:
+            slot = self._format_slot(start_utc, end_utc)
+            slot['date'] = timefmt.to_local(start_utc).date()
+            all_slots.append(slot)
         
         return all_slots
+    
+    # === Асинхронный доступ с объединением одинаковых запросов ===
+    
+    def invalidate_availability(self):
+        """
+        Занятость изменилась (создана или отменена запись)
+        Запросы после этого не присоединяются к вычислениям, начатым раньше.
+        """
+        self._availability_version += 1
+    
+    async def available_slots(self, date: datetime.date,
+                              service_type: Optional[str] = None) -> List[Dict]:
+        """
+        get_available_slots в отдельном потоке
+        Одновременные запросы на ту же дату (любых услуг) ждут одно
+        вычисление get_available_slots_by_service - один запрос freebusy.
+        """
+        by_service = await self._flights.run(
+            ('slots_by_service', date, self._availability_version),
+            self.get_available_slots_by_service, date
+        )
+        return by_service[self.get_service(service_type)['key']]
+    
+    async def free_slot_counts(self, service_type: Optional[str] = None) -> Dict[datetime.date, int]:
+        """get_free_slot_counts в отдельном потоке с объединением одинаковых запросов"""
+        key = self.get_service(service_type)['key']
+        today = datetime.now(self.primary_tz).date()
+        return await self._flights.run(
+            ('free_slot_counts', key, today, self._availability_version),
+            self.get_free_slot_counts, config.DAYS_AHEAD_TO_SHOW, key
+        )
+    
+    async def next_available_slots(self, limit: int = 10) -> List[Dict]:
+        """get_next_available_slots в отдельном потоке с объединением одинаковых запросов"""
+        today = datetime.now(self.primary_tz).date()
+        return await self._flights.run(
+            ('next_slots', limit, today, self._availability_version),
+            self.get_next_available_slots, limit
+        )
+    
+    def get_flight_metrics(self) -> Dict:
+        """Метрики объединения запросов доступности"""
+        return self._flights.get_metrics()
@@ -0,0 +1,46 @@
+"""
+Объединение одинаковых одновременных вычислений (singleflight)
+
+Пока вычисление по ключу выполняется, повторные вызовы с тем же ключом не
+запускают его заново, а ждут тот же результат. Это не кэш: после
+завершения следующий вызов вычисляет заново. Вычисление идет в отдельном
+потоке (asyncio.to_thread) и не блокирует event loop.
+
+Отмена одного ожидающего (например, обработчика обновления) не отменяет
+вычисление для остальных.
+"""
+import asyncio
+from typing import Any, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._counters = {'calls': 0, 'executions': 0, 'coalesced': 0}
+    
+    async def run(self, key: Hashable, fn: Callable[..., Any], *args) -> Any:
+        """Результат fn(*args); одновременные вызовы с тем же key ждут одно вычисление"""
+        self._counters['calls'] += 1
+        task = self._calls.get(key)
+        if task is None:
+            self._counters['executions'] += 1
+            task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self._counters['coalesced'] += 1
+        
+        # Результат общий для всех ожидающих - изменять его нельзя
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Ошибку получат ожидающие; если все они отменены, не предупреждать
+        # о неполученном исключении
+        if not task.cancelled():
+            task.exception()
+    
+    def get_metrics(self) -> Dict:
+        """Вызовы, реальные вычисления, присоединившиеся к уже идущим"""
+        return dict(self._counters, in_flight=len(self._calls))
@@ -0,0 +1,159 @@
+"""
+Модуль статистики загрузки расписания
+"""
+from datetime import datetime, date, timedelta
+from typing import Dict, List, Optional
+import pytz
+import config
+from database import Database
+
+
+WEEKDAY_NAMES = ['Вс', 'Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб']  # формат БД: 0=Вс
+
+
+def _weekday_counts(start_day: date, end_day: date) -> List[int]:
+    """Сколько раз каждый день недели (0=Вс) встречается в [start_day, end_day)"""
+    total_days = max((end_day - start_day).days, 0)
+    counts = [total_days // 7] * 7
+    first = (start_day.weekday() + 1) % 7  # Конвертировать в формат БД
+    for i in range(total_days % 7):
+        counts[(first + i) % 7] += 1
+    return counts
+
+
+def _minutes(time_str: str) -> int:
+    """'HH:MM' -> минуты от начала дня"""
+    hour, minute = map(int, time_str.split(':'))
+    return hour * 60 + minute
+
+
+def _capacity(db: Database, start_day: date, end_day: date) -> Dict:
+    """
+    Емкость расписания в минутах по дням недели и по часам
+    Считается по текущим рабочим часам и числу каждого дня недели в периоде
+    """
+    counts = _weekday_counts(start_day, end_day)
+    by_weekday = [0] * 7
+    by_hour = [0] * 24
+    
+    for wh in db.get_working_hours():
+        if not wh['is_active']:
+            continue
+        day = wh['day_of_week']
+        start, end = _minutes(wh['start_time']), _minutes(wh['end_time'])
+        by_weekday[day] = counts[day] * max(end - start, 0)
+        for hour in range(24):
+            overlap = min(end, (hour + 1) * 60) - max(start, hour * 60)
+            if overlap > 0:
+                by_hour[hour] += counts[day] * overlap
+    
+    return {'by_weekday': by_weekday, 'by_hour': by_hour}
+
+
+def collect_stats(db: Database, start_day: date, end_day: date,
+                  use_rollups: Optional[bool] = None) -> Dict:
+    """
+    Собрать статистику за локальные дни [start_day, end_day)
+    use_rollups: брать прошедшие дни из кэша агрегатов
+    (по умолчанию - для периодов длиннее STATS_ROLLUP_MIN_DAYS)
+    """
+    tz = pytz.timezone(config.PRIMARY_TZ)
+    now_utc = datetime.now(pytz.utc)
+    today = now_utc.astimezone(tz).date()
+    
+    # Europe/Minsk без перехода на летнее время - смещение постоянное
+    offset_minutes = int(now_utc.astimezone(tz).utcoffset().total_seconds() // 60)
+    
+    if use_rollups is None:
+        use_rollups = (end_day - start_day).days > config.STATS_ROLLUP_MIN_DAYS
+    
+    rollup_until = None
+    if use_rollups:
+        rollup_until = db.refresh_stats_rollups(
+            offset_minutes,
+            today.isoformat(),
+            tz.localize(datetime.combine(today, datetime.min.time())).astimezone(pytz.utc).isoformat()
+        )
+    
+    aggregates = db.get_booking_stats(start_day.isoformat(), end_day.isoformat(),
+                                      offset_minutes, rollup_until)
+    capacity = _capacity(db, start_day, end_day)
+    
+    def utilization(rows: List[Dict], key: str, capacity_list: List[int]) -> List[Dict]:
+        booked = {row[key]: row for row in rows}
+        result = []
+        for i, cap in enumerate(capacity_list):
+            row = booked.get(i, {})
+            minutes = row.get('booked_minutes') or 0
+            if not cap and not minutes:
+                continue
+            result.append({
+                key: i,
+                'bookings': row.get('bookings') or 0,
+                'booked_minutes': minutes,
+                'capacity_minutes': cap,
+                'utilization': minutes / cap if cap else None,
+            })
+        return result
+    
+    totals = aggregates['totals']
+    bookings = totals['bookings'] or 0
+    cancelled = totals['cancelled'] or 0
+    total_capacity = sum(capacity['by_weekday'])
+    
+    end_utc = tz.localize(datetime.combine(end_day, datetime.min.time())).astimezone(pytz.utc)
+    start_utc = tz.localize(datetime.combine(start_day, datetime.min.time())).astimezone(pytz.utc)
+    no_show_end = min(end_utc, now_utc).replace(microsecond=0)
+    
+    return {
+        'start_day': start_day,
+        'end_day': end_day,
+        'by_weekday': utilization(aggregates['by_weekday'], 'weekday', capacity['by_weekday']),
+        'by_hour': utilization(aggregates['by_hour'], 'hour', capacity['by_hour']),
+        'bookings': bookings,
+        'cancelled': cancelled,
+        'cancellation_rate': cancelled / bookings if bookings else None,
+        'utilization': (totals['booked_minutes'] / total_capacity) if total_capacity else None,
+        'avg_lead_hours': (totals['lead_hours_sum'] / totals['lead_count']) if totals['lead_count'] else None,
+        'no_show_candidates': db.get_no_show_candidates(start_utc.isoformat(), no_show_end.isoformat())
+                              if no_show_end > start_utc else [],
+    }
+
+
+def _percent(value: Optional[float]) -> str:
+    return f"{value * 100:.0f}%" if value is not None else '—'
+
+
+def format_stats(stats: Dict) -> str:
+    """Форматировать статистику в текст (для консоли и бота)"""
+    last_day = stats['end_day'] - timedelta(days=1)
+    lines = [
+        f"📊 Статистика {stats['start_day'].strftime('%d.%m.%Y')} - {last_day.strftime('%d.%m.%Y')}",
+        "",
+        f"Записей: {stats['bookings']}, отменено: {stats['cancelled']} "
+        f"({_percent(stats['cancellation_rate'])})",
+        f"Загрузка: {_percent(stats['utilization'])}",
+    ]
+    
+    if stats['avg_lead_hours'] is not None:
+        lines.append(f"Среднее время от записи до сессии: {stats['avg_lead_hours'] / 24:.1f} дн.")
+    
+    lines += ["", "По дням недели:"]
+    for row in stats['by_weekday']:
+        lines.append(f"  {WEEKDAY_NAMES[row['weekday']]}: {_percent(row['utilization'])} "
+                     f"({row['bookings']} зап.)")
+    
+    lines += ["", "По часам:"]
+    for row in stats['by_hour']:
+        lines.append(f"  {row['hour']:02d}:00: {_percent(row['utilization'])} "
+                     f"({row['bookings']} зап.)")
+    
+    if stats['no_show_candidates']:
+        tz = pytz.timezone(config.PRIMARY_TZ)
+        lines += ["", "Возможные неявки (не подтверждены):"]
+        for booking in stats['no_show_candidates']:
+            start_local = datetime.fromisoformat(booking['start_time_utc']).astimezone(tz)
+            name = booking['client_first_name'] or booking['client_telegram_id']
+            lines.append(f"  #{booking['id']} {start_local.strftime('%d.%m.%Y %H:%M')} {name}")
+    
+    return '\n'.join(lines)
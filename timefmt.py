@@ -0,0 +1,101 @@
+"""
+Форматирование времени в часовом поясе клиента
+
+Объекты часовых поясов и смещения от UTC кэшируются: для каждого
+(пояс, день UTC) смещение вычисляется один раз, дальше перевод времени -
+это сложение с timedelta, без обращения к pytz.
+"""
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from typing import Optional, Tuple
+import pytz
+import config
+
+
+@lru_cache(maxsize=None)
+def get_tz(tz_name: str) -> pytz.BaseTzInfo:
+    """Объект часового пояса (кэшируется)"""
+    return pytz.timezone(tz_name)
+
+
+def is_valid_tz(tz_name: str) -> bool:
+    """Проверить, что имя часового пояса известно pytz"""
+    return tz_name in pytz.all_timezones_set
+
+
+@lru_cache(maxsize=4096)
+def _day_offsets(tz_name: str, utc_day: date) -> Tuple[Tuple[datetime, timedelta], ...]:
+    """
+    Таблица смещений пояса на сутки UTC: ((начало действия, смещение), ...)
+    Обычно одна запись; в день перехода на летнее/зимнее время - две.
+    """
+    tz = get_tz(tz_name)
+    day_start = datetime.combine(utc_day, time(0, 0), tzinfo=pytz.utc)
+    day_end = day_start + timedelta(days=1) - timedelta(microseconds=1)
+    
+    first = day_start.astimezone(tz).utcoffset()
+    last = day_end.astimezone(tz).utcoffset()
+    if first == last:
+        return ((day_start, first),)
+    
+    # Найти момент перехода с точностью до минуты
+    low, high = day_start, day_end
+    while high - low > timedelta(minutes=1):
+        middle = low + (high - low) / 2
+        if middle.astimezone(tz).utcoffset() == first:
+            low = middle
+        else:
+            high = middle
+    transition = high.replace(second=0, microsecond=0)
+    if transition.astimezone(tz).utcoffset() != last:
+        transition += timedelta(minutes=1)
+    
+    return ((day_start, first), (transition, last))
+
+
+def utc_offset(dt_utc: datetime, tz_name: str) -> timedelta:
+    """Смещение пояса от UTC в момент dt_utc"""
+    if dt_utc.tzinfo is not None:
+        dt_utc = dt_utc.astimezone(pytz.utc)
+    else:
+        dt_utc = dt_utc.replace(tzinfo=pytz.utc)
+    
+    offsets = _day_offsets(tz_name, dt_utc.date())
+    offset = offsets[0][1]
+    for since, value in offsets[1:]:
+        if dt_utc >= since:
+            offset = value
+    return offset
+
+
+def to_local(dt_utc: datetime, tz_name: Optional[str] = None) -> datetime:
+    """Перевести время UTC в локальное время пояса (naive datetime)"""
+    tz_name = tz_name or config.PRIMARY_TZ
+    offset = utc_offset(dt_utc, tz_name)
+    if dt_utc.tzinfo is not None:
+        dt_utc = dt_utc.astimezone(pytz.utc)
+    return dt_utc.replace(tzinfo=None) + offset
+
+
+def format_time(dt_utc: datetime, tz_name: Optional[str] = None) -> str:
+    """'HH:MM' в поясе tz_name"""
+    local = to_local(dt_utc, tz_name)
+    return f"{local.hour:02d}:{local.minute:02d}"
+
+
+def format_date(dt_utc: datetime, tz_name: Optional[str] = None) -> str:
+    """'DD.MM.YYYY' в поясе tz_name"""
+    local = to_local(dt_utc, tz_name)
+    return f"{local.day:02d}.{local.month:02d}.{local.year}"
+
+
+def format_datetime(dt_utc: datetime, tz_name: Optional[str] = None) -> str:
+    """'DD.MM.YYYY HH:MM' в поясе tz_name"""
+    local = to_local(dt_utc, tz_name)
+    return f"{local.day:02d}.{local.month:02d}.{local.year} {local.hour:02d}:{local.minute:02d}"
+
+
+def tz_label(tz_name: Optional[str] = None) -> str:
+    """Подпись пояса для сообщений: 'по времени Минска'"""
+    tz_name = tz_name or config.PRIMARY_TZ
+    return f"по времени {config.CLIENT_TIMEZONES.get(tz_name, {}).get('genitive', tz_name)}"
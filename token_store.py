@@ -0,0 +1,97 @@
+"""
+Хранение OAuth-токена Google в JSON
+
+Токен пишется атомарно: во временный файл в том же каталоге, fsync, затем
+os.replace - при сбое на диске остается либо старый, либо новый токен
+целиком. Старые token.pickle и GOOGLE_TOKEN_PICKLE_BASE64 читаются один раз
+и переносятся в JSON.
+"""
+import base64
+import json
+import logging
+import os
+import pickle
+import tempfile
+from typing import Optional
+from google.oauth2.credentials import Credentials
+import config
+
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/calendar']
+TOKEN_PATH = config.GOOGLE_TOKEN_PATH
+LEGACY_PICKLE_PATH = os.path.splitext(TOKEN_PATH)[0] + '.pickle'
+
+
+def save_credentials(creds: Credentials, path: str = TOKEN_PATH):
+    """Атомарно сохранить токен в JSON (права 600)"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.token-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(creds.to_json())
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_credentials(path: str = TOKEN_PATH) -> Optional[Credentials]:
+    """Загрузить токен из JSON-файла (None - файла нет)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return Credentials.from_authorized_user_info(json.load(f), SCOPES)
+
+
+def migrate_pickle(pickle_path: str = LEGACY_PICKLE_PATH,
+                   path: str = TOKEN_PATH) -> Optional[Credentials]:
+    """
+    Перенести токен из token.pickle в JSON
+    Старый файл переименовывается в .bak, чтобы pickle больше не загружался.
+    """
+    if not os.path.exists(pickle_path):
+        return None
+    
+    with open(pickle_path, 'rb') as f:
+        creds = pickle.load(f)
+    save_credentials(creds, path)
+    os.replace(pickle_path, pickle_path + '.bak')
+    return creds
+
+
+def load_or_migrate() -> Optional[Credentials]:
+    """
+    Найти токен: JSON-файл, старый token.pickle, переменные окружения
+    GOOGLE_TOKEN_JSON или (устаревшая) GOOGLE_TOKEN_PICKLE_BASE64.
+    Токен из старых источников сразу сохраняется в JSON.
+    """
+    creds = load_credentials()
+    if creds:
+        return creds
+    
+    creds = migrate_pickle()
+    if creds:
+        logger.info(f"Токен перенесен из {LEGACY_PICKLE_PATH} в {TOKEN_PATH}")
+        return creds
+    
+    if os.getenv('GOOGLE_TOKEN_JSON'):
+        creds = Credentials.from_authorized_user_info(json.loads(os.getenv('GOOGLE_TOKEN_JSON')), SCOPES)
+    elif os.getenv('GOOGLE_TOKEN_PICKLE_BASE64'):
+        creds = pickle.loads(base64.b64decode(os.getenv('GOOGLE_TOKEN_PICKLE_BASE64')))
+        logger.warning("GOOGLE_TOKEN_PICKLE_BASE64 устарела, используйте GOOGLE_TOKEN_JSON "
+                       f"(содержимое {TOKEN_PATH})")
+    
+    if creds:
+        try:
+            save_credentials(creds)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить токен в {TOKEN_PATH}: {e}")
+    return creds
@@ -0,0 +1,159 @@
+"""
+Параллельная обработка обновлений с сохранением порядка для каждого пользователя
+
+Обновления разных пользователей обрабатываются одновременно (не больше
+max_running сразу), обновления одного пользователя - строго по очереди, в
+порядке поступления: ConversationHandler рассчитан на последовательную
+обработку, а ключ его состояния - (чат, пользователь).
+
+Когда все места заняты, свободное место получает ожидающее обновление с
+наивысшим приоритетом (подтверждение записи раньше просмотра слотов). Если
+ожидающих не меньше shed_queue_size, обновления просмотра в очередь не
+ставятся: пользователь сразу получает просьбу повторить через несколько секунд.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import config
+
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты (меньше - важнее)
+PRIORITY_COMMIT = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BROWSE = 2
+
+SHED_MESSAGE = "⏳ Сейчас много запросов. Повторите, пожалуйста, через несколько секунд."
+
+
+class PriorityLimiter:
+    """Не больше limit одновременно работающих задач, ожидающие - по приоритету"""
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()  # Порядок поступления при равном приоритете
+    
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+    
+    async def acquire(self, priority: int):
+        if self.running < self.limit and not self.waiting:
+            self.running += 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            # release передает место напрямую, running при этом не меняется
+            await future
+        except asyncio.CancelledError:
+            # Место уже было передано - вернуть его следующему
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+    
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик обновлений для Application.builder().concurrent_updates(...)
+    priority_of(update) -> PRIORITY_* определяет очередность при перегрузке.
+    """
+    
+    def __init__(self, priority_of: Callable[[object], int],
+                 max_running: int = config.UPDATE_MAX_RUNNING,
+                 shed_queue_size: int = config.UPDATE_SHED_QUEUE_SIZE,
+                 max_in_flight: int = config.UPDATE_MAX_IN_FLIGHT):
+        # Семафор базового класса ограничивает все принятые обновления,
+        # включая ожидающие своей очереди; работающие ограничивает limiter
+        super().__init__(max_in_flight)
+        self.priority_of = priority_of
+        self.shed_queue_size = shed_queue_size
+        self.limiter = PriorityLimiter(max_running)
+        # Ключ пользователя -> [замок, число обновлений, которые его ждут или держат]
+        self._user_locks: Dict[Hashable, List] = {}
+        self._counters = {'processed': 0, 'shed': 0}
+    
+    @staticmethod
+    def _user_key(update: object) -> Optional[Hashable]:
+        """Ключ порядка - как у ConversationHandler: (чат, пользователь)"""
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        priority = self.priority_of(update)
+        if priority >= PRIORITY_BROWSE and self.limiter.waiting >= self.shed_queue_size:
+            coroutine.close()
+            await self._shed(update)
+            return
+        
+        key = self._user_key(update)
+        if key is None:
+            await self._run(priority, coroutine)
+            return
+        
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(priority, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+    
+    async def _run(self, priority: int, coroutine: Awaitable[Any]):
+        await self.limiter.acquire(priority)
+        try:
+            await coroutine
+        finally:
+            self.limiter.release()
+            self._counters['processed'] += 1
+    
+    async def _shed(self, update: object):
+        """Отказать в обработке с понятным сообщением"""
+        self._counters['shed'] += 1
+        logger.warning(f"Перегрузка: обновление {getattr(update, 'update_id', None)} отклонено "
+                       f"(ожидают {self.limiter.waiting})")
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(SHED_MESSAGE, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(SHED_MESSAGE)
+        except Exception as e:
+            logger.error(f"Не удалось отправить сообщение о перегрузке: {e}")
+    
+    def get_metrics(self) -> Dict:
+        """Работающие и ожидающие обновления, счетчики"""
+        return dict(
+            self._counters,
+            running=self.limiter.running,
+            waiting=self.limiter.waiting,
+            users_in_flight=len(self._user_locks),
+        )
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
@@ -0,0 +1,142 @@
+"""
+Лист ожидания
+
+Клиент подписывается на дату и диапазон времени начала. Когда запись
+отменяется, освободившееся время сразу предлагается подписчикам по
+очереди подписки: первому подходящему - с исключительной бронью на
+WAITLIST_HOLD_MINUTES минут (остальным это время не показывается). Если
+он отказался или бронь истекла, время предлагается следующему.
+
+Подписчики ищутся по индексу (дата, диапазон) в момент отмены -
+периодического перебора подписок нет.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import pytz
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+import callbacks
+import config
+import timefmt
+from database import Database
+
+
+logger = logging.getLogger(__name__)
+
+# Код -> (название, from_time, to_time): диапазоны для подписки из бота
+RANGES = {
+    'a': ('Любое время', '00:00', '24:00'),
+    'm': ('До 14:00', '00:00', '14:00'),
+    'e': ('После 14:00', '14:00', '24:00'),
+}
+
+
+def _parse_utc(value: str) -> datetime:
+    return datetime.fromisoformat(value).replace(tzinfo=pytz.utc)
+
+
+def format_range(from_time: str, to_time: str) -> str:
+    """Диапазон подписки для сообщений"""
+    for name, start, end in RANGES.values():
+        if (start, end) == (from_time, to_time):
+            return name.lower()
+    return f"{from_time}-{to_time}"
+
+
+def offer_slot(db: Database, start_utc: datetime, end_utc: datetime) -> Optional[Dict]:
+    """
+    Предложить свободное время [start_utc, end_utc) следующему подписчику
+    end_utc - конец занятого интервала (вместе с перерывом после сессии).
+    Подходят услуги, которые в нем помещаются. Возвращает бронь или None.
+    """
+    now = datetime.now(pytz.utc)
+    if start_utc < now + timedelta(hours=config.MIN_HOURS_BEFORE_BOOKING):
+        return None
+    
+    free_minutes = (end_utc - start_utc).total_seconds() / 60
+    service_types = [
+        key for key, service in config.SERVICE_TYPES.items()
+        if service['duration'] + service['buffer'] <= free_minutes
+    ]
+    if not service_types:
+        return None
+    
+    local = timefmt.to_local(start_utc)
+    return db.hold_slot_for_waiter(
+        start_utc.isoformat(), end_utc.isoformat(),
+        local.date().isoformat(), local.strftime('%H:%M'), service_types,
+        (now + timedelta(minutes=config.WAITLIST_HOLD_MINUTES)).isoformat()
+    )
+
+
+def offer_cancelled(db: Database, bookings: Iterable[Dict]) -> List[Dict]:
+    """Записи отменены: предложить их время подписчикам, возвращает брони"""
+    offers = []
+    for booking in bookings:
+        buffer = config.SERVICE_TYPES.get(booking.get('service_type'), {}).get('buffer', 0)
+        offer = offer_slot(
+            db,
+            _parse_utc(booking['start_time_utc']),
+            _parse_utc(booking['end_time_utc']) + timedelta(minutes=buffer)
+        )
+        if offer:
+            offers.append(offer)
+    return offers
+
+
+def offer_released(db: Database, holds: Iterable[Dict]) -> List[Dict]:
+    """Брони истекли или от них отказались: предложить время следующим"""
+    offers = []
+    for hold in holds:
+        offer = offer_slot(db, _parse_utc(hold['start_time_utc']), _parse_utc(hold['end_time_utc']))
+        if offer:
+            offers.append(offer)
+    return offers
+
+
+def offer_message(db: Database, hold: Dict) -> Tuple[int, str, InlineKeyboardMarkup]:
+    """(chat_id, текст, кнопки) уведомления подписчику"""
+    user_id = hold['telegram_id']
+    tz_name = db.get_user_timezone(user_id) or config.PRIMARY_TZ
+    start_utc = _parse_utc(hold['start_time_utc'])
+    service = config.SERVICE_TYPES[hold['service_type']]
+    
+    text = (
+        "🔔 Освободилось время, которого вы ждали:\n\n"
+        f"📅 {timefmt.format_date(start_utc, tz_name)}\n"
+        f"🕐 {timefmt.format_time(start_utc, tz_name)} ({timefmt.tz_label(tz_name)})\n"
+        f"🗂 {service['name']}\n\n"
+        f"Время закреплено за вами на {config.WAITLIST_HOLD_MINUTES} минут. "
+        "Если оно не подходит, откажитесь - его предложат следующему в очереди."
+    )
+    start_code = callbacks.encode_datetime(start_utc)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Записаться",
+                              callback_data=callbacks.encode('waitlist_book', start_code, user_id=user_id))],
+        [InlineKeyboardButton("✖️ Отказаться",
+                              callback_data=callbacks.encode('waitlist_skip', start_code, user_id=user_id))],
+    ])
+    return user_id, text, keyboard
+
+
+async def send_offers(db: Database, bot, offers: List[Dict]) -> int:
+    """
+    Отправить предложения подписчикам, возвращает число отправленных
+    Если подписчику не удалось написать (например, он остановил бота),
+    бронь снимается и время сразу предлагается следующему.
+    """
+    sent = 0
+    pending = list(offers)
+    while pending:
+        hold = pending.pop(0)
+        chat_id, text, keyboard = offer_message(db, hold)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+            sent += 1
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить предложение листа ожидания {chat_id}: {e}")
+            released = db.release_slot_hold(hold['start_time_utc'], chat_id)
+            if released:
+                pending.extend(offer_released(db, [released]))
+    return sent